@@ -1,7 +1,9 @@
 import os
-import threading
+import time
 import json
 import random
+import shutil
+from multiprocessing import Pool
 
 # function for generating unique ids
 #####################################
@@ -12,112 +14,137 @@ def uniqueid():
        seed += 1
 #####################################
 
+# BDD100K category --> our category id (0 vehicle, 1 person, 2 motorbike)
+CATEGORIES = {"car" : 0, "truck" : 0, "bus" : 0, "pedestrian" : 1, "rider" : 1, "other person" : 1, "motorcycle" : 2}
+
+# video name --> 'timeofday', sent ONCE to each worker process by 'init_worker' (and not with every video)
+timeofday_dict = {}
+
+def init_worker(dictionary):
+    global timeofday_dict
+    timeofday_dict = dictionary
+
+# it runs inside the worker processes (so it has to be a top-level function)
+def build_labels(labels_dir, json_video):
+    """
+    Reads the json file of one video and returns a list with one (image, labels) pair for each frame.
+    The ids of images and labels are assigned afterwards by the main process, so they are unique among all the workers.
+    """
+    d = json.load(open(labels_dir+"/"+json_video))
+    name_video = d[0]["videoName"]
+    timeofday = timeofday_dict.get(name_video) # è il dizionario che contiene le info rigurdanti il 'timeofday' di ogni video
+
+    frames = []
+    for image_dict in d:
+        name_image = name_video +"/" + image_dict["name"]
+        width = 1280
+        height = 720
+        image = {"file_name" : name_image, "video_id" : name_video, "width" : width, "height" : height, "dataset" : "bdd100k", "timeofday" : timeofday}
+        list_labels = []
+        for label in image_dict["labels"]:
+            cat_id = CATEGORIES.get(label["category"])
+            if cat_id is not None:
+                if label["attributes"]["truncated"] == False and label["attributes"]["crowd"] == False:
+                    # (x1,y1) è l'angolo sx di sopra e (x2,y2) quello dx di sotto.
+                    x1 = label["box2d"]["x1"]
+                    y1 = label["box2d"]["y1"]
+                    x2 = label["box2d"]["x2"]
+                    y2 = label["box2d"]["y2"]
+                    w = x2-x1
+                    h = y2-y1
+                    bbox = [x1, y1, w, h]
+                    list_labels.append({"id" : label["id"], "category_id" : cat_id, "bbox" :  bbox})
+        frames.append((image, list_labels))
+    return frames
+
+def build_labels_star(args):
+    return build_labels(*args)
+
+class StreamingJSONList:
+    """ Writes the elements of a (potentially huge) json list one at a time into a temporary file. """
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "w")
+        self.count = 0
+    def append(self, element):
+        if self.count > 0:
+            self.f.write(",")
+        self.f.write(json.dumps(element))
+        self.count += 1
+    def close(self):
+        self.f.close()
+
 class BDD100KToolKit:
-    def __init__(self, labels_json=None, labels_dir=None, timeofday_list=None):
+    def __init__(self, labels_json=None, labels_dir=None, timeofday_dict=None, num_workers=None):
 
         self.get_id = uniqueid()
-        
+
         self.labels_dir = labels_dir
         self.labels_json = labels_json
-        self.timeofday_list = timeofday_list # è la lista che contiene le info rigurdanti il 'timeofday' di ogni video
-        
-        self.json_dictionaries = []
-        
+        self.timeofday_dict = timeofday_dict # video name --> 'timeofday'
+        self.num_workers = num_workers if num_workers is not None else os.cpu_count()
+
     def list_json_videos(self):
         l = []
         for file in os.listdir(self.labels_dir):
             if file.endswith(".json"):
                 l.append(file)
         return l
-        
-    def build_labels(self, json_video, index):
-        
-            d = json.load(open(self.labels_dir+"/"+json_video))
-            name_video = d[0]["videoName"]
-            timeofday = None
-            for i in range(len(self.timeofday_list)):
-                if self.timeofday_list[i]["video_name"] == name_video:
-                    timeofday = self.timeofday_list.pop(i)["timeofday"]
-                    break
-            totalFrames = d[-1]["frameIndex"] + 1
-            #self.update_json_video(name_video, totalFrames, i)
-
-            list_image = []
-            for image_dict in d:
-                name_image = name_video +"/" + image_dict["name"]
-                image_id = next(self.get_id)
-                width = 1280
-                height = 720
-                list_image.append({"id" : image_id, "file_name" : name_image, "video_id" : name_video, "width" : width, "height" : height, "dataset" : "bdd100k", "timeofday" : timeofday})
-                list_labels = []
-                for label in image_dict["labels"]:
-                    if label["category"] == "car" or label["category"] == "truck" or label["category"] == "bus" or label["category"] == "pedestrian" or label["category"] == "rider" or label["category"] == "other person"  or label["category"] == "motorcycle":
-                        if label["attributes"]["truncated"] == False and label["attributes"]["crowd"] == False:
-                            id = label["id"]
-                            # (x1,y1) è l'angolo sx di sopra e (x2,y2) quello dx di sotto.
-                            x1 = label["box2d"]["x1"]
-                            y1 = label["box2d"]["y1"]
-                            x2 = label["box2d"]["x2"]
-                            y2 = label["box2d"]["y2"]
-                            w = x2-x1
-                            h = y2-y1
-                            bbox = [x1, y1, w, h]
-                            if label["category"] == "car" or label["category"] == "truck" or label["category"] == "bus":
-                                cat_id = 0
-                            elif label["category"] == "pedestrian" or label["category"] == "rider" or label["category"] == "other person":
-                                cat_id = 1
-                            elif label["category"] == "motorcycle":
-                                cat_id = 2
-                            list_labels.append({"id" : id, "image_id" : image_id, "category_id" : cat_id, "bbox" :  bbox})
-                self.update_json_annotation(list_labels, index)
-            self.update_json_image(list_image, index)
-           
-        
-    def bdd100k_building(self):
-        
-        iteration = 0
-        list_json_videos = self.list_json_videos()
+
+    def bdd100k_building(self, max_videos=1500):
+
+        list_json_videos = self.list_json_videos()[:max_videos] # 1400 videos
         num_json_video = len(list_json_videos)
-        
-        num_dictionaries = int(num_json_video/100)
-        for _ in range(num_dictionaries):
-            self.json_dictionaries.append(json.load(open(self.labels_json)))
-        print("----------- We created {} 'support dictionaries' to improve efficiency -----------".format(len(self.json_dictionaries)))
-            
-        for json_video in list_json_videos: # 1400 videos
-            json_dict_index = int(iteration/100)
-            iteration = iteration + 1
-            num_json_video = num_json_video - 1
-            print("^^^^^^^^^^^^^^^^^^^^^^ Starting processing {} ^^^^^^^^^^^^^^^^^^^^^^".format(json_video))
-            if num_json_video != 0:
-                print("^^^^^^^^^^^^^^^^^^^^^^     {} json files left     ^^^^^^^^^^^^^^^^^^^^^^".format(num_json_video))
-            else:
-                print("^^^^^^^^^^^^^^^^^^^^^^  Last json file to process ^^^^^^^^^^^^^^^^^^^^^^")
-                
-            t = threading.Thread(target=self.build_labels, args=[json_video, json_dict_index])
-            t.start()
-            t.join()
-                
-            if iteration == 1500:
-                break
-            
+
+        # images and annotations are streamed into two temporary files while the workers produce them,
+        # so we never keep (nor concatenate) the full lists in memory
+        images_writer = StreamingJSONList(self.labels_json + ".images.tmp")
+        annotations_writer = StreamingJSONList(self.labels_json + ".annotations.tmp")
+
+        start = time.time()
+        with Pool(self.num_workers, initializer=init_worker, initargs=(self.timeofday_dict,)) as pool:
+            args = [(self.labels_dir, json_video) for json_video in list_json_videos]
+            # 'imap' keeps the order of the videos --> consecutive ids in video order (from the random start of 'uniqueid')
+            for iteration, frames in enumerate(pool.imap(build_labels_star, args, chunksize=4), start=1):
+                for image, list_labels in frames:
+                    image_id = next(self.get_id)
+                    image["id"] = image_id
+                    images_writer.append(image)
+                    for label in list_labels:
+                        label["image_id"] = image_id
+                        annotations_writer.append(label)
+                if iteration % 50 == 0 or iteration == num_json_video:
+                    elapsed = time.time() - start
+                    print("^^^^^^^^^^^^^^^^^^^^^^ {}/{} json files processed ({:.2f} videos/s) ^^^^^^^^^^^^^^^^^^^^^^".format(iteration, num_json_video, iteration/elapsed))
+        images_writer.close()
+        annotations_writer.close()
+        elapsed = time.time() - start
+
         print("################# Processing is Finished ;) #################")
-        print("Number of processed json files: {}".format(iteration))
-        print("loading the new label_json file...")
-        d = self.json_dictionaries[0]
-        for dict in self.json_dictionaries[1:]:
-            #d["videos"] = d["videos"] + dict["videos"]
-            d["images"] = d["images"] + dict["images"]
-            d["annotations"] = d["annotations"] + dict["annotations"]
-        f = open(self.labels_json, "w")
-        json.dump(d, f)
-        print("Done!")    
-            
-    #def update_json_video(self, name, num_frames, i, time_of_day=None):
-    #   self.json_dictionaries[i]["videos"].append({"id" : name, "num_frames" : num_frames, "time" : time_of_day})
-        
-    def update_json_image(self, list, i):
-        self.json_dictionaries[i]["images"] = self.json_dictionaries[i]["images"] + list
-        
-    def update_json_annotation(self, list, i):
-        self.json_dictionaries[i]["annotations"] = self.json_dictionaries[i]["annotations"] + list
\ No newline at end of file
+        print("Number of processed json files: {} in {:.1f}s ({:.2f} videos/s)".format(num_json_video, elapsed, num_json_video/max(elapsed, 1e-9)))
+        print("writing the new label_json file...")
+        self.write_labels_json(images_writer, annotations_writer)
+        print("Done!")
+
+    def write_labels_json(self, images_writer, annotations_writer):
+        # the previous content of 'labels_json' (e.g. the categories) is kept, the new images and annotations are appended to it
+        d = json.load(open(self.labels_json))
+        old_images = d.pop("images", [])
+        old_annotations = d.pop("annotations", [])
+        with open(self.labels_json + ".tmp", "w") as f:
+            f.write(json.dumps(d)[:-1]) # we drop the closing brace
+            f.write((", " if len(d) > 0 else "") + '"images": [')
+            self.copy_list(f, old_images, images_writer)
+            f.write('], "annotations": [')
+            self.copy_list(f, old_annotations, annotations_writer)
+            f.write("]}")
+        os.replace(self.labels_json + ".tmp", self.labels_json)
+        os.remove(images_writer.path)
+        os.remove(annotations_writer.path)
+
+    def copy_list(self, f, old_elements, writer):
+        f.write(",".join(json.dumps(e) for e in old_elements))
+        if len(old_elements) > 0 and writer.count > 0:
+            f.write(",")
+        with open(writer.path) as tmp:
+            shutil.copyfileobj(tmp, f)
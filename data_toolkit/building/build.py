@@ -7,21 +7,19 @@ from pycocotools.coco import COCO
 
 def add_timeofday():
 
-  print("Building 'timeofday_list'...")
+  print("Building 'timeofday_dict'...")
   d1 = json.load(open("/content/drive/MyDrive/VISIOPE/Project/datasets/BDD100K/labels/det_train.json"))
   d2 = json.load(open("/content/drive/MyDrive/VISIOPE/Project/datasets/BDD100K/labels/det_val.json"))
   
-  video_list = os.listdir("/content/drive/MyDrive/VISIOPE/Project/datasets/BDD100K/images/videos")
-  timeofday_list = []
-  for e in d1:
+  video_list = set(os.listdir("/content/drive/MyDrive/VISIOPE/Project/datasets/BDD100K/images/videos"))
+  # video name --> timeofday (constant time lookup for each video)
+  timeofday_dict = {}
+  for e in d1 + d2:
     if e["name"][:-4] in video_list:
-      timeofday_list.append({"video_name" : e["name"][:-4], "timeofday" : e["attributes"]["timeofday"]})
-  for e in d2:
-    if e["name"][:-4] in video_list:
-      timeofday_list.append({"video_name" : e["name"][:-4], "timeofday" : e["attributes"]["timeofday"]})
+      timeofday_dict.setdefault(e["name"][:-4], e["attributes"]["timeofday"])
 
   print("Done!")
-  return timeofday_list
+  return timeofday_dict
 
 def clean_json(coco_train, coco_val, d, train_lookup_video, val_lookup_video):
     d["categories"] = [{"name" : "vehicle", "id" : 0}, {"name" : "person", "id" : 1}, {"name" : "motorbike", "id" : 2}]
@@ -104,9 +102,9 @@ if __name__=="__main__":
     elif args.dataset == "bdd100k":
         labels_dir = "/content/drive/MyDrive/VISIOPE/Project/datasets/BDD100K/labels/old_json"
         labels_json = "/content/drive/MyDrive/VISIOPE/Project/datasets/BDD100K/labels/COCO/annotations.json"
-        timeofday_list = add_timeofday()
+        timeofday_dict = add_timeofday()
         
-        toolkit = bdd100k.BDD100KToolKit(labels_dir=labels_dir, labels_json=labels_json, timeofday_list = timeofday_list)
+        toolkit = bdd100k.BDD100KToolKit(labels_dir=labels_dir, labels_json=labels_json, timeofday_dict = timeofday_dict)
         toolkit.bdd100k_building()
         
     elif args.dataset == "argoverse": # since the labels are COCO-like, we just need to clean the already existed json file!
@@ -1,14 +1,14 @@
 import os
 import glob
-import threading
 import json
-import cv2
+import struct
 import random
-import tensorflow.compat.v1 as tf
-tf.enable_eager_execution()
+import cv2
+import numpy as np
+from multiprocessing import Pool
 
-from google.protobuf.json_format import MessageToDict # utile per manipolare i proto buffers
 from waymo_open_dataset import dataset_pb2 as open_dataset
+from waymo_open_dataset import label_pb2
 
 # function for generating unique ids
 #####################################
@@ -19,25 +19,104 @@ def uniqueid():
        seed += 1
 #####################################
 
+CAMERA_LIST = ["UNKNOWN", "FRONT", "FRONT_LEFT", "FRONT_RIGHT", "SIDE_LEFT", "SIDE_RIGHT"]
+FRONT_CAMERAS = {"FRONT", "FRONT_LEFT", "FRONT_RIGHT"} # the only images we keep
+# Waymo label type --> our category id (0 vehicle, 1 person)
+CATEGORIES = {label_pb2.Label.TYPE_VEHICLE : 0, label_pb2.Label.TYPE_PEDESTRIAN : 1, label_pb2.Label.TYPE_CYCLIST : 1}
+
+# TFRecord files are just a sequence of (length, crc, data, crc) records: we read them one at a time
+# (without materializing the whole segment and without needing tensorflow in the worker processes)
+def read_tfrecord(path):
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(12) # uint64 length + uint32 masked crc of the length
+            if len(header) < 12:
+                return
+            length = struct.unpack("<Q", header[:8])[0]
+            data = f.read(length)
+            f.read(4) # uint32 masked crc of the data
+            yield data
+
+def annotation_filter(label):
+    # we keep the objects that are not difficult to identify (UNKNOWN means that the level has not been set)
+    return label.detection_difficulty_level <= label_pb2.Label.LEVEL_1 and label.tracking_difficulty_level <= label_pb2.Label.LEVEL_1
+
+def clean_directory(files):
+    for f in files:
+        try:
+            os.remove(f)
+        except OSError as e:
+            print("Error: %s : %s" % (f, e.strerror))
+
+# these two functions run inside the worker processes (so they have to be top-level functions):
+# each worker streams the frames of one segment, so only one frame at a time is in memory
+def extract_segment_images(tfrecord_dir, images_dir, segment):
+    images_seg_dir = images_dir + "/" + segment[:-28]
+    if not os.path.exists(images_seg_dir):
+        os.makedirs(images_seg_dir)
+    # clear images from previous executions
+    clean_directory(glob.glob('{}/**/*.jpg'.format(images_seg_dir), recursive=True))
+
+    frame = open_dataset.Frame() # estraggo il Frame
+    num_frames = 0
+    for frameIdx, record in enumerate(read_tfrecord("{}/{}".format(tfrecord_dir, segment))):
+        frame.ParseFromString(record)
+        for data in frame.images:
+            camera = CAMERA_LIST[data.name]
+            if camera in FRONT_CAMERAS: # we decode only the images we keep
+                decodedImage = cv2.imdecode(np.frombuffer(data.image, dtype=np.uint8), cv2.IMREAD_COLOR) # already BGR
+                cv2.imwrite("{}/{:03d}_{}.jpg".format(images_seg_dir, frameIdx, camera), decodedImage)
+        num_frames += 1
+    return segment, num_frames
+
+def extract_segment_labels(tfrecord_dir, segment):
+    """
+    Returns a list with one (images, labels) pair for each frame of the segment:
+    'images' maps each FRONT camera to its image entry and 'labels' is a list of (camera, annotation) pairs.
+    The ids are assigned afterwards by the main process, so they are unique among all the workers.
+    """
+    frame = open_dataset.Frame()
+    frames = []
+    for frameIdx, record in enumerate(read_tfrecord("{}/{}".format(tfrecord_dir, segment))):
+        frame.ParseFromString(record)
+        images = {}
+        for data in frame.images:
+            camera = CAMERA_LIST[data.name]
+            if camera in FRONT_CAMERAS:
+                images[camera] = {"file_name" : (segment[:-28]+"/"+str(frameIdx)+"_"+camera+".png"), "video_id" : segment[:-28], "width" : frame.context.camera_calibrations[0].width, "height" : frame.context.camera_calibrations[0].height, "dataset" : "waymo", "timeofday" : frame.context.stats.time_of_day}
+        labels = []
+        # we read the protobuf fields directly (no more conversion to dictionaries)
+        for data in frame.camera_labels:
+            camera = CAMERA_LIST[data.name]
+            if camera not in FRONT_CAMERAS:
+                continue
+            for label in data.labels: # iteriamo sulle labels di una singola immagine
+                cat_id = CATEGORIES.get(label.type)
+                if cat_id is not None and annotation_filter(label): # vado a filtrare anche gli oggetti più difficili da identificare
+                    x = label.box.center_x - 0.5 * label.box.length
+                    y = label.box.center_y - 0.5 * label.box.width
+                    bbox = [x, y, label.box.length, label.box.width]
+                    labels.append((camera, {"id" : label.id, "category_id" : cat_id, "bbox" :  bbox}))
+        frames.append((images, labels))
+    return frames
+
+def extract_segment_images_star(args):
+    return extract_segment_images(*args)
+
+def extract_segment_labels_star(args):
+    return extract_segment_labels(*args)
+
 class WaymoToolKit:
-    def __init__(self, tfrecord_dir=None,  images_dir=None, labels_json=None, image_or_label=None):
+    def __init__(self, tfrecord_dir=None,  images_dir=None, labels_json=None, image_or_label=None, num_workers=None):
         self.get_id = uniqueid()
-        self.frame_ids = {"FRONT" : None, "FRONT_RIGHT" : None, "FRONT_LEFT" : None}
-        self.segment = None
-        
+
         self.tfrecord_dir = tfrecord_dir
         self.images_dir = images_dir
         self.labels_json = labels_json
-        
+
         self.image_or_label = image_or_label
-        self.images_seg_dir = None
         self.json_dictionary = json.load(open(labels_json))
-
-        self.camera_list = ["UNKNOWN", "FRONT", "FRONT_LEFT", "FRONT_RIGHT", "SIDE_LEFT", "SIDE_RIGHT"]
-
-    def assign_segment(self, segment):
-        self.segment = segment
-        self.dataset = tf.data.TFRecordDataset("{}/{}".format(self.tfrecord_dir, self.segment), compression_type='')
+        self.num_workers = num_workers if num_workers is not None else os.cpu_count()
 
     def list_segments(self):
         seg_list = []
@@ -45,163 +124,47 @@ class WaymoToolKit:
             if file.endswith(".tfrecord"):
                 seg_list.append(file)
         return seg_list
-    
-    def annotation_filter(self, label):
-        if "detectionDifficultyLevel" not in label.keys() or ("detectionDifficultyLevel" in label.keys() and label["detectionDifficultyLevel"]=="LEVEL_1"):
-            if "trackingDifficultyLevel" not in label.keys() or ("trackingDifficultyLevel" in label.keys() and label["trackingDifficultyLevel"]=="LEVEL_1"):
-                return True
-        return False
-    
-    # Extract Camera Image
-    def extract_image(self, ndx, frame):
-        if self.image_or_label == "image":
-            if 0 <= int(ndx) <= 9:
-                ndx = str(0) + str(0)+ str(ndx)
-            elif 10 <= int(ndx) <= 99:
-                ndx = str(0) + str(ndx)
-            for data in frame.images:
-                decodedImage = tf.io.decode_jpeg(data.image, channels=3, dct_method='INTEGER_ACCURATE')
-                decodedImage = cv2.cvtColor(decodedImage.numpy(), cv2.COLOR_RGB2BGR)
-                if self.camera_list[data.name]=="FRONT" or  self.camera_list[data.name]=="FRONT_LEFT" or self.camera_list[data.name]=="FRONT_RIGHT":
-                    cv2.imwrite("{}/{}_{}.jpg".format(self.images_seg_dir, ndx, self.camera_list[data.name]), decodedImage)
-        elif self.image_or_label == "label":
-            l = []
-            for data in frame.images:
-                if self.camera_list[data.name]=="FRONT" or  self.camera_list[data.name]=="FRONT_LEFT" or self.camera_list[data.name]=="FRONT_RIGHT":
-                    camera_type = self.camera_list[data.name]
-                    id = next(self.get_id)
-                    self.frame_ids[camera_type] = id
-                    l.append({"id" : id, "file_name" : (self.segment[:-28]+"/"+str(ndx)+"_"+self.camera_list[data.name]+".png"), "video_id" : self.segment[:-28], "width" : frame.context.camera_calibrations[0].width, "height" : frame.context.camera_calibrations[0].height, "dataset" : "waymo", "timeofday" : frame.context.stats.time_of_day})
-            self.update_json_image(l)
-    # Extract Camera Label
-    def extract_labels(self, ndx, frame): # ogni volta devo aggiungere una label
-        l=[]
-        for data in frame.camera_labels:
-            camera = MessageToDict(data) # converte dal .proto file
-            camera_name = camera["name"]
-            if "labels" in camera.keys() and (camera_name=="FRONT" or  camera_name=="FRONT_LEFT" or camera_name=="FRONT_RIGHT"):
-                labels = camera["labels"]
-                for label in labels: # iteriamo sulle labels di una singola immagine
-                    if label["type"] == "TYPE_VEHICLE" or label["type"] == "TYPE_PEDESTRIAN" or label["type"] == "TYPE_CYCLIST":
-                        if self.annotation_filter(label)==True : # vado a filtrare anche gli oggetti più difficili da identificare    
-                            x = label["box"]["centerX"]
-                            y = label["box"]["centerY"]
-                            width = label["box"]["width"]
-                            length = label["box"]["length"]
-                            x = x - 0.5 * length
-                            y = y - 0.5 * width
-                            if label["type"] == "TYPE_VEHICLE":
-                                cat_id = 0
-                            elif label["type"] == "TYPE_PEDESTRIAN" or label["type"] == "TYPE_CYCLIST":
-                                cat_id = 1
-                            id = label["id"]
-                            bbox = [x, y, length, width]
-                            image_id = self.frame_ids[camera_name]
-                            l.append({"id" : id, "image_id" : image_id, "category_id" : cat_id, "bbox" :  bbox})
-        self.update_json_annotation(l)
-               
-    
-    # Implemented Extraction as Threads
-    def camera_image_extraction_thread(self, datasetAsList, range_value):
-        frame = open_dataset.Frame() # estraggo il Frame
-        for frameIdx in range_value:
-            print("*************** processing frame {} ***************".format(frameIdx))
-            frame.ParseFromString(datasetAsList[frameIdx])
-            self.extract_image(frameIdx, frame)
-
-    # Function to call to extract images
-    def extract_camera_images(self): # we're processing only one segment
-
-        if self.image_or_label == "image":
-            self.images_seg_dir = self.images_dir + "/" + self.segment[:-28]
-            if not os.path.exists(self.images_seg_dir):
-                os.makedirs(self.images_seg_dir)
-            print("cleaning directory from previous images...")
-            # clear images from previous executions
-            self.clean_directory(glob.glob('{}/**/*.jpg'.format(self.images_seg_dir), recursive=True))
-            print("Done!")
 
-        # Convert tfrecord to a list
-        datasetAsList = list(self.dataset.as_numpy_iterator()) # lista dei frame relativi a un 'segment'
-        totalFrames = len(datasetAsList)
-        
-        if self.image_or_label == "label": # NO MULTITHREADING
-            frame = open_dataset.Frame()
-            for frameIdx in range(0, totalFrames):
-                self.frame_ids = {"FRONT" : None, "FRONT_RIGHT" : None, "FRONT_LEFT" : None}
-                print("*************** processing frame {} ***************".format(frameIdx))
-                frame.ParseFromString(datasetAsList[frameIdx])
-                #if frameIdx == 0: # aggiungo le informazioni del 'video' solo una volta!
-                #  self.update_json_video(self.segment[:-28], totalFrames, frame.context.stats.time_of_day)
-                self.extract_image(frameIdx, frame)
-                if self.image_or_label == "label":
-                    self.extract_labels(frameIdx, frame)
-                    
-        elif self.image_or_label == "image": # MULTITHREADING
-            threads = []
-            for i in self.batch(range(totalFrames), 30): # ogni thread si occupa di 30 frame alla volta
-                t = threading.Thread(target=self.camera_image_extraction_thread, args=[datasetAsList, i])
-                t.start()
-                threads.append(t)
-            
-            for thread in threads:
-                thread.join()
-
-    def waymo_building(self):
-        
+    def waymo_building(self, max_segments=1000):
+
         ##############  REMINDER !!!! #################
         # The segments that will be processed are the #
         # ones 'listed' in the "tfrecord_dir" folder. #
         # (both for image and label extraction)       #
-        
-        iteration = 0
-        list_segments = self.list_segments() # list of segments stored in 'tfrecord_dir'
+
+        list_segments = self.list_segments()[:max_segments] # for controlling how many segments we're going to process
         num_segments = len(list_segments)
-            
-        for segment in list_segments:
-            iteration = iteration + 1
-            num_segments = num_segments - 1
-            print("^^^^^^^^^^^^^^^^^^^^^^ Starting processing |{}| ^^^^^^^^^^^^^^^^^^^^^^".format(segment[:-28]))
-            if num_segments != 0:
-                print("^^^^^^^^^^^^^^^^^^^^^^     {} segments left     ^^^^^^^^^^^^^^^^^^^^^^".format(num_segments))
-            else:
-                print("^^^^^^^^^^^^^^^^^^^^^^  Last segment to process ^^^^^^^^^^^^^^^^^^^^^^")
-            self.assign_segment(segment)
-            
-            t = threading.Thread(target=self.extract_camera_images)
-            t.start()
-            t.join()
-                
-            if iteration == 1000: # for controlling how many segments we're going to process
-                break 
-            
+
+        # the segments are processed in parallel by the pool (one segment for each worker at a time)
+        with Pool(self.num_workers) as pool:
+            if self.image_or_label == "image":
+                args = [(self.tfrecord_dir, self.images_dir, segment) for segment in list_segments]
+                for iteration, (segment, num_frames) in enumerate(pool.imap_unordered(extract_segment_images_star, args), start=1):
+                    print("^^^^^^^^^^^^^^^^^^^^^^ |{}| done ({} frames), {} segments left ^^^^^^^^^^^^^^^^^^^^^^".format(segment[:-28], num_frames, num_segments-iteration))
+            elif self.image_or_label == "label":
+                args = [(self.tfrecord_dir, segment) for segment in list_segments]
+                # 'imap' keeps the order of the segments --> the ids are deterministic given the seed
+                for iteration, frames in enumerate(pool.imap(extract_segment_labels_star, args), start=1):
+                    self.update_json(frames)
+                    print("^^^^^^^^^^^^^^^^^^^^^^ |{}| done, {} segments left ^^^^^^^^^^^^^^^^^^^^^^".format(list_segments[iteration-1][:-28], num_segments-iteration))
+
         print("################# Processing is Finished ;) #################")
-        print("Number of processed segments: {}".format(iteration))
+        print("Number of processed segments: {}".format(num_segments))
         if self.image_or_label == "label":
             print("loading the new label_json file...")
             f = open(self.labels_json, "w")
-            json.dump(self.json_dictionary, f) 
+            json.dump(self.json_dictionary, f)
             print("Done!")
-            
+
     ######## Util Functions ########
 
-    def batch(self, iterable, n=1):
-        l = len(iterable)
-        for ndx in range(0, l, n):
-            yield iterable[ndx:min(ndx + n, l)]
-            
-    def clean_directory(self, files):
-        for f in files:
-            try:
-                os.remove(f)
-            except OSError as e:
-                print("Error: %s : %s" % (f, e.strerror))
-                
-    #def update_json_video(self, name, num_frames, time_of_day=None):
-    #    self.json_dictionary["videos"].append({"id" : name, "num_frames" : num_frames, "time" : time_of_day})
-        
-    def update_json_image(self, list):
-        self.json_dictionary["images"] = self.json_dictionary["images"] + list
-        
-    def update_json_annotation(self, list):
-        self.json_dictionary["annotations"] = self.json_dictionary["annotations"] + list
\ No newline at end of file
+    def update_json(self, frames):
+        for images, labels in frames:
+            frame_ids = {}
+            for camera, image in images.items():
+                image["id"] = next(self.get_id)
+                frame_ids[camera] = image["id"]
+                self.json_dictionary["images"].append(image)
+            for camera, label in labels:
+                label["image_id"] = frame_ids.get(camera)
+                self.json_dictionary["annotations"].append(label)
@@ -0,0 +1,134 @@
+import os
+import json
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from lookup_store import SOURCES, FRAME_STRIDES
+
+# maximum Hamming distance (over the 64 bits of the hash) under which a frame is a near-duplicate of the last kept one:
+# Waymo runs at 10 fps (many more near-duplicates) while BDD100K/Argoverse frames are already subsampled
+DEDUP_THRESHOLDS = {"waymo" : 10, "bdd100k" : 6, "argoverse" : 8}
+
+def video_source(video_folder):
+    roots = {root : name for name, root in SOURCES.items()}
+    return roots.get(video_folder.split("/images/videos/")[0])
+
+# it runs inside the worker processes of 'hash_frames' (so it has to be a top-level function)
+def dhash_batch(file_names, hash_size=8):
+    """
+    Difference hashes of a batch of frames: each frame is reduced to a (hash_size, hash_size+1) grayscale thumbnail and
+    each bit tells if a pixel is brighter than its right neighbour (robust to small shifts, noise and compression).
+    Returns:
+        np.array: (n, hash_size*hash_size/8) uint8 packed bits
+    """
+    thumbnails = np.empty((len(file_names), hash_size, hash_size + 1), dtype=np.int16)
+    for i, file_name in enumerate(file_names):
+        im = Image.open(file_name)
+        if im.format == "JPEG": # decoded directly at 1/8 of the size, the thumbnail is tiny anyway
+            im.draft("L", (hash_size * 8, hash_size * 8))
+        thumbnails[i] = np.asarray(im.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR))
+    # the comparisons of the whole batch at once
+    return np.packbits(thumbnails[:, :, 1:] > thumbnails[:, :, :-1], axis=-1).reshape(len(file_names), -1)
+
+def hamming(a, b):
+    # Hamming distances between packed hashes (broadcasting on the leading dimensions)
+    return np.unpackbits(np.bitwise_xor(a, b), axis=-1).sum(-1)
+
+def hash_frames(file_names, batch_size=64, num_workers=None, max_in_flight=None):
+    """
+    Perceptual hashes of all the frames, computed in batches by a pool of processes.
+    Returns:
+        np.array: (len(file_names), 8) hashes in the same order of 'file_names'
+    """
+    num_workers = num_workers if num_workers is not None else os.cpu_count()
+    max_in_flight = max_in_flight if max_in_flight is not None else 2*num_workers
+    hashes = np.zeros((len(file_names), 8), dtype=np.uint8)
+    batches = iter(range(0, len(file_names), batch_size))
+    with ProcessPoolExecutor(max_workers=num_workers) as pool, tqdm(total=len(file_names)) as pbar:
+        in_flight = {}
+        while True:
+            # we keep at most 'max_in_flight' batches inside the pool (like 'save_images')
+            for start in batches:
+                in_flight[pool.submit(dhash_batch, file_names[start:start + batch_size])] = start
+                if len(in_flight) >= max_in_flight:
+                    break
+            if len(in_flight) == 0:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                start = in_flight.pop(future)
+                batch = future.result()
+                hashes[start:start + len(batch)] = batch
+                pbar.update(len(batch))
+    return hashes
+
+def select_video_frames(hashes, threshold):
+    """
+    Greedy selection on the (sorted) frames of a video: a frame is kept only if it differs from the last kept frame by
+    more than 'threshold' bits, so a static scene gives few frames and a fast one keeps many of them.
+    Returns:
+        list: indices of the kept frames
+    """
+    if len(hashes) == 0:
+        return []
+    kept = [0]
+    for i in range(1, len(hashes)):
+        if hamming(hashes[i], hashes[kept[-1]]) > threshold:
+            kept.append(i)
+    return kept
+
+def stride_count(num_frames, source):
+    # number of frames kept by the fixed stride of 'extract_images'
+    offsets, stride = FRAME_STRIDES.get(source, ((0,), 1))
+    return sum(1 for i in range(0, num_frames, stride) for o in offsets if i + o < num_frames)
+
+def dedup_frames(file_images, thresholds=None, batch_size=64, num_workers=None):
+    """
+    Deduplication stage which replaces the fixed stride: frames are grouped by video, hashed, and selected per video with
+    the threshold of their source.
+    Returns:
+        tuple: (list of the selected frames, list of one row (dict) for each video)
+    """
+    thresholds = thresholds if thresholds is not None else DEDUP_THRESHOLDS
+    videos = {}
+    for f in file_images:
+        videos.setdefault(os.path.dirname(f), []).append(f)
+    frames = [f for video_folder in videos for f in sorted(videos[video_folder])]
+    print("Hashing {} frames of {} videos...".format(len(frames), len(videos)))
+    hashes = hash_frames(frames, batch_size, num_workers)
+    selected, rows = [], []
+    start = 0
+    for video_folder in videos:
+        n = len(videos[video_folder])
+        source = video_source(video_folder)
+        kept = select_video_frames(hashes[start:start + n], thresholds.get(source, max(thresholds.values())))
+        selected += [frames[start + i] for i in kept]
+        rows.append({"video" : video_folder, "source" : source, "frames" : n, "stride_kept" : stride_count(n, source), "dedup_kept" : len(kept),
+                     "bytes" : sum(os.path.getsize(f) for f in frames[start:start + n]), "dedup_bytes" : sum(os.path.getsize(frames[start + i]) for i in kept)})
+        start += n
+    return selected, rows
+
+def dedup_report(rows, seconds_per_image=None, report_path=None):
+    """
+    Size of the dataset with the fixed stride and with the deduplication (for each source and overall), and the training
+    time saved for each epoch ('seconds_per_image' is e.g. the training step time of 'src/benchmark.py' over the batch size).
+    """
+    sources = sorted({r["source"] for r in rows}, key=str) + ["total"]
+    table = []
+    for source in sources:
+        rs = [r for r in rows if source == "total" or r["source"] == source]
+        frames, stride_kept, dedup_kept = (sum(r[k] for r in rs) for k in ("frames", "stride_kept", "dedup_kept"))
+        bytes_per_frame = sum(r["bytes"] for r in rs) / max(frames, 1)
+        table.append({"source" : source, "videos" : len(rs), "frames" : frames, "stride_kept" : stride_kept, "dedup_kept" : dedup_kept,
+                      "reduction_vs_stride" : 1 - dedup_kept / max(stride_kept, 1),
+                      "stride_MB" : stride_kept * bytes_per_frame / 2**20, "dedup_MB" : sum(r["dedup_bytes"] for r in rs) / 2**20,
+                      "epoch_s_saved" : (stride_kept - dedup_kept) * seconds_per_image if seconds_per_image is not None else None})
+    print("{:<12}{:>8}{:>10}{:>10}{:>10}{:>12}{:>12}{:>12}{:>16}".format("source", "videos", "frames", "stride", "dedup", "reduction", "stride MB", "dedup MB", "epoch s saved"))
+    for r in table:
+        saved = "{:.1f}".format(r["epoch_s_saved"]) if r["epoch_s_saved"] is not None else "-"
+        print("{:<12}{:>8}{:>10}{:>10}{:>10}{:>11.1%}{:>12.1f}{:>12.1f}{:>16}".format(str(r["source"]), r["videos"], r["frames"], r["stride_kept"], r["dedup_kept"],
+                                                                                     r["reduction_vs_stride"], r["stride_MB"], r["dedup_MB"], saved))
+    if report_path is not None:
+        json.dump({"sources" : table, "videos" : rows}, open(report_path, "w"), indent=2)
+    return table
@@ -1,10 +1,22 @@
 import os
 import glob
 import random
+import time
 from PIL import Image
 import json
 from pycocotools.coco import COCO
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from lookup_store import SOURCES, source_annotations, select_frames
+from dedup import dedup_frames, dedup_report
+
+# output formats supported by 'save_images' --> (PIL format, file extension)
+IMAGE_FORMATS = {"jpeg" : ("JPEG", ".jpg"), "png" : ("PNG", ".png"), "webp" : ("WEBP", ".webp")}
+
+# outputs of 'extract_labels' and 'save_images' (they only make sense for the 'images_list' they were created from)
+SHARDS_DIR = "/content/drive/MyDrive/VISIOPE/Project/data/labels/COCO/shards"
+IMAGES_DIR = "/content/drive/MyDrive/VISIOPE/Project/data/images"
+MANIFEST_PATH = "/content/drive/MyDrive/VISIOPE/Project/data/saved_images_manifest.txt"
 
 def uniqueid():
     seed = 0
@@ -19,16 +31,40 @@ def name_id(id, x):
         name = '0' + name
     return name
 
+def rotate(path, suffix):
+    # the old outputs are renamed (and not deleted): nothing is lost if the new selection is not the good one
+    if os.path.exists(path):
+        print("Moving '{}' to '{}'".format(path, path + suffix))
+        os.replace(path, path + suffix)
+
+# it runs inside the worker processes of 'save_images' (so it has to be a top-level function)
+def export_image(file_name, out_path, size, img_format, quality, draft=False):
+    im = Image.open(file_name)
+    if draft and im.format == "JPEG":
+        # DCT-domain downscaling: the JPEG is decoded at the smallest 1/2, 1/4 or 1/8 scale which is still larger than 'size'
+        im.draft(None, size)
+    resized_im = im.resize(size)
+    final_im = resized_im.convert("RGB")
+    # we first write a temporary file and then we rename it: a crash never leaves a truncated image behind
+    tmp_path = out_path + ".tmp"
+    if img_format == "PNG":
+        final_im.save(tmp_path, format=img_format)
+    else:
+        final_im.save(tmp_path, format=img_format, quality=quality)
+    os.replace(tmp_path, out_path)
+    return out_path
+
 class ExtractionToolkit:
-    def __init__(self, img2id=None, img2oldID=None, oldID2id=None, images_list=None, old_ids_list=None):
+    def __init__(self, img2id=None, img2oldID=None, oldID2id=None, images_list=None, old_ids_list=None, store=None,
+                 images_list_path="/content/drive/MyDrive/VISIOPE/Project/data/images_list.json"):
 
         self.img2id = img2id
         self.img2oldID = img2oldID
         self.oldID2id = oldID2id
-        self.images_list = (json.load(open("/content/drive/MyDrive/VISIOPE/Project/data/images_list.json")))["images_list"]
+        self.images_list_path = images_list_path
+        self.images_list = (json.load(open(images_list_path)))["images_list"]
         self.old_ids_list = old_ids_list # all'inizio è 'None'
-        
-        self.processed_images_so_far = {"images_so_far" : []}
+        self.store = store # LookupStore of the incremental build (see lookup_store.py), it tells the source of each image
         
     def extract_images(self):
         print("Starting extracting images...")
@@ -77,77 +113,171 @@ class ExtractionToolkit:
         for img in self.images_list:
             self.old_ids_list.append(self.img2oldID[img])
         
-    def extract_labels(self):
+    def select_images(self, dedup=True, thresholds=None, num_workers=None, seconds_per_image=None,
+                      report_path="/content/drive/MyDrive/VISIOPE/Project/data/dedup_report.json",
+                      shards_dir=SHARDS_DIR, images_dir=IMAGES_DIR, manifest_path=MANIFEST_PATH):
+        """
+        New 'images_list' from all the frames of the sources. With 'dedup' the frames are selected by perceptual hashing
+        (see dedup.py) instead of the fixed stride (3 of every 9 Waymo frames, 1 of 3 BDD100K frames, 1 of 6 Argoverse frames).
+        NB: it changes the images of the dataset, so the label shards, the saved images and their manifest of the previous
+        'images_list' are moved aside ('<path>.before_select_<time>'): 'extract_labels' and 'save_images' then start from scratch
+        instead of resuming with the old images.
+        """
+        print("Listing the frames of the sources...")
+        frames = []
+        for root in SOURCES.values():
+            videos_dir = root + "/images/videos"
+            for v in os.listdir(videos_dir):
+                frames += [videos_dir + "/" + v + "/" + f for f in os.listdir(videos_dir + "/" + v)]
+        if dedup:
+            selected, rows = dedup_frames(frames, thresholds, num_workers=num_workers)
+            dedup_report(rows, seconds_per_image, report_path)
+        else:
+            selected = select_frames(frames)
+        random.shuffle(selected) # for shuffling the order of the images
+        print("Now the images are: {}".format(len(selected)))
+        suffix = ".before_select_" + time.strftime("%Y%m%d-%H%M%S")
+        for path in (shards_dir, images_dir, manifest_path):
+            rotate(path, suffix)
+        self.images_list = []
+        return self.append_images(selected)
+    
+    def append_images(self, new_images):
+        # the new selected frames go at the END of 'images_list': the position of the old ones (and so the names of the
+        # images already saved and the labels already extracted) doesn't change
+        known = set(self.images_list)
+        new_images = [f for f in new_images if f not in known]
+        self.images_list = self.images_list + new_images
+        with open(self.images_list_path + ".tmp", "w") as f:
+            json.dump({"images_list" : self.images_list}, f)
+        os.replace(self.images_list_path + ".tmp", self.images_list_path)
+        self.old_ids_list = None # it has to be rebuilt by 'extract_images'
+        return new_images
+    
+    def load_subsets(self, images_subset_path, annotations_subset_path):
+        # the subsets of the original 'images' and 'annotations' (only the ones of the selected images) are saved for EFFICIENCY REASONS,
+        # if they are not present (or some selected images are missing) we create them (in a single pass) from the COCO sources
+        images_list_subset, annotations_list_subset = [], []
+        if os.path.exists(images_subset_path) and os.path.exists(annotations_subset_path):
+            images_list_subset = (json.load(open(images_subset_path)))["images"]
+            annotations_list_subset = (json.load(open(annotations_subset_path)))["annotations"]
+        missing = set(self.old_ids_list) - {im["id"] for im in images_list_subset}
+        if len(missing) == 0:
+            return images_list_subset, annotations_list_subset
+        
+        print("Adding {} images to the images/annotations subsets...".format(len(missing)))
+        # with the lookup store we only load the sources of the missing images
+        names = self.store.datasets_of(missing) if self.store is not None else SOURCES.keys()
+        for name in names:
+            dataset = COCO(source_annotations(SOURCES[name])).dataset
+            images_list_subset += [im for im in dataset["images"] if im["id"] in missing]
+            annotations_list_subset += [ann for ann in dataset["annotations"] if ann["image_id"] in missing]
+        json.dump({"images" : images_list_subset}, open(images_subset_path, "w"))
+        json.dump({"annotations" : annotations_list_subset}, open(annotations_subset_path, "w"))
+        print("Done!")
+        return images_list_subset, annotations_list_subset
+    
+    def extract_labels(self, shards_dir=SHARDS_DIR, shard_size=500,
+                       annotations_path="/content/drive/MyDrive/VISIOPE/Project/data/labels/COCO/annotations.json"):
+        """
+        Linear-time creation of the new annotations.
+        The annotations are grouped by old image id in a single pass and the ids are remapped through the lookup tables.
+        Progress is checkpointed as JSONL shards (one line for each image, 'shard_size' images for each shard) which are
+        merged only at the end, so an interrupted run resumes from the last complete shard without rewriting 'annotations.json'.
+        """
         print("Starting extracting labels...")
-        coco_waymo = COCO("/content/drive/MyDrive/VISIOPE/Project/datasets/Waymo/labels/COCO/annotations.json")
-        coco_bdd100k = COCO("/content/drive/MyDrive/VISIOPE/Project/datasets/BDD100K/labels/COCO/annotations.json")
-        coco_argoverse = COCO("/content/drive/MyDrive/VISIOPE/Project/datasets/Argoverse/labels/COCO/annotations.json")
-        images = coco_waymo.dataset["images"] + coco_bdd100k.dataset["images"] + coco_argoverse.dataset["images"]
-        annotations = coco_waymo.dataset["annotations"] + coco_bdd100k.dataset["annotations"] + coco_argoverse.dataset["annotations"] 
+        images_list_subset, annotations_list_subset = self.load_subsets("/content/drive/MyDrive/VISIOPE/Project/data/images_list_subset.json",
+                                                                        "/content/drive/MyDrive/VISIOPE/Project/data/annotations_list_subset.json")
         
-        # loading the new annotations file
-        new_annotations = json.load(open("/content/drive/MyDrive/VISIOPE/Project/data/labels/COCO/annotations.json"))
+        # lookup tables built in ONE pass: old image id --> image and old image id --> its annotations
+        old_id2image = {im["id"] : im for im in images_list_subset}
+        old_id2annotations = {}
+        for ann in annotations_list_subset:
+            old_id2annotations.setdefault(ann["image_id"], []).append(ann)
         
         # needed if the overall process is interrupted during its execution! ("checkpoint logic")
-        self.processed_images_so_far = json.load(open("/content/drive/MyDrive/VISIOPE/Project/data/processed_images_so_far.json"))
-        step = self.processed_images_so_far["images_so_far"][-1]
-        self.images_list = self.images_list[step:]
-        self.old_ids_list = self.old_ids_list[step:]
-        
-        # saving the subsets of the original 'images' and 'annotations' for EFFICENCY REASONS
-        # (we need to create them again if not already present!)
-        images_list_subset = (json.load(open("/content/drive/MyDrive/VISIOPE/Project/data/images_list_subset.json")))["images"]
-        annotations_list_subset = (json.load(open("/content/drive/MyDrive/VISIOPE/Project/data/annotations_list_subset.json")))["annotations"]
-        #new_annotations_list = list(filter(lambda x: x["image_id"] in self.old_ids_list, tqdm(annotations)))
+        # only the shards which have been completed (renamed from '.tmp') are taken into account
+        os.makedirs(shards_dir, exist_ok=True)
+        shards = sorted(f for f in os.listdir(shards_dir) if f.endswith(".jsonl"))
+        step = 0
+        num_annotations = 0
+        for shard in shards:
+            with open(os.path.join(shards_dir, shard)) as f:
+                for line in f:
+                    step += 1
+                    num_annotations += len(json.loads(line)["annotations"])
+        print("Resuming from image {} ({} complete shards)".format(step, len(shards)))
         
         print("Create new annotations...")
-        id_generator = uniqueid()
-        for file_name,image_id in tqdm(zip(self.images_list, self.old_ids_list)):
+        shard_idx = len(shards)
+        shard_file = None
+        for file_name, image_id in tqdm(zip(self.images_list[step:], self.old_ids_list[step:]), total=len(self.images_list)-step):
+            if shard_file is None:
+                shard_path = os.path.join(shards_dir, "shard_{:05d}.jsonl".format(shard_idx))
+                shard_file = open(shard_path + ".tmp", "w")
             #--------------------------------------------------------------------------#
             step += 1
-            d = {}
-            im = list(filter(lambda x: x["id"]==self.img2oldID[file_name], images_list_subset))[0]       
-            id = self.img2id[file_name]
-            id = name_id(id, 6)
-            d["id"] = id
-            d["file_name"] = file_name
-            d["width"] = 1280
-            d["height"] = 720
-            d["timeofday"] = im["timeofday"]
-            new_annotations["images"].append(d)
-            images_list_subset.remove(im) # rimuovo per efficienza futura computazionale
+            im = old_id2image[self.img2oldID[file_name]]
+            new_image_id = name_id(self.img2id[file_name], 6)
+            d = {"id" : new_image_id, "file_name" : file_name, "width" : 1280, "height" : 720, "timeofday" : im["timeofday"]}
             #--------------------------------------------------------------------------#
-            annot = list(filter(lambda x: x["image_id"]==image_id, annotations_list_subset))
-            for ann in annot:
-                new_image_id = self.img2id[file_name]
-                new_image_id = name_id(new_image_id, 6)
-                ann["image_id"] = new_image_id
-                new_id = str(next(id_generator))
-                new_id = name_id(new_id, 8)
-                ann["id"] = new_id
-                new_annotations["annotations"].append(ann)
-                annotations_list_subset.remove(ann) # per efficienza
-            self.processed_images_so_far["images_so_far"].append(step)
+            annot = []
+            for ann in old_id2annotations.get(image_id, []):
+                new_ann = dict(ann)
+                new_ann["image_id"] = new_image_id
+                new_ann["id"] = name_id(str(num_annotations), 8) # the annotation ids only depend on how many annotations have been written (stable across resumes)
+                num_annotations += 1
+                annot.append(new_ann)
+            shard_file.write(json.dumps({"image" : d, "annotations" : annot}) + "\n")
             #--------------------------------------------------------------------------#
-            if step % 500 == 0: # save the processed images each 500 iterations
-                f = open("/content/drive/MyDrive/VISIOPE/Project/data/processed_images_so_far.json", "w")
-                json.dump(self.processed_images_so_far, f)
-                f.close()
-                f = open("/content/drive/MyDrive/VISIOPE/Project/data/labels/COCO/annotations.json", "w")
-                json.dump(new_annotations, f)
-                f.close()
+            if step % shard_size == 0: # the shard is complete
+                shard_file.close()
+                os.replace(shard_path + ".tmp", shard_path)
+                shard_file = None
+                shard_idx += 1
+        if shard_file is not None:
+            shard_file.close()
+            os.replace(shard_path + ".tmp", shard_path)
         print("Done!")
         
+        print("Merging the shards...")
+        if os.path.exists(annotations_path):
+            new_annotations = json.load(open(annotations_path))
+        else:
+            new_annotations = {"categories" : [{"name" : "vehicle", "id" : 0}, {"name" : "person", "id" : 1}, {"name" : "motorbike", "id" : 2}]}
+        new_annotations["images"] = []
+        new_annotations["annotations"] = []
+        for shard in sorted(f for f in os.listdir(shards_dir) if f.endswith(".jsonl")):
+            with open(os.path.join(shards_dir, shard)) as f:
+                for line in f:
+                    record = json.loads(line)
+                    new_annotations["images"].append(record["image"])
+                    new_annotations["annotations"].extend(record["annotations"])
+        
         # number of annotations
         print("Total number of annotations: " + str(len(new_annotations["annotations"])))
         
         print("Writing the 'annotations.json' file...")
-        f = open("/content/drive/MyDrive/VISIOPE/Project/data/labels/COCO/annotations.json", "w")
-        json.dump(new_annotations, f)
-        f.close()
+        with open(annotations_path + ".tmp", "w") as f:
+            json.dump(new_annotations, f)
+        os.replace(annotations_path + ".tmp", annotations_path)
         print("Done!")
         
-    def save_images(self):
+    def save_images(self, images_dir=IMAGES_DIR, manifest_path=MANIFEST_PATH,
+                    size=(1280, 720), img_format="jpeg", quality=95, num_workers=None, max_in_flight=None, draft=False):
+        """
+        Parallel and resumable export of the selected images.
+        Parameters:
+            images_dir (str): output folder
+            manifest_path (str): append-only file with one line for each image already saved ("checkpoint logic")
+            size (tuple): (width, height) of the saved images --> use (img_size, img_size) to write them directly at the training size
+                          (the annotations are always expressed w.r.t. 1280x720, so the labels don't change)
+            img_format (str): "jpeg", "png" or "webp"
+            quality (int): encoder quality (ignored for "png")
+            num_workers (int): number of processes of the pool (all the cpus by default)
+            max_in_flight (int): maximum number of images submitted to the pool and not yet saved (it bounds the memory usage)
+            draft (bool): the source JPEGs are decoded directly near 'size' (only useful when 'size' is at most half of the source)
+        """
         
         # # first of all, we delete the previous images inside the folder
         # print("Deleting the previous images...")
@@ -155,21 +285,52 @@ class ExtractionToolkit:
         #     os.remove(f)
         # print("Done!")
         
-        saved_images_so_far = os.listdir("/content/drive/MyDrive/VISIOPE/Project/data/images")
-        saved_images_so_far = sorted( saved_images_so_far, key=lambda x: int(x.split("_")[0]) )
-        last_saved_image = saved_images_so_far[-1]
-        step = int(last_saved_image.split("_")[0])
-        self.images_list = self.images_list[step:]
+        pil_format, extension = IMAGE_FORMATS[img_format]
+        num_workers = num_workers if num_workers is not None else os.cpu_count()
+        max_in_flight = max_in_flight if max_in_flight is not None else 4*num_workers
+        os.makedirs(images_dir, exist_ok=True)
         
-        print("Saving the new images to 'data/images'...")
-        for file_name in tqdm(self.images_list):
-            step+= 1 
+        # which images have already been saved? We only trust COMPLETE lines of the manifest
+        # (a crash while appending can leave the last line truncated)
+        if not os.path.exists(manifest_path):
+            # first run with the manifest: we bootstrap it from the images already present in the folder (only once)
+            with open(manifest_path, "w") as manifest:
+                for name in os.listdir(images_dir):
+                    if name.endswith(extension):
+                        manifest.write(name + "\n")
+        saved_images_so_far = set()
+        with open(manifest_path) as manifest:
+            for line in manifest:
+                if line.endswith("\n"):
+                    saved_images_so_far.add(line[:-1])
+        
+        jobs = []
+        for step, file_name in enumerate(self.images_list, start=1):
             id = self.img2id[file_name]
             name = name_id(id, 6)
-            name = str(step) + '_' + name + '.jpg'
-            
-            im = Image.open(file_name)
-            resized_im = im.resize((1280, 720))
-            final_im = resized_im.convert("RGB")
-            final_im.save('/content/drive/MyDrive/VISIOPE/Project/data/images/'+ name)
-        print("Done!")
\ No newline at end of file
+            name = str(step) + '_' + name + extension
+            if name not in saved_images_so_far:
+                jobs.append((file_name, name))
+        print("{} images already saved, {} left".format(len(self.images_list)-len(jobs), len(jobs)))
+        
+        print("Saving the new images to '{}'...".format(images_dir))
+        with open(manifest_path, "a") as manifest, ProcessPoolExecutor(max_workers=num_workers) as pool, tqdm(total=len(jobs)) as pbar:
+            in_flight = {}
+            jobs = iter(jobs)
+            while True:
+                # we keep at most 'max_in_flight' images inside the pool
+                for file_name, name in jobs:
+                    future = pool.submit(export_image, file_name, os.path.join(images_dir, name), size, pil_format, quality, draft)
+                    in_flight[future] = name
+                    if len(in_flight) >= max_in_flight:
+                        break
+                if len(in_flight) == 0:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = in_flight.pop(future)
+                    future.result() # errors of the workers are raised here
+                    manifest.write(name + "\n")
+                    pbar.update(1)
+                manifest.flush()
+        print("Done!")
@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import sqlite3
+from collections.abc import Mapping
+from tqdm import tqdm
+
+# the three COCO sources (name --> root folder), a new source is added here with the same layout
+# (<root>/labels/COCO/annotations.json and <root>/images/videos/<file_name>)
+SOURCES = {"waymo" : "/content/drive/MyDrive/VISIOPE/Project/datasets/Waymo",
+           "bdd100k" : "/content/drive/MyDrive/VISIOPE/Project/datasets/BDD100K",
+           "argoverse" : "/content/drive/MyDrive/VISIOPE/Project/datasets/Argoverse"}
+
+# frames kept from each video by 'extract_images' (see the commented code there): (offsets kept, every how many frames)
+FRAME_STRIDES = {"waymo" : ((0, 1, 2), 9), "bdd100k" : ((0,), 3), "argoverse" : ((0,), 6)}
+
+def source_annotations(root):
+    return os.path.join(root, "labels", "COCO", "annotations.json")
+
+class _Table(Mapping):
+    # read-only dict view over one column of the store (same lookups of the old JSON lookup tables)
+    def __init__(self, store, key, value):
+        self.store, self.key, self.value = store, key, value
+
+    def __getitem__(self, k):
+        row = self.store.db.execute(f"SELECT {self.value} FROM images WHERE {self.key} = ?", (k,)).fetchone()
+        if row is None and isinstance(k, str) and k.isdigit(): # the keys of the old JSON tables were always strings
+            row = self.store.db.execute(f"SELECT {self.value} FROM images WHERE {self.key} = ?", (int(k),)).fetchone()
+        if row is None:
+            raise KeyError(k)
+        return str(row[0]) if self.value == "id" else row[0]
+
+    def __iter__(self):
+        return (row[0] for row in self.store.db.execute(f"SELECT {self.key} FROM images ORDER BY id"))
+
+    def __len__(self):
+        return self.store.num_images()
+
+class LookupStore:
+    """
+    On-disk (SQLite) version of the three lookup tables of 'lookup_tables_create': each image of the sources has a row
+    (id, file_image, old_id, dataset), so 'img2id', 'img2oldID' and 'oldID2id' are views over the same table.
+    The ids are stable: a new frame always takes the next free id and the existing rows are never renumbered, so adding
+    a video only appends rows (and only the sources whose annotations file changed are loaded again).
+    """
+    def __init__(self, path="/content/drive/MyDrive/VISIOPE/Project/data/lookup_tables/lookup.sqlite"):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path)
+        # 'old_id' has no type: the ids of the sources keep their original (int) type
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS images (id INTEGER PRIMARY KEY, file_image TEXT UNIQUE NOT NULL, old_id UNIQUE NOT NULL,
+                                               dataset TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS sources (name TEXT PRIMARY KEY, mtime REAL, size INTEGER, num_images INTEGER, load_seconds REAL);
+        """)
+        self.img2id = _Table(self, "file_image", "id")
+        self.img2oldID = _Table(self, "file_image", "old_id")
+        self.oldID2id = _Table(self, "old_id", "id")
+
+    def close(self):
+        self.db.close()
+
+    def num_images(self):
+        return self.db.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def next_id(self):
+        return self.db.execute("SELECT COALESCE(MAX(id) + 1, 0) FROM images").fetchone()[0]
+
+    def add_images(self, images, root):
+        """
+        Appends the COCO 'images' of a source which are not in the store yet (with the next free ids, in their order).
+        Returns:
+            list: the file paths of the new images
+        """
+        next_id = self.next_id()
+        known = {row[0] for row in self.db.execute("SELECT old_id FROM images")}
+        rows = []
+        for im in images:
+            if im["id"] in known:
+                continue
+            rows.append((next_id, root + "/images/videos/" + im["file_name"], im["id"], im["dataset"]))
+            next_id += 1
+        with self.db:
+            self.db.executemany("INSERT INTO images (id, file_image, old_id, dataset) VALUES (?, ?, ?, ?)", rows)
+        return [row[1] for row in rows]
+
+    def update(self, sources=SOURCES, force=False):
+        """
+        Incremental build: only the sources whose annotations file is new or changed (size/mtime) are loaded, and only
+        their new images are added.
+        Returns:
+            dict: source name --> (list of the new file paths, seconds spent on it)
+        """
+        delta = {}
+        for name, root in sources.items():
+            path = source_annotations(root)
+            stat = os.stat(path)
+            row = self.db.execute("SELECT mtime, size FROM sources WHERE name = ?", (name,)).fetchone()
+            if not force and row is not None and tuple(row) == (stat.st_mtime, stat.st_size):
+                print(f"{name}: unchanged, skipped")
+                continue
+            start = time.perf_counter()
+            # a plain json load is enough (we don't need the indexes built by pycocotools)
+            images = json.load(open(path))["images"]
+            new_images = self.add_images(images, root)
+            seconds = time.perf_counter() - start
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?)", (name, stat.st_mtime, stat.st_size, len(images), seconds))
+            delta[name] = (new_images, seconds)
+            print(f"{name}: {len(new_images)} new images ({seconds:.1f} s)")
+        return delta
+
+    def import_json_tables(self, img2id, img2oldID):
+        # seeds an empty store with the JSON lookup tables of a previous full build (so the exported dataset keeps its ids)
+        assert self.num_images() == 0, "The store is not empty!"
+        datasets = {root : name for name, root in SOURCES.items()}
+        rows = []
+        for file_image, id in tqdm(img2id.items()):
+            root = file_image.split("/images/videos/")[0]
+            rows.append((int(id), file_image, img2oldID[file_image], datasets.get(root, root)))
+        with self.db:
+            self.db.executemany("INSERT INTO images (id, file_image, old_id, dataset) VALUES (?, ?, ?, ?)", rows)
+
+    def datasets_of(self, old_ids):
+        # source names of the images with these old ids (to load only the sources that are needed)
+        names = set()
+        for old_id in old_ids:
+            row = self.db.execute("SELECT dataset FROM images WHERE old_id = ?", (old_id,)).fetchone()
+            if row is not None:
+                names.add(row[0])
+        return names
+
+    def source_load_seconds(self):
+        # the last measured loading time of every source (the cost of a full rebuild of the tables)
+        return {name : seconds for name, seconds in self.db.execute("SELECT name, load_seconds FROM sources")}
+
+def select_frames(file_images):
+    # the same frame selection of 'extract_images', applied to the new frames of each video
+    videos = {}
+    for f in file_images:
+        videos.setdefault(os.path.dirname(f), []).append(f)
+    roots = {root : name for name, root in SOURCES.items()}
+    selected = []
+    for video_folder, frames in videos.items():
+        offsets, stride = FRAME_STRIDES.get(roots.get(video_folder.split("/images/videos/")[0]), ((0,), 1))
+        frames = sorted(frames)
+        for i in range(0, len(frames), stride):
+            selected += [frames[i + o] for o in offsets if i + o < len(frames)]
+    return selected
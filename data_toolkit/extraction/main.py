@@ -1,7 +1,12 @@
 import os
 import json
+import time
+import random
+import argparse
 from pathlib import Path
 from extract import ExtractionToolkit
+from lookup_store import LookupStore, select_frames
+from dedup import dedup_frames, dedup_report
 from pycocotools.coco import COCO
 from tqdm import tqdm
 
@@ -65,8 +70,69 @@ def lookup_tables_create():
 
   return img2id, img2oldID, oldID2id
 
+def incremental_build(store_path="/content/drive/MyDrive/VISIOPE/Project/data/lookup_tables/lookup.sqlite",
+                      report_path="/content/drive/MyDrive/VISIOPE/Project/data/incremental_build_report.json", dedup=False):
+  """
+  Incremental build: the lookup tables live in a LookupStore (SQLite) and only the new frames of the new/changed sources
+  are added, selected, labelled and exported. The time of each phase is compared with the (estimated) one of a full rebuild.
+  """
+  store = LookupStore(store_path)
+  if store.num_images() == 0 and Path("/content/drive/MyDrive/VISIOPE/Project/data/lookup_tables/img2id.json").is_file():
+    # the first incremental build starts from the JSON tables of the last full build (same ids of the exported images)
+    print("Importing the JSON lookup tables...")
+    store.import_json_tables(json.load(open("/content/drive/MyDrive/VISIOPE/Project/data/lookup_tables/img2id.json")),
+                             json.load(open("/content/drive/MyDrive/VISIOPE/Project/data/lookup_tables/img2oldID.json")))
+  
+  print("Updating the lookup store...")
+  start = time.perf_counter()
+  delta = store.update()
+  tables_seconds = time.perf_counter() - start
+  new_frames = [f for new_images, _ in delta.values() for f in new_images]
+  if dedup: # perceptual-hash selection of the new frames (see dedup.py)
+    selected, rows = dedup_frames(new_frames)
+    dedup_report(rows)
+  else:
+    selected = select_frames(new_frames)
+  random.shuffle(selected) # like the original 'images_list'
+  
+  toolkit = ExtractionToolkit(img2id=store.img2id, img2oldID=store.img2oldID, oldID2id=store.oldID2id, store=store)
+  selected = toolkit.append_images(selected)
+  toolkit.extract_images()
+  print("{} new frames, {} selected (now the images are {})".format(len(new_frames), len(selected), len(toolkit.images_list)))
+  start = time.perf_counter()
+  toolkit.extract_labels()
+  labels_seconds = time.perf_counter() - start
+  start = time.perf_counter()
+  toolkit.save_images()
+  images_seconds = time.perf_counter() - start
+  
+  # a full rebuild loads every source (last measured loading times) and processes every selected image: we extrapolate
+  # the time per image of this run (the labels also include the final merge, so that estimate is pessimistic for us)
+  num_delta, num_total = max(len(selected), 1), len(toolkit.images_list)
+  rows = [{"phase" : "lookup tables", "incremental_s" : tables_seconds, "full_rebuild_s" : sum(store.source_load_seconds().values())},
+          {"phase" : "labels", "incremental_s" : labels_seconds, "full_rebuild_s" : labels_seconds / num_delta * num_total},
+          {"phase" : "images", "incremental_s" : images_seconds, "full_rebuild_s" : images_seconds / num_delta * num_total}]
+  rows.append({"phase" : "total", "incremental_s" : sum(r["incremental_s"] for r in rows), "full_rebuild_s" : sum(r["full_rebuild_s"] for r in rows)})
+  print("{:<15}{:>16}{:>18}{:>14}".format("phase", "incremental (s)", "full rebuild (s)", "saved (s)"))
+  for r in rows:
+    r["saved_s"] = r["full_rebuild_s"] - r["incremental_s"]
+    print("{:<15}{:>16.1f}{:>18.1f}{:>14.1f}".format(r["phase"], r["incremental_s"], r["full_rebuild_s"], r["saved_s"]))
+  report = {"new_frames" : len(new_frames), "selected_frames" : len(selected), "total_images" : num_total,
+            "new_per_source" : {name : len(new_images) for name, (new_images, _) in delta.items()}, "phases" : rows}
+  json.dump(report, open(report_path, "w"), indent=2)
+  store.close()
+  return report
+
 if __name__=="__main__":
     
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--incremental", action="store_true", help="only add the new frames (lookup tables in a SQLite store)")
+    parser.add_argument("--dedup", action="store_true", help="select the frames by perceptual hashing instead of the fixed stride")
+    args = parser.parse_args()
+    if args.incremental:
+        incremental_build(dedup=args.dedup)
+        exit()
+    
     img2id = None
     img2oldID = None
     oldID2id = None
@@ -86,6 +152,10 @@ if __name__=="__main__":
         print("Done!")
     
     toolkit = ExtractionToolkit(img2id=img2id, img2oldID=img2oldID, oldID2id=oldID2id)
+    if args.dedup: # a new 'images_list.json' selected by perceptual hashing (the previous labels and images are moved aside)
+        toolkit.select_images(dedup=True)
     toolkit.extract_images()
     #toolkit.extract_labels()
+    if args.dedup: # the labels of the new selection
+        toolkit.extract_labels()
     toolkit.save_images()
\ No newline at end of file
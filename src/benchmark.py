@@ -0,0 +1,775 @@
+import os
+import sys
+import time
+import copy
+import json
+import itertools
+import subprocess
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, Subset
+from .model import URBE_Perception
+from .inference import BACKBONES, NECKS, HEADS, YOLOV5_FAMILY, family_hparams, ANCHORS, STRIDE
+from .loss import YOLO_Loss
+
+# how to correctly compute inference time (therefore fps) for a model
+# https://towardsdatascience.com/the-correct-way-to-measure-inference-time-of-deep-neural-networks-304a54e5187f
+def measure_latency(model, img_input, repetitions=100, warmup=10):
+    """
+    Parameters:
+        model (callable): the model (or any callable) we want to time
+        img_input (tensor): the batch of images fed to the model
+        repetitions (int): number of timed forward passes
+        warmup (int): number of untimed forward passes done before measuring
+    Returns:
+        dict: mean/std/p50/p90 latency in milliseconds and the corresponding fps
+    """
+    use_cuda = img_input.is_cuda
+    timings = np.zeros((repetitions, 1))
+    with torch.no_grad():
+        # WARM-UP
+        for _ in range(warmup):
+            _ = model(img_input)
+        # MEASURE PERFORMANCE
+        for rep in range(repetitions):
+            if use_cuda:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            _ = model(img_input)
+            if use_cuda: # WAIT FOR GPU SYNC
+                torch.cuda.synchronize()
+            timings[rep] = (time.perf_counter() - start) * 1000
+    mean_syn = float(np.mean(timings))
+    return {"mean_ms": mean_syn, "std_ms": float(np.std(timings)), "p50_ms": float(np.percentile(timings, 50)),
+            "p90_ms": float(np.percentile(timings, 90)), "fps": 1 / (mean_syn/1000)}
+
+def print_table(rows, columns):
+    # simple fixed-width table (rows is a list of dicts)
+    widths = [max(len(c), *[len(f"{r[c]:.3f}" if isinstance(r[c], float) else str(r[c])) for r in rows]) for c in columns]
+    print(" | ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    print("-+-".join("-"*w for w in widths))
+    for r in rows:
+        print(" | ".join((f"{r[c]:.3f}" if isinstance(r[c], float) else str(r[c])).ljust(w) for c, w in zip(columns, widths)))
+
+def benchmark_compile_modes(hparams, modes=("eager", "script", "compile"), batch_size=1, repetitions=50, device="cpu"):
+    """
+    Steady-state latency of the eager forward against the graph-captured ones (see URBE_Perception.compile_network).
+    The warm-up passes are excluded from the timings, so we only compare the steady state.
+    Parameters:
+        hparams (dict): hyperparameters used to build the model
+        modes (tuple): compile modes to compare (the first one is the baseline of the speedups)
+    Returns:
+        list: one row (dict) for each mode
+    """
+    hparams = copy.deepcopy(hparams)
+    hparams["load_pretrained"] = False
+    hparams["compile_mode"] = None # the modes of the rows are always explicit
+    img_input = torch.rand((batch_size, hparams["img_channels"], hparams["img_size"], hparams["img_size"]), device=device)
+    rows = []
+    for mode in modes:
+        torch.manual_seed(0)
+        model = URBE_Perception(hparams).to(device)
+        start = time.perf_counter()
+        model.compile_network(mode=mode if mode is not None else "eager", example_input=img_input) # None would fall back to 'hparams.compile_mode'
+        compile_time = time.perf_counter() - start
+        ris = measure_latency(model, img_input, repetitions=repetitions)
+        rows.append({"mode": str(mode), "compile_s": compile_time, **ris})
+    eager = rows[0]["mean_ms"]
+    for r in rows:
+        r["speedup"] = eager / r["mean_ms"]
+    print_table(rows, ["mode", "compile_s", "mean_ms", "p50_ms", "p90_ms", "fps", "speedup"])
+    return rows
+
+def count_flops(model, img_input):
+    """ Counts the FLOPs (2 * multiply-accumulates) of the convolutions of one forward pass through forward hooks. """
+    flops = [0]
+    def hook(module, inputs, output):
+        kh, kw = module.kernel_size
+        flops[0] += 2 * output.numel() * (module.in_channels // module.groups) * kh * kw
+    handles = [m.register_forward_hook(hook) for m in model.modules() if isinstance(m, torch.nn.Conv2d)]
+    with torch.no_grad():
+        _ = model(img_input)
+    for h in handles:
+        h.remove()
+    return flops[0]
+
+def benchmark_architectures(hparams, backbones=None, necks=None, heads=None, batch_size=1, repetitions=30, device="cpu"):
+    """
+    Latency, GFLOPs and number of parameters for every backbone/neck/head combination of the registry
+    (by default all of them, see 'BACKBONES', 'NECKS' and 'HEADS' in model.py).
+    Returns:
+        list: one row (dict) for each combination, sorted by latency
+    """
+    backbones = backbones if backbones is not None else list(BACKBONES.keys())
+    necks = necks if necks is not None else list(NECKS.keys())
+    heads = heads if heads is not None else list(HEADS.keys())
+    img_input = torch.rand((batch_size, hparams["img_channels"], hparams["img_size"], hparams["img_size"]), device=device)
+    rows = []
+    for backbone in backbones:
+        for neck in necks:
+            for head in heads:
+                h = {**copy.deepcopy(hparams), "backbone": backbone, "neck": neck, "head": head, "load_pretrained": False}
+                try:
+                    model = URBE_Perception(h).to(device).eval()
+                except AssertionError as e: # e.g. a neck which can't be attached to the backbone
+                    print(f"skipping {backbone}/{neck}/{head}: {e}")
+                    continue
+                ris = measure_latency(model, img_input, repetitions=repetitions)
+                rows.append({"backbone": backbone, "neck": neck, "head": head, "mean_ms": ris["mean_ms"], "fps": ris["fps"],
+                             "gflops": count_flops(model, img_input) / 1e9 / batch_size,
+                             "params_M": sum(p.numel() for p in model.parameters()) / 1e6})
+    rows = sorted(rows, key=lambda r: r["mean_ms"])
+    print_table(rows, ["backbone", "neck", "head", "mean_ms", "fps", "gflops", "params_M"])
+    return rows
+
+def evaluate_map(model, dataloader, device, fp16=False, max_batches=None):
+    """
+    mAP of the model over a dataloader (same procedure of 'evaluate_performance' of the notebook, but the metric is computed only once at the end).
+    Returns:
+        dict: {"map_50" : ..., "map" : ...}
+    """
+    from torchmetrics.detection.mean_ap import MeanAveragePrecision
+    model.eval()
+    mAP = MeanAveragePrecision() # in this way the IoU thresholds are taken from the stepped range [0.5,...,0.95] with step 0.05
+    with torch.no_grad():
+        for i, batch in enumerate(dataloader):
+            if max_batches is not None and i == max_batches:
+                break
+            imgs = batch["img"].to(device)
+            if fp16:
+                imgs = imgs.half()
+            out = model(imgs)
+            targets = [YOLO_Loss.transform_targets(out, bboxes, torch.tensor(URBE_Perception.ANCHORS), URBE_Perception.STRIDE) for bboxes in batch["labels"]]
+            # I want targets to be the same shape as predictions --> (bs, 3 , 80/40/20, 80/40/20, 6)
+            targets = [torch.stack([target[s] for target in targets], dim=0).to(device, non_blocking=True) for s in range(3)]
+            pred_boxes = model.cells_to_bboxes(out, model.head.anchors, model.head.stride, device, is_pred=True)
+            true_boxes = model.cells_to_bboxes(targets, model.head.anchors, model.head.stride, device, is_pred=False)
+            _, _, pred_boxes = model.non_max_suppression(pred_boxes, iou_threshold=model.hparams.nms_iou_thresh, threshold=model.hparams.conf_threshold, max_detections=50, is_pred=True, filenames=batch["file_name"])
+            true_boxes = model.non_max_suppression(true_boxes, iou_threshold=model.hparams.nms_iou_thresh, threshold=model.hparams.conf_threshold, max_detections=50, is_pred=False)
+            pred_dict_list = []
+            for b in range(len(pred_boxes)):
+                if pred_boxes[b].numel() == 0: # if the model hasn't predict any bboxes
+                    pred_dict_list.append( dict(boxes=torch.tensor([]).to(device), scores=torch.tensor([]).to(device), labels=torch.tensor([]).to(device),) )
+                else:
+                    pred_dict_list.append( dict(boxes=pred_boxes[b][..., 2:].float(), scores=pred_boxes[b][..., 1].float(), labels=pred_boxes[b][..., 0],) )
+            true_dict_list = [ dict(boxes=true_boxes[i][..., 2:].float(), labels=true_boxes[i][..., 0],) for i in range(len(true_boxes)) ]
+            mAP.update(pred_dict_list, true_dict_list)
+    ris = mAP.compute()
+    return {"map_50" : float(ris["map_50"]), "map" : float(ris["map"])}
+
+def benchmark_model_zoo(hparams, sizes=tuple(YOLOV5_FAMILY.keys()), checkpoints=None, data=None, batch_size=1, repetitions=30, device="cpu", output_file=None):
+    """
+    Model-zoo of the YOLOv5 n/s/m/l/x-style variants (see 'depth_multiple' and 'width_multiple'): latency, GFLOPs and parameters of each of them.
+    Parameters:
+        checkpoints (dict): size --> checkpoint of the trained variant. For these variants we also compute the mAP on the test set of 'data'
+        data (URBE_DataModule): datamodule (already set up) for the mAP computation
+        output_file (str): if given, the table is also saved as json (to compare latency versus mAP among runs)
+    """
+    checkpoints = checkpoints if checkpoints is not None else {}
+    img_input = torch.rand((batch_size, hparams["img_channels"], hparams["img_size"], hparams["img_size"]), device=device)
+    rows = []
+    for size in sizes:
+        h = {**copy.deepcopy(hparams), **family_hparams(size), "backbone": "yolov5", "neck": "yolov5", "load_pretrained": False}
+        if size in checkpoints:
+            model = URBE_Perception.load_from_checkpoint(checkpoints[size], strict=False).to(device).eval()
+        else:
+            model = URBE_Perception(h).to(device).eval()
+        ris = measure_latency(model, img_input, repetitions=repetitions)
+        # the scaling of a checkpoint is the one it was trained with (e.g. None for our legacy models), not the one of the preset
+        scaling = model.hparams if size in checkpoints else h
+        row = {"size": size, "depth_multiple": scaling["depth_multiple"], "width_multiple": scaling["width_multiple"], "mean_ms": ris["mean_ms"], "fps": ris["fps"],
+               "gflops": count_flops(model, img_input) / 1e9 / batch_size, "params_M": sum(p.numel() for p in model.parameters()) / 1e6,
+               "map_50": float("nan")}
+        if size in checkpoints and data is not None:
+            row["map_50"] = evaluate_map(model, data.test_dataloader(), device)["map_50"]
+        rows.append(row)
+    print_table(rows, ["size", "depth_multiple", "width_multiple", "mean_ms", "fps", "gflops", "params_M", "map_50"])
+    if output_file is not None:
+        json.dump(rows, open(output_file, "w"), indent=4)
+    return rows
+
+def benchmark_import_time(modules=("src.inference", "src.model"), repetitions=5):
+    """
+    Cold-start import time of the inference package against the full Lightning module: every import runs in a
+    fresh interpreter (from the root of the repository), so nothing is already cached in 'sys.modules'.
+    Returns:
+        list: one row (dict) for each module
+    """
+    code = "import time; start = time.perf_counter(); import {}; print(time.perf_counter() - start)"
+    rows = []
+    for module in modules:
+        timings = [float(subprocess.run([sys.executable, "-c", code.format(module)], capture_output=True, text=True, check=True).stdout) * 1000
+                   for _ in range(repetitions)]
+        rows.append({"module": module, "mean_ms": float(np.mean(timings)), "min_ms": float(np.min(timings)), "max_ms": float(np.max(timings))})
+    for r in rows:
+        r["speedup"] = rows[-1]["mean_ms"] / r["mean_ms"]
+    print_table(rows, ["module", "mean_ms", "min_ms", "max_ms", "speedup"])
+    return rows
+
+CHECKPOINTING_SETTINGS = ((), ("head",), ("neck",), ("backbone", "sppf"), ("backbone", "sppf", "neck"), ("backbone", "sppf", "neck", "head"))
+
+def benchmark_checkpointing(hparams, settings=CHECKPOINTING_SETTINGS, batch_size=4, steps=5, device="cpu"):
+    """
+    Memory/throughput trade-off of the activation checkpointing (see URBE_Detector.set_checkpointing) for a training step
+    (forward + backward). The activation memory is the size of the tensors saved for the backward pass, so it is measured
+    in the same way on CPU and GPU (on GPU we also report the peak of allocated memory).
+    'batch_gain' is how many times larger the batch can be with the same activation memory of the first setting.
+    Parity: after the first training step (BatchNorm in train mode) 'bn_stats_diff' and 'grad_diff' are the largest absolute
+    differences of the BN running statistics and of the gradients from the first setting (they should be ~0: the recomputation
+    doesn't update the running statistics twice, see 'bn_safe_checkpoint').
+    Returns:
+        list: one row (dict) for each setting
+    """
+    img_input = torch.rand((batch_size, hparams["img_channels"], hparams["img_size"], hparams["img_size"]), device=device)
+    rows = []
+    reference = None
+    for stages in settings:
+        torch.manual_seed(0)
+        model = URBE_Perception({**copy.deepcopy(hparams), "checkpointing": tuple(stages)}).to(device).train()
+        # we count the bytes of every tensor saved for the backward pass (the checkpointed blocks only save their input)
+        saved_bytes = [0]
+        def pack(tensor):
+            saved_bytes[0] += tensor.numel() * tensor.element_size()
+            return tensor
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            out = model(img_input)
+        activation_mb = saved_bytes[0] / 2**20
+        sum(o.float().pow(2).mean() for o in out).backward() # a dummy loss is enough to exercise the backward pass
+        bn_stats = {k : v.detach().double() for k, v in model.named_buffers() if "running_" in k or "num_batches_tracked" in k}
+        grads = {k : p.grad.detach().double() for k, p in model.named_parameters() if p.grad is not None}
+        reference = reference if reference is not None else (bn_stats, grads)
+        bn_stats_diff = max((bn_stats[k] - reference[0][k]).abs().max().item() for k in bn_stats)
+        grad_diff = max((grads[k] - reference[1][k]).abs().max().item() for k in grads)
+        model.zero_grad(set_to_none=True)
+
+        if device != "cpu":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        start = time.perf_counter()
+        for _ in range(steps):
+            out = model(img_input)
+            sum(o.float().pow(2).mean() for o in out).backward()
+            model.zero_grad(set_to_none=True)
+        if device != "cpu":
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+        rows.append({"stages": "+".join(stages) if len(stages) > 0 else "none", "activation_MB": activation_mb,
+                     "peak_MB": torch.cuda.max_memory_allocated() / 2**20 if device != "cpu" else float("nan"),
+                     "imgs_per_s": steps * batch_size / elapsed, "bn_stats_diff": bn_stats_diff, "grad_diff": grad_diff})
+    for r in rows:
+        r["batch_gain"] = rows[0]["activation_MB"] / r["activation_MB"]
+        r["throughput"] = r["imgs_per_s"] / rows[0]["imgs_per_s"]
+    print_table(rows, ["stages", "activation_MB", "peak_MB", "imgs_per_s", "batch_gain", "throughput", "bn_stats_diff", "grad_diff"])
+    return rows
+
+def random_labels(batch_size, max_objects, num_classes):
+    # (bs, max_objects, 5) labels like the ones of 'URBE_DataModule.collate' (a random number of boxes + zero padding)
+    labels = torch.zeros((batch_size, max_objects, 5))
+    for b in range(batch_size):
+        n = int(torch.randint(1, max_objects + 1, (1,)))
+        wh = torch.rand((n, 2)) * 0.3 + 0.01
+        xy = wh / 2 + torch.rand((n, 2)) * (1 - wh)
+        labels[b, :n] = torch.cat([torch.randint(0, num_classes, (n, 1)).float(), xy, wh], dim=1)
+    return labels
+
+def benchmark_fused_loss(hparams, batch_size=16, max_objects=20, repetitions=20, device="cpu"):
+    """
+    Parity and speed of the fused loss (see YOLO_Loss.fused_loss) against the per-scale one on random predictions/labels.
+    The target assignments are cached after the first call, so we only time the loss computation itself.
+    Returns:
+        dict: the two loss values, their relative difference and the mean time (ms) of forward + backward of both
+    """
+    torch.manual_seed(0)
+    anchors = torch.tensor(ANCHORS).float().view(3, -1, 2) / torch.tensor(STRIDE).repeat(6, 1).T.reshape(3, 3, 2)
+    grids = [hparams["img_size"] // stride for stride in STRIDE]
+    preds = [torch.randn((batch_size, 3, g, g, 5 + hparams["num_classes"]), device=device) for g in grids]
+    labels = random_labels(batch_size, max_objects, hparams["num_classes"])
+    ids = list(range(batch_size))
+    ris = {}
+    for name, fused in (("loop", False), ("fused", True)):
+        loss_fn = YOLO_Loss({**hparams, "fused_loss": fused, "target_cache": True, "augmentation": False}, anchors, STRIDE, 3)
+        p = [t.clone().requires_grad_(True) for t in preds]
+        loss = loss_fn(p, labels, ids) # it also fills the target cache
+        ris[f"{name}_loss"] = loss.item()
+        timings = []
+        for _ in range(repetitions):
+            p = [t.clone().requires_grad_(True) for t in preds]
+            if device != "cpu":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            loss_fn(p, labels, ids).backward()
+            if device != "cpu":
+                torch.cuda.synchronize()
+            timings.append((time.perf_counter() - start) * 1000)
+        ris[f"{name}_ms"] = float(np.mean(timings))
+    ris["rel_diff"] = abs(ris["fused_loss"] - ris["loop_loss"]) / abs(ris["loop_loss"])
+    ris["speedup"] = ris["loop_ms"] / ris["fused_ms"]
+    print_table([ris], list(ris.keys()))
+    return ris
+
+def timeit(fn, repetitions):
+    # mean time (ms) of 'fn' after one warm-up call
+    fn()
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        fn()
+    return (time.perf_counter() - start) / repetitions * 1000
+
+def legacy_giou(boxes_preds, boxes_labels, eps=1e-7):
+    # the GIoU of 'intersection_over_union' before 'inference/box_ops.py' (sliced columns, "yolo" format), kept as reference
+    box1_x1, box1_x2 = boxes_preds[..., 0:1] - boxes_preds[..., 2:3]/2, boxes_preds[..., 0:1] + boxes_preds[..., 2:3]/2
+    box1_y1, box1_y2 = boxes_preds[..., 1:2] - boxes_preds[..., 3:4]/2, boxes_preds[..., 1:2] + boxes_preds[..., 3:4]/2
+    box2_x1, box2_x2 = boxes_labels[..., 0:1] - boxes_labels[..., 2:3]/2, boxes_labels[..., 0:1] + boxes_labels[..., 2:3]/2
+    box2_y1, box2_y2 = boxes_labels[..., 1:2] - boxes_labels[..., 3:4]/2, boxes_labels[..., 1:2] + boxes_labels[..., 3:4]/2
+    w1, h1, w2, h2 = box1_x2 - box1_x1, box1_y2 - box1_y1, box2_x2 - box2_x1, box2_y2 - box2_y1
+    inter = (torch.min(box1_x2, box2_x2) - torch.max(box1_x1, box2_x1)).clamp(0) * \
+            (torch.min(box1_y2, box2_y2) - torch.max(box1_y1, box2_y1)).clamp(0)
+    union = (w1 * h1) + (w2 * h2) - inter + eps
+    iou = inter / union
+    cw = torch.max(box1_x2, box2_x2) - torch.min(box1_x1, box2_x1)
+    ch = torch.max(box1_y2, box2_y2) - torch.min(box1_y1, box2_y1)
+    c_area = cw * ch + eps
+    return iou - (c_area - union) / c_area
+
+def legacy_xywh_to_xyxy(boxes):
+    # the conversion of 'non_max_suppression' before 'inference/box_ops.py' (column by column writes)
+    w = boxes[..., 4:5]
+    h = boxes[..., 5:6]
+    boxes[..., 2:3] = boxes[..., 2:3] - (w/2)
+    boxes[..., 3:4] = boxes[..., 3:4] - (h/2)
+    boxes[..., 4:5] = boxes[..., 2:3] + w
+    boxes[..., 5:6] = boxes[..., 3:4] + h
+    return boxes
+
+def benchmark_box_ops(num_boxes=4096, num_gt=64, batch_size=8, repetitions=50, device="cpu"):
+    """
+    Parity and speed of 'inference/box_ops.py' against the implementations it replaced:
+        - loss: GIoU of the positive predictions (forward + backward), old sliced version vs 'box_iou'
+        - NMS: (xc, yc, w, h) --> (x1, y1, x2, y2) of the cells above the threshold, column writes vs 'to_corners_'
+        - visualization: per-box python conversion of the notebook ('draw_bbox') vs 'box_convert' + 'scale_boxes_'
+        - metrics: batched (N x M) IoU matrix, python loop over the images (torchvision) vs 'pairwise_box_iou'
+    Returns:
+        list: one row (dict) for each operation with the max absolute difference and the two times (ms)
+    """
+    from torchvision.ops import box_iou as tv_box_iou
+    from .inference.box_ops import box_iou, pairwise_box_iou, to_corners_, box_convert, scale_boxes_
+    torch.manual_seed(0)
+    def random_boxes(*shape): # (xc, yc, w, h) in [0, 1]
+        wh = torch.rand((*shape, 2), device=device) * 0.3 + 0.01
+        return torch.cat([wh / 2 + torch.rand((*shape, 2), device=device) * (1 - wh), wh], dim=-1)
+    def sync(fn):
+        def wrapped():
+            out = fn()
+            if device != "cpu":
+                torch.cuda.synchronize()
+            return out
+        return wrapped
+    rows = []
+
+    pred, target = random_boxes(num_boxes).requires_grad_(True), random_boxes(num_boxes)
+    old_fn = lambda: legacy_giou(pred, target).squeeze(-1).mean().backward()
+    new_fn = lambda: box_iou(pred, target, box_format="yolo", iou_type="giou").mean().backward()
+    diff = (legacy_giou(pred, target).squeeze(-1) - box_iou(pred, target, box_format="yolo", iou_type="giou")).abs().max().item()
+    rows.append({"op": "loss GIoU (fwd+bwd)", "max_abs_diff": diff, "old_ms": timeit(sync(old_fn), repetitions), "new_ms": timeit(sync(new_fn), repetitions)})
+
+    cells = torch.cat([torch.rand((num_boxes, 2), device=device), random_boxes(num_boxes) * 640], dim=-1) # [class, score, xc, yc, w, h]
+    diff = (legacy_xywh_to_xyxy(cells.clone())[..., 2:6] - to_corners_(cells.clone()[..., 2:6], "yolo")).abs().max().item()
+    # both conversions are in-place: repeating them on the same tensor changes the values, not the cost
+    old_cells, new_cells = cells.clone(), cells.clone()
+    rows.append({"op": "NMS xywh->xyxy", "max_abs_diff": diff,
+                 "old_ms": timeit(sync(lambda: legacy_xywh_to_xyxy(old_cells)), repetitions),
+                 "new_ms": timeit(sync(lambda: to_corners_(new_cells[..., 2:6], "yolo")), repetitions)})
+
+    labels = random_boxes(num_gt).cpu()
+    def old_draw():
+        return [[(xc - w/2) * 1280, (yc - h/2) * 720, (xc + w/2) * 1280, (yc + h/2) * 720] for xc, yc, w, h in labels.tolist()]
+    new_draw = lambda: scale_boxes_(box_convert(labels, "yolo", "corners"), (1, 1), (1280, 720))
+    diff = (torch.tensor(old_draw()) - new_draw()).abs().max().item()
+    rows.append({"op": "draw_bbox yolo->pixels", "max_abs_diff": diff, "old_ms": timeit(old_draw, repetitions), "new_ms": timeit(new_draw, repetitions)})
+
+    preds, gts = box_convert(random_boxes(batch_size, num_boxes // batch_size), "yolo", "corners"), box_convert(random_boxes(batch_size, num_gt), "yolo", "corners")
+    old_fn = lambda: torch.stack([tv_box_iou(p, g) for p, g in zip(preds, gts)])
+    new_fn = lambda: pairwise_box_iou(preds, gts)
+    diff = (old_fn() - new_fn()).abs().max().item()
+    rows.append({"op": "batched IoU matrix", "max_abs_diff": diff, "old_ms": timeit(sync(old_fn), repetitions), "new_ms": timeit(sync(new_fn), repetitions)})
+
+    for r in rows:
+        r["speedup"] = r["old_ms"] / r["new_ms"]
+    print_table(rows, ["op", "max_abs_diff", "old_ms", "new_ms", "speedup"])
+    return rows
+
+# (name, VideoDetector arguments): the detector on every frame is the reference, then fixed intervals and the adaptive keyframes
+VIDEO_SETTINGS = (("every frame", {"keyframe_interval": 1, "motion_threshold": float("inf")}),
+                  ("every 3", {"keyframe_interval": 3, "motion_threshold": float("inf")}),
+                  ("every 5", {"keyframe_interval": 5, "motion_threshold": float("inf")}),
+                  ("every 10", {"keyframe_interval": 10, "motion_threshold": float("inf")}),
+                  ("adaptive (max 10)", {"keyframe_interval": 10}))
+
+def load_video_frames(video_path, img_size, max_frames=300, device="cpu"):
+    # frames of the clip preprocessed like in the notebook (RGB, resized to img_size x img_size, values in [0, 1])
+    import cv2
+    cap = cv2.VideoCapture(video_path)
+    frames = []
+    while len(frames) < max_frames:
+        ret_val, frame = cap.read()
+        if not ret_val:
+            break
+        frame = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), (img_size, img_size))
+        frames.append(torch.from_numpy(frame).permute(2, 0, 1).float().div(255).unsqueeze(0).to(device))
+    cap.release()
+    return frames
+
+def benchmark_video_tracking(model, video_path, settings=VIDEO_SETTINGS, targets=None, max_frames=300, device="cpu", output_file=None):
+    """
+    FPS gain against mAP loss of the tracker-assisted video inference (see 'inference/video.py') on a held-out clip.
+    The frames are decoded and preprocessed before timing, so only detector + tracker are measured.
+    Parameters:
+        model (URBE_Perception or URBE_Detector): the trained model
+        targets (list): one (n, 5) tensor [class, x1, y1, x2, y2] (pixels of the network input) for each frame of the clip.
+                        Without annotations, the detections of the detector on every frame are the reference (so the mAP
+                        loss is measured against running the detector on all the frames).
+    Returns:
+        list: one row (dict) for each setting
+    """
+    from torchmetrics.detection.mean_ap import MeanAveragePrecision
+    from .inference import VideoDetector
+    detector = getattr(model, "detector", model).to(device).eval()
+    frames = load_video_frames(video_path, detector.config.img_size, max_frames, device)
+    rows = []
+    for name, kwargs in settings:
+        video_detector = VideoDetector(detector, **kwargs)
+        video_detector(frames[0]) # warm-up (the tracker is reset below)
+        video_detector.reset()
+        outputs = []
+        if device != "cpu":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for frame in frames:
+            outputs.append(video_detector(frame)[0])
+        if device != "cpu":
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+        if targets is None: # the first setting is the detector on every frame
+            targets = [torch.cat([o[:, 0:1], o[:, 2:6]], dim=-1) for o in outputs]
+        mAP = MeanAveragePrecision()
+        mAP.update([dict(boxes=o[:, 2:6], scores=o[:, 1], labels=o[:, 0].long()) for o in outputs],
+                   [dict(boxes=t[:, 1:5].float().cpu(), labels=t[:, 0].long().cpu()) for t in targets[:len(frames)]])
+        ris = mAP.compute()
+        stats = video_detector.stats
+        rows.append({"setting": name, "keyframes_%": 100 * (len(frames) - stats["tracked"]) / len(frames), "scene_changes": stats["scene_change"],
+                     "fps": len(frames) / elapsed, "map_50": float(ris["map_50"]), "map": float(ris["map"])})
+    for r in rows:
+        r["fps_gain"] = r["fps"] / rows[0]["fps"]
+        r["map_50_loss"] = rows[0]["map_50"] - r["map_50"]
+    print_table(rows, ["setting", "keyframes_%", "scene_changes", "fps", "fps_gain", "map_50", "map_50_loss", "map"])
+    if output_file is not None:
+        json.dump(rows, open(output_file, "w"), indent=4)
+    return rows
+
+def label_boxes(labels, img_size):
+    # zero-padded labels (max_objects, 5) [class, xc, yc, w, h] --> (n, 5) [class, x1, y1, x2, y2] in pixels of the network input
+    from .inference import box_convert
+    labels = labels[labels.sum(dim=-1) != 0]
+    return torch.cat([labels[:, 0:1], box_convert(labels[:, 1:5], "yolo", "corners") * img_size], dim=-1)
+
+# (name, CascadeDetector arguments): the two models alone (a gate which never/always escalates) and the two escalations
+CASCADE_SETTINGS = (("nano only", {"gate": lambda detections: None}),
+                    ("medium only", {"gate": lambda detections: "always", "escalation": "frame"}),
+                    ("cascade (frame)", {"escalation": "frame"}),
+                    ("cascade (crop)", {"escalation": "crop"}))
+
+def benchmark_cascade(student, teacher, data, settings=CASCADE_SETTINGS, max_images=None, device="cpu", output_file=None):
+    """
+    Escalation rate, average latency per frame and mAP of the nano --> medium cascade (see 'inference/cascade.py') on the
+    test split. The frames are processed one at a time, like in the video inference.
+    Parameters:
+        student, teacher (URBE_Perception or URBE_Detector): the nano and the medium trained models
+        data (URBE_DataModule): datamodule (already set up) with the test split
+    Returns:
+        list: one row (dict) for each setting
+    """
+    from torchmetrics.detection.mean_ap import MeanAveragePrecision
+    from .inference import CascadeDetector
+    student = getattr(student, "detector", student).to(device).eval()
+    teacher = getattr(teacher, "detector", teacher).to(device).eval()
+    samples = [(img, label_boxes(labels, student.config.img_size)) for batch in data.test_dataloader() for img, labels in zip(batch["img"], batch["labels"])]
+    samples = samples[:max_images] if max_images is not None else samples
+    rows = []
+    for name, kwargs in settings:
+        cascade = CascadeDetector(student, teacher, **kwargs)
+        cascade(samples[0][0][None].to(device)) # warm-up
+        cascade.stats.clear()
+        mAP = MeanAveragePrecision()
+        timings = []
+        for img, target in samples:
+            img = img[None].to(device)
+            if device != "cpu":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            detections, _ = cascade(img)
+            if device != "cpu":
+                torch.cuda.synchronize()
+            timings.append((time.perf_counter() - start) * 1000)
+            d = detections[0].float().cpu()
+            mAP.update([dict(boxes=d[:, 2:6], scores=d[:, 1], labels=d[:, 0].long())], [dict(boxes=target[:, 1:5], labels=target[:, 0].long())])
+        ris = mAP.compute()
+        rows.append({"setting": name, "escalation_%": 100 * cascade.escalation_rate(), "mean_ms": float(np.mean(timings)),
+                     "fps": 1000 / float(np.mean(timings)), "map_50": float(ris["map_50"]), "map": float(ris["map"])})
+    print_table(rows, ["setting", "escalation_%", "mean_ms", "fps", "map_50", "map"])
+    if output_file is not None:
+        json.dump(rows, open(output_file, "w"), indent=4)
+    return rows
+
+def benchmark_jpeg_decoding(hparams, sizes=(640, 416, 320), num_images=200, oversample=1.0, model=None, device="cpu", output_file=None):
+    """
+    Decoding time of the full decode + resize (the current path of 'make_data') against the reduced-resolution JPEG
+    decode (see 'inference/image_io.py') for each target size, on the images of the test split. If a trained 'model' is
+    given, we also compute its test mAP with the two decodes (at the model 'img_size').
+    NB: the decoder only reduces by 1/2, 1/4 or 1/8 without going below the target, so for 1280x720 frames and square
+    targets the draft decode only kicks in for sizes <= 360 (otherwise it is a full decode).
+    Returns:
+        list: one row (dict) for each target size
+    """
+    from torchvision import transforms
+    from .inference.image_io import open_image
+    from .data_module import URBE_DataModule, URBE_Dataset
+    test_dir = os.path.join(hparams["dataset_dir"], "test")
+    files = [os.path.join(test_dir, name) for name in sorted(os.listdir(test_dir))[:num_images]]
+    rows = []
+    for size in sizes:
+        resize = transforms.Resize((size, size))
+        row = {"img_size": size}
+        for name, draft_size in (("full", None), ("draft", (size, size))):
+            start = time.perf_counter()
+            for file_name in files:
+                img = open_image(file_name, draft_size, oversample)
+                decoded_size = img.size
+                resize(img)
+            row[f"{name}_ms"] = (time.perf_counter() - start) / len(files) * 1000
+            row[f"{name}_decoded"] = f"{decoded_size[0]}x{decoded_size[1]}" # of the last image
+        row["speedup"] = row["full_ms"] / row["draft_ms"]
+        row["map_50_full"], row["map_50_draft"] = float("nan"), float("nan")
+        if model is not None and size == model.hparams.img_size:
+            for name in ("full", "draft"):
+                data = URBE_DataModule({**hparams, "jpeg_draft": name == "draft", "jpeg_draft_oversample": oversample})
+                data.data_test = URBE_Dataset(data.hparams.dataset_dir, "test", data.hparams.annotations_file_path, data.hparams)
+                row[f"map_50_{name}"] = evaluate_map(model.to(device), data.test_dataloader(), device)["map_50"]
+        rows.append(row)
+    print_table(rows, ["img_size", "full_decoded", "full_ms", "draft_decoded", "draft_ms", "speedup", "map_50_full", "map_50_draft"])
+    if output_file is not None:
+        json.dump(rows, open(output_file, "w"), indent=4)
+    return rows
+
+class PhaseTimer:
+    """
+    Wall time of the phases of a step. The methods wrapped with 'wrap' (on the instance, so the model is unchanged for
+    the other instances) are timed with synchronization, and the time of a phase excludes the wrapped calls nested inside
+    it (e.g. the target assignment inside 'predict'). Everything of the step which is not wrapped goes to 'rest_phase'.
+    """
+    def __init__(self, device):
+        self.cuda = str(device).startswith("cuda")
+        self.times = {}
+        self.stack = [] # children time of the running phases
+
+    def sync(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    def add(self, phase, seconds):
+        self.times[phase] = self.times.get(phase, 0.0) + seconds
+
+    def timed(self, phase, fn, *args, **kwargs):
+        self.sync()
+        self.stack.append(0.0)
+        start = time.perf_counter()
+        ris = fn(*args, **kwargs)
+        self.sync()
+        elapsed = time.perf_counter() - start
+        self.add(phase, elapsed - self.stack.pop())
+        if len(self.stack) > 0:
+            self.stack[-1] += elapsed
+        return ris
+
+    def wrap(self, obj, name, phase):
+        fn = getattr(obj, name)
+        setattr(obj, name, lambda *args, **kwargs: self.timed(phase, fn, *args, **kwargs))
+
+    def step(self, rest_phase, fn, *args, **kwargs):
+        # a whole step: the not wrapped part goes to 'rest_phase'
+        before = sum(self.times.values())
+        self.sync()
+        start = time.perf_counter()
+        ris = fn(*args, **kwargs)
+        self.sync()
+        self.add(rest_phase, time.perf_counter() - start - (sum(self.times.values()) - before))
+        return ris
+
+    def pop(self):
+        times, self.times = self.times, {}
+        return times
+
+def synthetic_samples(num_samples, img_size, num_classes, max_objects=20, seed=0):
+    # samples like the ones of URBE_Dataset (uint8 HWC image, normalized [class, xc, yc, w, h] labels) with random content
+    gen = np.random.default_rng(seed)
+    torch.manual_seed(seed)
+    labels = random_labels(num_samples, max_objects, num_classes)
+    return [{"id": f"synthetic_{i}", "img": gen.integers(0, 256, (img_size, img_size, 3), dtype=np.uint8), "time": "daytime", "file_name": f"synthetic_{i}.jpg",
+             "labels": labels[i][labels[i, :, 2:].sum(-1) > 0].tolist()} for i in range(num_samples)]
+
+class FirstSamples(IterableDataset):
+    # the first 'num_samples' samples of an iterable dataset (e.g. the ShardedDataset, which has no __getitem__ for a Subset)
+    def __init__(self, dataset, num_samples):
+        self.dataset = dataset
+        self.num_samples = num_samples
+
+    def __iter__(self):
+        return itertools.islice(iter(self.dataset), self.num_samples)
+
+def first_samples(dataset, num_samples):
+    if isinstance(dataset, IterableDataset):
+        return FirstSamples(dataset, num_samples)
+    return Subset(dataset, range(min(num_samples, len(dataset))))
+
+TRAIN_PHASES = ("data", "h2d", "forward", "targets", "loss", "logging", "backward", "optimizer")
+VAL_PHASES = ("data", "h2d", "forward", "targets", "loss", "postprocess", "metrics", "logging")
+
+def benchmark_step_breakdown(hparams, data=None, steps=20, warmup=3, batch_size=None, num_workers=0, device="cpu", seed=0, num_threads=None, output_file=None):
+    """
+    Time breakdown of 'URBE_Perception.training_step' and 'validation_step' (with the backward and the optimizer step):
+        data: wait for the next batch of the DataLoader (collate included)
+        h2d: host-to-device copy of the batch
+        forward: forward pass of the network
+        targets: target assignment of 'YOLO_Loss' (the 'transform_targets' of every image, or the target cache)
+        loss: the rest of the step (loss math, and for the validation the accuracy)
+        logging: 'self.log' calls (outside a Trainer Lightning only validates the arguments)
+        postprocess: 'predict' without the targets (decode + NMS)
+        metrics: update of the mAP
+    The batches are synthetic (random images and labels) or, if 'data' (a URBE_DataModule) is given, the first ones of its
+    training/validation sets. Everything is seeded (and on CPU the number of threads is fixed), so the JSON report of
+    two commits can be diffed. The first 'warmup' steps are not timed.
+    Returns:
+        dict: environment, settings and for "train"/"val" the mean/median/p90 ms of each phase and its share of the step
+    """
+    import random
+    import platform
+    import warnings
+    from .data_module import URBE_DataModule
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    if num_threads is not None or device == "cpu":
+        torch.set_num_threads(num_threads if num_threads is not None else min(4, os.cpu_count()))
+    batch_size = batch_size if batch_size is not None else hparams["batch_size"]
+    num_samples = (steps + warmup) * batch_size
+    # no images for wandb (they need a Trainer and a logger)
+    hparams = {**copy.deepcopy(hparams), "batch_size": batch_size, "log_image_each_epoch": 0}
+    if data is None:
+        data = URBE_DataModule(hparams)
+        data.data_train = synthetic_samples(num_samples, hparams["img_size"], hparams["num_classes"], seed=seed)
+        data.data_val = synthetic_samples(num_samples, hparams["img_size"], hparams["num_classes"], seed=seed + 1)
+        source = "synthetic"
+    else:
+        data.setup()
+        source = "dataset"
+    # map-style datasets (and the synthetic samples) are cut with a Subset, the sharded ones are read only up to 'num_samples'
+    loaders = {"train": data.make_dataloader(first_samples(data.data_train, num_samples), shuffle=False, batch_size=batch_size, num_workers=num_workers),
+               "val": data.make_dataloader(first_samples(data.data_val, num_samples), shuffle=False, batch_size=batch_size, num_workers=num_workers)}
+
+    model = URBE_Perception(hparams).to(device)
+    optimizer = model.configure_optimizers()["optimizer"]
+    timer = PhaseTimer(device)
+    timer.wrap(model, "forward", "forward")
+    timer.wrap(model.loss, "build_assignments", "targets")
+    timer.wrap(model, "log", "logging")
+    timer.wrap(model, "log_dict", "logging")
+    timer.wrap(model, "predict", "postprocess")
+    timer.wrap(model.mAP, "update", "metrics")
+
+    def to_device(batch):
+        # like the Trainer, every tensor of the batch is moved
+        return {k: v.to(device) if torch.is_tensor(v) else v for k, v in batch.items()}
+
+    def train_step(batch, batch_idx):
+        loss = model.training_step(batch, batch_idx)["loss"]
+        timer.timed("backward", loss.backward)
+        timer.timed("optimizer", optimizer.step)
+        optimizer.zero_grad(set_to_none=True)
+
+    def val_step(batch, batch_idx):
+        with torch.no_grad():
+            model.validation_step(batch, batch_idx)
+
+    report = {"environment": {"torch": torch.__version__, "python": platform.python_version(), "platform": platform.platform(), "device": str(device),
+                              "num_threads": torch.get_num_threads(), "commit": subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()},
+              "settings": {"source": source, "steps": steps, "warmup": warmup, "batch_size": batch_size, "num_workers": num_workers, "seed": seed,
+                           **{k: hparams[k] for k in ("img_size", "backbone", "neck", "head", "first_out", "fused_loss", "target_cache", "precision") if k in hparams}}}
+    all_rows = []
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore") # 'self.log' without a Trainer
+        for split, phases, step_fn in (("train", TRAIN_PHASES, train_step), ("val", VAL_PHASES, val_step)):
+            model.train(split == "train")
+            step_times = []
+            loader = iter(loaders[split])
+            for batch_idx in range(warmup + steps):
+                batch = timer.timed("data", next, loader, None)
+                if batch is None: # the dataset is smaller than the requested steps
+                    break
+                batch = timer.timed("h2d", to_device, batch)
+                timer.step("loss", step_fn, batch, batch_idx)
+                times = timer.pop()
+                if batch_idx >= warmup:
+                    step_times.append(times)
+            rows = []
+            total = np.array([sum(t.values()) for t in step_times]) * 1000
+            for phase in phases:
+                ms = np.array([t.get(phase, 0.0) for t in step_times]) * 1000
+                rows.append({"split": split, "phase": phase, "mean_ms": float(ms.mean()), "median_ms": float(np.median(ms)),
+                             "p90_ms": float(np.percentile(ms, 90)), "share_%": float(100 * ms.sum() / total.sum())})
+            rows.append({"split": split, "phase": "step", "mean_ms": float(total.mean()), "median_ms": float(np.median(total)),
+                         "p90_ms": float(np.percentile(total, 90)), "share_%": 100.0})
+            report[split] = {"steps": len(step_times), "phases": rows}
+            all_rows += rows
+    print_table(all_rows, ["split", "phase", "mean_ms", "median_ms", "p90_ms", "share_%"])
+    if output_file is not None:
+        json.dump(report, open(output_file, "w"), indent=4)
+    return report
+
+def benchmark_detection_log(log_dir, num_frames=20000, detections_per_frame=20, batch_size=16, num_classes=3, queries=1000, seed=0):
+    """
+    Overhead of the detection log (see 'inference/detection_log.py') on random NMS outputs: time of the batched appends
+    (with the chunk writes), of the random access by frame and of a class + score filter over the whole log.
+    NB: 'log_dir' is emptied first.
+    Returns:
+        dict: append time per frame (us), size on disk (MB), random access time per frame (us) and filter time (ms)
+    """
+    import shutil
+    from .inference.detection_log import DetectionLogWriter, DetectionLogReader
+    shutil.rmtree(log_dir, ignore_errors=True)
+    gen = torch.Generator().manual_seed(seed)
+    batches = []
+    for start in range(0, num_frames, batch_size):
+        frames = list(range(start, min(start + batch_size, num_frames)))
+        detections = []
+        for _ in frames:
+            n = int(torch.randint(0, 2 * detections_per_frame + 1, (1,), generator=gen))
+            boxes = torch.rand((n, 4), generator=gen).sort(dim=-1).values * 640 # x1 <= y1 <= x2 <= y2 is enough here
+            detections.append(torch.cat([torch.randint(0, num_classes, (n, 1), generator=gen).float(), torch.rand((n, 1), generator=gen), boxes], dim=1))
+        batches.append((frames, detections))
+    start = time.perf_counter()
+    with DetectionLogWriter(log_dir) as log:
+        for frames, detections in batches:
+            log.append(frames, detections, [f / 30 for f in frames])
+    ris = {"append_us_per_frame": (time.perf_counter() - start) / num_frames * 1e6,
+           "size_MB": sum(os.path.getsize(os.path.join(log_dir, f)) for f in os.listdir(log_dir)) / 2**20}
+    reader = DetectionLogReader(log_dir)
+    frames = torch.randint(0, num_frames, (queries,), generator=gen).tolist()
+    start = time.perf_counter()
+    for f in frames:
+        reader.frame(f)
+    ris["frame_access_us"] = (time.perf_counter() - start) / queries * 1e6
+    start = time.perf_counter()
+    kept = reader.query(classes=[1], min_score=0.5)
+    ris["query_ms"] = (time.perf_counter() - start) * 1000
+    ris["query_rows"] = len(kept["score"])
+    print_table([ris], list(ris.keys()))
+    return ris
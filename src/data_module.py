@@ -1,13 +1,57 @@
 import os
-from PIL import Image
 from torchvision import transforms
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, IterableDataset
 import pytorch_lightning as pl
 import json
 import torch
 from tqdm import tqdm
 import albumentations as A
 from numpy import asarray
+from dataclasses import asdict
+from .hyperparameters import Hparams
+from .inference.image_io import open_image
+from .resolution import ResolutionSchedule, ResolutionBatchSampler, MultiScaleDataset
+
+def make_augmentation():
+	# a slightly image augmentation (albumentations works with image numpy arrays and normalized yolo bboxes)
+	return A.Compose([A.ColorJitter(brightness=0.2, contrast=0.2, saturation=0.2, hue=0.0, p=0.4),
+					  A.VerticalFlip(p=0.5),
+					  A.HorizontalFlip(p=0.5),
+					  A.RandomBrightnessContrast(p=0.2),
+					  A.Blur(p=0.05),
+					  A.ChannelShuffle(p=0.05),
+					 ], bbox_params=A.BboxParams(format='yolo', min_visibility=0.4, label_fields=['class_labels']))
+
+def augment(augmentation, sample):
+	# it returns the augmented copy of the sample
+	sample = dict(sample)
+	labels = torch.tensor(sample["labels"])
+	augmentations = augmentation(image=asarray(sample["img"]), bboxes=labels[..., 1:].tolist(), class_labels=[e for e in labels[..., 0].tolist()])
+	sample["img"] = augmentations["image"]
+	# loss fx requires bboxes to be (class_idx,x,y,w,h)
+	sample["labels"] = []
+	if len(augmentations["bboxes"]):
+		# and restore the original order of bboxes
+		sample["labels"] = torch.cat((torch.tensor([[e] for e in augmentations["class_labels"]]), torch.tensor(augmentations["bboxes"])), dim=-1).tolist()
+	return sample
+
+def make_labels(ann_list):
+	# from the COCO annotations (w.r.t. 1280x720 frames) of an image to the [class, xc, yc, w, h] normalized labels
+	labels = []
+	for ann in ann_list:
+		# we normalize the bounding boxes using the (xc, yc, w, h) format...
+		x1 = ann["bbox"][0] / 1280
+		y1 = ann["bbox"][1] / 720
+		w = ann["bbox"][2] / 1280
+		h = ann["bbox"][3] / 720
+		xc = x1 + (w/2)
+		yc = y1 + (h/2)
+		# we skip these type of annotations in order to avoid future errors with albumentations (due to their internal bug)
+		# see https://github.com/albumentations-team/albumentations/issues/922
+		if x1+w>1 or y1+h>1:
+			continue
+		labels.append( [ann["category_id"], xc, yc, w, h] )
+	return labels
 
 class URBE_Dataset(Dataset):
 	def __init__(self, dataset_dir: str, data_type: str, annotations_file_path, hparams):
@@ -20,13 +64,7 @@ class URBE_Dataset(Dataset):
 			transforms.Resize((self.hparams.img_size, self.hparams.img_size)),
 		])
 		if self.hparams.augmentation and self.data_type == "train": # a slightly image augmentation
-				self.augmentation = A.Compose([A.ColorJitter(brightness=0.2, contrast=0.2, saturation=0.2, hue=0.0, p=0.4),
-        									   A.VerticalFlip(p=0.5),
-											   A.HorizontalFlip(p=0.5),
-											   A.RandomBrightnessContrast(p=0.2),
-											   A.Blur(p=0.05),
-											   A.ChannelShuffle(p=0.05),
-											  ], bbox_params=A.BboxParams(format='yolo', min_visibility=0.4, label_fields=['class_labels']))
+				self.augmentation = make_augmentation()
 		self.make_data()
 	
 	def make_data(self):
@@ -36,23 +74,12 @@ class URBE_Dataset(Dataset):
 		max_number = round(self.hparams.max_number_images/8) if (self.data_type == "val" or self.data_type == "test") else self.hparams.max_number_images
 		for file_name in tqdm(images_folder[:max_number]):
 			image_id = (file_name.split("_")[-1])[:-4]
-			img = self.resize(Image.open(file_name).convert('RGB')) # we only resize the PIL Image
+			# we only resize the PIL Image (with 'jpeg_draft' the JPEG is already decoded near 'img_size')
+			draft_size = (self.hparams.img_size, self.hparams.img_size) if self.hparams.jpeg_draft else None
+			img = self.resize(open_image(file_name, draft_size, self.hparams.jpeg_draft_oversample))
 			time = list(filter(lambda x: x["id"] == image_id, self.annotations["images"]))[0]["timeofday"]
 			ann_list = list(filter(lambda x: x["image_id"] == image_id, self.annotations["annotations"]))
-			labels = []
-			for ann in ann_list:
-				# we normalize the bounding boxes using the (xc, yc, w, h) format...
-				x1 = ann["bbox"][0] / 1280
-				y1 = ann["bbox"][1] / 720
-				w = ann["bbox"][2] / 1280
-				h = ann["bbox"][3] / 720
-				xc = x1 + (w/2)
-				yc = y1 + (h/2)
-				# we skip these type of annotations in order to avoid future errors with albumentations (due to their internal bug)
-				# see https://github.com/albumentations-team/albumentations/issues/922
-				if x1+w>1 or y1+h>1:
-					continue
-				labels.append( [ann["category_id"], xc, yc, w, h] )
+			labels = make_labels(ann_list)
 			self.data.append({"id" : image_id, "img" : img, "time" : time, "file_name" : file_name, "labels" : labels})
 	
 	def __len__(self):
@@ -62,17 +89,8 @@ class URBE_Dataset(Dataset):
 		## AUGMENTATION ## 
   		# is performed only on the training set
 		if self.hparams.augmentation and self.data_type == "train": # a slightly image augmentation because the dataset is already heterogeneous!
-			data_tmp = self.data[idx]			
-			data_tmp["labels"] = torch.tensor(data_tmp["labels"])
-   			# albumentations works with image numpy arrays
-			augmentations = self.augmentation(image=asarray(data_tmp["img"]), bboxes=data_tmp["labels"][..., 1:].tolist(), class_labels=[e for e in data_tmp["labels"][..., 0].tolist()])
-			data_tmp["img"] = augmentations["image"]
-            # loss fx requires bboxes to be (class_idx,x,y,w,h)
-			data_tmp["labels"] = []
-			if len(augmentations["bboxes"]):
-				# and restore the original order of bboxes
-				data_tmp["labels"] = torch.cat((torch.tensor([[e] for e in augmentations["class_labels"]]), torch.tensor(augmentations["bboxes"])), dim=-1).tolist()
-			return data_tmp
+			# (on a copy: the stored sample must stay the original one, otherwise the augmentations pile up epoch after epoch)
+			return augment(self.augmentation, self.data[idx])
 		else:
 			return self.data[idx]
 
@@ -81,6 +99,9 @@ class URBE_DataModule(pl.LightningDataModule):
 	def __init__(self, hparams: dict):
 		super().__init__()
 		self.save_hyperparameters(hparams, logger=False)
+		# the missing hyperparameters take the default value
+		for key, value in asdict(Hparams()).items():
+			self.hparams.setdefault(key, value)
 		self.totensor = transforms.Compose([
 			# Converts a PIL Image or numpy.ndarray (H x W x C) in the range [0, 255] 
 			# to a torch.FloatTensor of shape (C x H x W) in the range [0.0, 1.0]
@@ -88,7 +109,14 @@ class URBE_DataModule(pl.LightningDataModule):
 		])
 
 	def setup(self, stage=None):
-		if not hasattr(self,"data_train"):
+		if not hasattr(self,"data_train") and self.hparams.shard_dir is not None:
+			# the same splits streamed from the shards (built by 'shards.py' on a slow/remote storage)
+			from .shards import ShardedDataset # (shards.py imports this module)
+			assert ResolutionSchedule.from_hparams(self.hparams) is None, "The shards can't be used with a resolution schedule (it needs a map-style dataset)!"
+			self.data_train = ShardedDataset(os.path.join(self.hparams.shard_dir, "train"), self.hparams, "train", shuffle=True, num_read_ahead=self.hparams.shard_read_ahead)
+			self.data_val = ShardedDataset(os.path.join(self.hparams.shard_dir, "val"), self.hparams, "val", num_read_ahead=self.hparams.shard_read_ahead)
+			self.data_test = ShardedDataset(os.path.join(self.hparams.shard_dir, "test"), self.hparams, "test", num_read_ahead=self.hparams.shard_read_ahead)
+		elif not hasattr(self,"data_train"):
 			# TRAIN
 			self.data_train = URBE_Dataset(self.hparams.dataset_dir, "train", self.hparams.annotations_file_path, self.hparams)
 			# VAL
@@ -97,36 +125,39 @@ class URBE_DataModule(pl.LightningDataModule):
 			self.data_test = URBE_Dataset(self.hparams.dataset_dir, "test", self.hparams.annotations_file_path, self.hparams)
 
 	def train_dataloader(self):
-		return DataLoader(
-			self.data_train,
-			batch_size=self.hparams.batch_size,
-			shuffle=True,
-			num_workers=self.hparams.n_cpu,
-			collate_fn = self.collate,
-			pin_memory=self.hparams.pin_memory,
-			persistent_workers=True
-		)
+		# with a resolution schedule the batches are bucketed by resolution (see 'resolution.py')
+		schedule = ResolutionSchedule.from_hparams(self.hparams)
+		if schedule is not None:
+			if not hasattr(self, "batch_sampler"): # the same sampler keeps counting the epochs
+				# when the training is resumed from a checkpoint the schedule continues from the restored epoch (and not from 'min_img_size')
+				trainer = getattr(self, "trainer", None)
+				start_epoch = trainer.current_epoch if trainer is not None else 0
+				self.batch_sampler = ResolutionBatchSampler(len(self.data_train), self.hparams.batch_size, schedule, shuffle=True, start_epoch=start_epoch)
+			return self.make_dataloader(MultiScaleDataset(self.data_train), shuffle=True, batch_sampler=self.batch_sampler)
+		# an IterableDataset shuffles by itself (shard order and samples inside each shard)
+		return self.make_dataloader(self.data_train, shuffle=not isinstance(self.data_train, IterableDataset))
 
 	def val_dataloader(self):
-		return DataLoader(
-			self.data_val,
-			batch_size=self.hparams.batch_size,
-			shuffle=False,
-			num_workers=self.hparams.n_cpu,
-			collate_fn = self.collate,
-			pin_memory=self.hparams.pin_memory,
-			persistent_workers=True
-		)
+		return self.make_dataloader(self.data_val, shuffle=False)
   
 	def test_dataloader(self):
+		return self.make_dataloader(self.data_test, shuffle=False)
+
+	def make_dataloader(self, dataset, shuffle, batch_size=None, num_workers=None, prefetch_factor=None, batch_sampler=None):
+		# by default the values of the hyperparameters are used (see also 'tuning.py' which searches the best ones for each machine)
+		num_workers = self.hparams.n_cpu if num_workers is None else num_workers
+		prefetch_factor = self.hparams.prefetch_factor if prefetch_factor is None else prefetch_factor
+		# 'persistent_workers' and 'prefetch_factor' are only allowed when there are worker processes
+		workers_kwargs = dict(persistent_workers=True, prefetch_factor=prefetch_factor) if num_workers > 0 else dict()
+		# a batch sampler already decides the batches (and their order)
+		batch_kwargs = dict(batch_sampler=batch_sampler) if batch_sampler is not None else dict(batch_size=self.hparams.batch_size if batch_size is None else batch_size, shuffle=shuffle)
 		return DataLoader(
-			self.data_test,
-			batch_size=self.hparams.batch_size,
-			shuffle=False,
-			num_workers=self.hparams.n_cpu,
-   			collate_fn = self.collate,
+			dataset,
+			num_workers=num_workers,
+			collate_fn = self.collate,
 			pin_memory=self.hparams.pin_memory,
-			persistent_workers=True
+			**workers_kwargs,
+			**batch_kwargs
 		)
   
 	# we need a collate function because each image have a different number of bounding boxes
@@ -138,4 +169,7 @@ class URBE_DataModule(pl.LightningDataModule):
 		batch_out["file_name"] = [sample["file_name"] for sample in batch]
 		max_number_bbox = torch.tensor([len(sample["labels"]) for sample in batch]).max()
 		batch_out["labels"] = torch.stack( [ torch.tensor(sample["labels"] + [ [0,0,0,0,0] for _ in range(max_number_bbox - len(sample["labels"]))] ) for sample in batch] )
+		# cached tensors, e.g. the activations of the frozen backbone layers or the teacher outputs (see 'feature_cache.py' and 'distillation.py')
+		for key in batch[0].keys() - batch_out.keys():
+			batch_out[key] = torch.stack([sample[key] for sample in batch], dim=0)
 		return batch_out
\ No newline at end of file
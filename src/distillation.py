@@ -0,0 +1,87 @@
+import torch
+from torch import nn
+from .inference import URBE_Detector
+from .feature_cache import FeatureCache, CachedFeaturesDataset, cache_key, base_dataset, without_cache
+
+###################################################### KNOWLEDGE DISTILLATION ################################################
+# A frozen teacher (e.g. the YOLOv5m, first_out=48) guides the training of the student (e.g. the YOLOv5n, first_out=16):
+#   - feature imitation: the three neck outputs of the student (adapted to the teacher channels by 1x1 convs) imitate the teacher ones
+#   - soft targets: the teacher objectness/class probabilities are targets for the student (see YOLO_Loss.distill_loss)
+# The two models must have the same image size, anchors and number of classes (so their predictions have the same shapes).
+TEACHER_NAMES = tuple(f"teacher_feature_{s}" for s in range(3)) + tuple(f"teacher_pred_{s}" for s in range(3))
+
+def load_detector(path, map_location="cpu"):
+    """ URBE_Detector from a Lightning checkpoint of URBE_Perception or from a file saved by 'URBE_Detector.save'. """
+    try:
+        saved = torch.load(path, map_location=map_location, weights_only=False) # the hyperparameters are not only tensors
+    except TypeError: # 'weights_only' is only available from PyTorch 1.13
+        saved = torch.load(path, map_location=map_location)
+    if "hyper_parameters" in saved: # Lightning checkpoint: we only keep the network (also the older 'backbone.*' keys)
+        hparams = dict(saved["hyper_parameters"])
+        state_dict = {}
+        for key, value in saved["state_dict"].items():
+            key = key[len("detector."):] if key.startswith("detector.") else key
+            if key.startswith(("backbone.", "neck.", "head.")):
+                state_dict[key] = value
+    else:
+        hparams, state_dict = saved["hparams"], saved["state_dict"]
+    detector = URBE_Detector(hparams)
+    detector.load_state_dict(state_dict)
+    return detector
+
+class Teacher:
+    """ The frozen teacher. It is not a submodule of the student, so it is never trained, saved in its checkpoints or counted in its parameters. """
+    def __init__(self, path, map_location="cpu"):
+        self.detector = load_detector(path, map_location).eval()
+        for param in self.detector.parameters():
+            param.requires_grad = False
+
+    @property
+    def neck_channels(self):
+        return self.detector.neck.out_channels
+
+    @torch.no_grad()
+    def __call__(self, imgs):
+        """
+        Returns:
+            tuple: (list of the three neck outputs, list of the three head outputs) of the teacher for the batch 'imgs'
+        """
+        self.detector.to(imgs.device) # it does nothing once the teacher is on the right device
+        return self.detector.eager_forward(imgs, return_features=True)
+
+def feature_adapters(student_channels, teacher_channels):
+    # 1x1 convs from the student neck outputs to the teacher channels (they are only used during the training)
+    return nn.ModuleList([nn.Conv2d(cs, ct, kernel_size=1) for cs, ct in zip(student_channels, teacher_channels)])
+
+def feature_imitation_loss(adapters, student_features, teacher_features):
+    """ Mean over the three scales of the MSE between the adapted student neck outputs and the teacher ones. """
+    losses = [nn.functional.mse_loss(adapter(s).float(), t.detach().float()) for adapter, s, t in zip(adapters, student_features, teacher_features)]
+    return sum(losses) / len(losses)
+
+def attach_teacher_cache(model, data, cache_dir=None, batch_size=16):
+    """
+    The teacher outputs (neck outputs and predictions, in fp16) are computed once for all the training images and added to the
+    samples (TEACHER_NAMES keys), so the teacher forward is not repeated every epoch. The cache is (re)built only if it
+    doesn't match the current teacher/dataset.
+    NB: the neck outputs of a YOLOv5m at 640x640 take ~4 MB for each image.
+    """
+    assert model.hparams.teacher_checkpoint is not None, "The teacher cache needs a teacher (hparams.teacher_checkpoint)!"
+    assert not data.hparams.augmentation, "The teacher cache can't be used with augmentation (the images change every epoch)!"
+    assert not (data.hparams.progressive_resize or data.hparams.multi_scale), "The teacher cache can't be used with a resolution schedule!"
+    assert data.hparams.shard_dir is None, "The teacher cache needs the map-style dataset (not the shards)!"
+    data.setup()
+    dataset = without_cache(data.data_train, TEACHER_NAMES)
+    teacher = model.get_teacher()
+    cache = FeatureCache(cache_dir if cache_dir is not None else model.hparams.teacher_cache_dir, TEACHER_NAMES)
+    key = cache_key(teacher.detector, base_dataset(dataset))
+    if not cache.matches(key):
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        def forward(imgs):
+            features, preds = teacher(imgs.to(device))
+            return (*features, *preds)
+        cache.build(forward, base_dataset(dataset), data.collate, key, batch_size)
+    else:
+        print(f"Using the teacher cache in {cache.cache_dir}")
+    data.data_train = CachedFeaturesDataset(dataset, cache)
+    return cache
+##############################################################################################################################
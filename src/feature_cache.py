@@ -0,0 +1,153 @@
+import os
+import copy
+import json
+import shutil
+import hashlib
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from .inference import FROZEN_LAYERS
+
+######################################################### FEATURE CACHE ######################################################
+# When the pretrained weights are loaded, the first FROZEN_LAYERS layers of the backbone are frozen (and their BatchNorms
+# use the pretrained running statistics, see URBE_Perception.train). Without augmentation they produce the same activations
+# for an image every epoch, so we compute them only once: the two outputs we need ('c4', skip connection, and 'c6', skip
+# connection and input of the 7th layer) are stored in fp16 inside two memory-mapped .npy files (one row for each image).
+
+def cache_key(module, dataset):
+    """ The cache is valid as long as the weights of 'module', the image size and the images (and their order) are the same. """
+    h = hashlib.sha1()
+    for name, tensor in module.state_dict().items():
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().numpy().tobytes())
+    h.update(str(dataset.hparams.img_size).encode())
+    h.update(json.dumps([sample["id"] for sample in dataset.data]).encode())
+    return h.hexdigest()[:16]
+
+class FeatureCache:
+    def __init__(self, cache_dir, names=("c4", "c6")):
+        self.cache_dir = cache_dir
+        self.names = tuple(names) # one memory-mapped array (and one key of the samples) for each cached tensor
+        self.meta_path = os.path.join(cache_dir, "meta.json")
+        # the meta file is written at the end of 'build', so if it exists the cache is complete
+        self.meta = json.load(open(self.meta_path)) if os.path.exists(self.meta_path) else None
+        self.arrays = None # opened lazily (also in each dataloader worker)
+
+    def __getstate__(self):
+        # we don't pickle the memory maps when the dataset is sent to the dataloader workers
+        state = self.__dict__.copy()
+        state["arrays"] = None
+        return state
+
+    def matches(self, key):
+        return self.meta is not None and self.meta["key"] == key
+
+    def build(self, forward, dataset, collate, key, batch_size=16):
+        """ Stores the outputs of 'forward' (one tensor for each of the 'names') for all the images of 'dataset' (in the same order). """
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir) # previous (invalid) cache
+        os.makedirs(self.cache_dir)
+        self.meta, self.arrays = None, None
+
+        arrays = {}
+        print(f"Building the feature cache of {len(dataset)} images in {self.cache_dir}...")
+        with torch.no_grad():
+            for start in range(0, len(dataset), batch_size):
+                batch = collate([dataset.data[i] for i in range(start, min(start + batch_size, len(dataset)))])
+                for name, features in zip(self.names, forward(batch["img"])):
+                    if name not in arrays:
+                        arrays[name] = np.lib.format.open_memmap(os.path.join(self.cache_dir, f"{name}.npy"), mode="w+", dtype=np.float16,
+                                                                 shape=(len(dataset), *features.shape[1:]))
+                    arrays[name][start:start + features.shape[0]] = features.half().cpu().numpy()
+        for array in arrays.values():
+            array.flush()
+        del arrays
+
+        meta = {"key" : key, "num_images" : len(dataset), "names" : list(self.names)}
+        with open(self.meta_path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(self.meta_path + ".tmp", self.meta_path)
+        self.meta = meta
+
+    def read(self, idx):
+        if self.arrays is None:
+            self.arrays = {name : np.load(os.path.join(self.cache_dir, f"{name}.npy"), mmap_mode="r") for name in self.names}
+        # we copy the rows, the memory maps are read-only
+        return tuple(torch.from_numpy(np.array(self.arrays[name][idx])) for name in self.names)
+
+class CachedFeaturesDataset(Dataset):
+    """ The training URBE_Dataset with the cached tensors (e.g. 'c4' and 'c6', the activations of the frozen layers) added to each sample. """
+    def __init__(self, dataset, cache):
+        self.dataset = dataset
+        self.cache = cache
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        sample = dict(self.dataset[idx])
+        sample.update(zip(self.cache.names, self.cache.read(idx)))
+        return sample
+
+# the caches can be stacked (e.g. feature cache + teacher cache, see 'distillation.py'): the indices are always the ones of the URBE_Dataset
+def base_dataset(dataset):
+    while isinstance(dataset, CachedFeaturesDataset):
+        dataset = dataset.dataset
+    return dataset
+
+def without_cache(dataset, names):
+    # 'dataset' without the CachedFeaturesDataset layer of the cache with these 'names' (if it is attached)
+    if not isinstance(dataset, CachedFeaturesDataset):
+        return dataset
+    if dataset.cache.names == tuple(names):
+        return dataset.dataset
+    dataset.dataset = without_cache(dataset.dataset, names)
+    return dataset
+
+def attach_feature_cache(model, data, cache_dir=None, batch_size=16):
+    """
+    Feature-caching training mode: the training set of 'data' is replaced by a CachedFeaturesDataset, so the training
+    steps start from the 7th layer of the backbone. The cache is (re)built only if it doesn't match the current model/dataset.
+    """
+    assert model.frozen, "The feature cache needs the frozen layers of the YOLOv5 backbone (load_pretrained=True)!"
+    assert not data.hparams.augmentation, "The feature cache can't be used with augmentation (the images change every epoch)!"
+    assert not (data.hparams.progressive_resize or data.hparams.multi_scale), "The feature cache can't be used with a resolution schedule!"
+    assert data.hparams.shard_dir is None, "The feature cache needs the map-style dataset (not the shards)!"
+    data.setup()
+    dataset = without_cache(data.data_train, ("c4", "c6"))
+    cache = FeatureCache(cache_dir if cache_dir is not None else model.hparams.feature_cache_dir)
+    key = cache_key(model.backbone.backbone[:FROZEN_LAYERS], base_dataset(dataset))
+    if not cache.matches(key):
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        # only the backbone is needed: we work on a copy so that the model is left untouched (and on its device)
+        backbone = copy.deepcopy(model.backbone).to(device).eval()
+        cache.build(lambda imgs: backbone.forward_prefix(imgs.to(device)), base_dataset(dataset), data.collate, key, batch_size)
+    else:
+        print(f"Using the feature cache in {cache.cache_dir}")
+    data.data_train = CachedFeaturesDataset(dataset, cache)
+    return cache
+
+def check_feature_cache_parity(model, data, num_batches=3, batch_size=None, rtol=1e-2):
+    """
+    Parity check of the feature-caching mode: the training loss computed from the cached (fp16) activations must match
+    the one computed by the live forward on the same batches (the model is copied, so it isn't modified).
+    Returns:
+        list: one row (dict) for each batch with the two losses and their relative difference
+    """
+    assert isinstance(data.data_train, CachedFeaturesDataset), "Call 'attach_feature_cache' first!"
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = copy.deepcopy(model).to(device).train()
+    batch_size = batch_size if batch_size is not None else data.hparams.batch_size
+    rows = []
+    with torch.no_grad():
+        for b in range(num_batches):
+            indices = [i % len(data.data_train) for i in range(b * batch_size, (b + 1) * batch_size)]
+            batch = data.collate([data.data_train[i] for i in indices])
+            live_loss = model.loss(model(batch["img"].to(device)), batch["labels"]).item()
+            cached_out = model.detector.forward_from_features(batch["c4"].to(device).float(), batch["c6"].to(device).float())
+            cached_loss = model.loss(cached_out, batch["labels"]).item()
+            rows.append({"batch" : b, "live_loss" : live_loss, "cached_loss" : cached_loss, "rel_diff" : abs(live_loss - cached_loss) / max(abs(live_loss), 1e-12)})
+            print(f"batch {b}: live loss {live_loss:.6f} - cached loss {cached_loss:.6f} (relative difference {rows[-1]['rel_diff']:.2e})")
+    assert all(r["rel_diff"] <= rtol for r in rows), f"The cached and live losses don't match (rtol={rtol})!"
+    return rows
+##############################################################################################################################
@@ -1,3 +1,6 @@
+import os
+import json
+import socket
 from dataclasses import dataclass
 
 @dataclass
@@ -8,25 +11,53 @@ class Hparams:
     max_number_images: int = 3000
     num_classes: int = 3 # number of classes in the dataset
     augmentation: bool = False # apply augmentation strategy to input images and bounding boxes
+    target_cache: bool = False # the target grids of each image are computed only once (only without augmentation)
     # by reducing the image size to a multiple of 32, you can get a higher frame rate. Here comes the trade-off between Speed and Accuracy. You can reduce the image size until you receive satisfactory accuracy for your use-case.
     img_size: int = 640 # suggested size of image for YOLOv5 or 416
     img_channels: int = 3 # RGB channels
+    jpeg_draft: bool = False # the JPEGs are decoded directly near 'img_size' (DCT-domain scaling, see inference/image_io.py)
+    jpeg_draft_oversample: float = 1.0 # the reduced decode is at least this factor times 'img_size' (higher --> closer to the full decode)
+    shard_dir: str = None # if set, the images are streamed from the sequential shards in '<shard_dir>/<split>' (see shards.py)
+    shard_read_ahead: int = 2 # shards read in advance by each dataloader worker
+    # resolution schedule of the training (see resolution.py): 'img_size' is the final resolution, the validation always uses it
+    progressive_resize: bool = False # the resolution grows from 'min_img_size' to 'img_size' in the first 'resize_ramp_epochs' epochs
+    min_img_size: int = 320
+    resize_ramp_epochs: int = 10
+    multi_scale: bool = False # random resolution (multiple of 32) for each batch...
+    multi_scale_range: float = 0.5 # ...in [(1 - multi_scale_range) * resolution of the epoch, resolution of the epoch]
     batch_size: int = 10 # size of the batches (only 10 on my local machine)
+    checkpointing: tuple = () # stages with activation checkpointing ("backbone", "sppf", "neck", "head"): less memory --> larger batches
     n_cpu: int = 8 # number of cpu threads to use for the dataloaders
     pin_memory: bool = False # parameter to pin memory in dataloader
+    prefetch_factor: int = 2 # batches loaded in advance by each worker
     
     # YOLOv5 params
-    head: str = "simple" # simple or decoupled
-    first_out: int = 48 # 48 for YOLOv5m or 16 for YOLOv5n
+    backbone: str = "yolov5" # yolov5, darknet_tiny, darknet_small, darknet_base or darknet_large
+    neck: str = "yolov5" # yolov5, pafpn_csp or pafpn_al
+    head: str = "simple" # simple, decoupled or yolox
+    first_out: int = 48 # 48 for YOLOv5m or 16 for YOLOv5n (only for the yolov5 backbone)
+    # YOLOv5 n/s/m/l/x scaling (see YOLOV5_FAMILY in model.py): None keeps 'first_out' and our original C3 depths
+    depth_multiple: float = None # it scales the number of bottlenecks of the C3 blocks (0.33, 0.33, 0.67, 1.0, 1.33)
+    width_multiple: float = None # it scales the channels, it overrides 'first_out' (0.25, 0.50, 0.75, 1.0, 1.25)
     
     # LOSS params - values taken from the official YOLOv5 repository code
     weight_class: float = 0.5
     weight_obj: float = 1 
     weight_box: float = 0.05
+    fused_loss: bool = False # the three scales are computed in a single pass (same values, fewer kernels)
     
     # TRAIN params
     resume_from_checkpoint: str = None # checkpoint model path from which we want to RESUME the training
     load_pretrained: bool = True # if we want to load pretrained weights (only for the BACKBONE and the NECK)
+    feature_cache: bool = False # the activations of the frozen backbone layers are computed once and cached (only with load_pretrained and without augmentation)
+    feature_cache_dir: str = "dataset/feature_cache" # where the (fp16, memory-mapped) cached activations are stored
+    # knowledge distillation (see distillation.py): a frozen teacher (e.g. YOLOv5m) guides the training of the student (e.g. YOLOv5n)
+    teacher_checkpoint: str = None # Lightning checkpoint (or exported URBE_Detector) of the teacher, None disables the distillation
+    weight_feature: float = 1.0 # feature imitation loss on the neck outputs (the student ones are adapted with 1x1 convs)
+    weight_distill: float = 1.0 # soft objectness/class targets given by the teacher predictions
+    distill_temperature: float = 1.0 # the logits of both models are divided by it before the sigmoid
+    teacher_cache: bool = False # the teacher outputs are computed once and stored on disk (only without augmentation)
+    teacher_cache_dir: str = "dataset/teacher_cache" # where the (fp16, memory-mapped) teacher outputs are stored
     lr: float = 2e-4 # learning rate: 2e-4 or 5e-4
     min_lr: float = 1e-8 # min lr for ReduceLROnPlateau
     adam_eps: float = 1e-6 # term added to the denominator to improve numerical stability
@@ -43,4 +74,29 @@ class Hparams:
     log_image_each_epoch: int = 2 # epochs interval we wait to log images
     
     # INFERENCE params
-    quantization: bool = False # if we want to quantize the model during training
\ No newline at end of file
+    quantization: bool = False # if we want to quantize the model during training
+    compile_mode: str = None # None (eager), "compile" (torch.compile) or "script" (torch.jit.script) --> see URBE_Perception.compile_network
+    compile_warmup: int = 3 # number of forward passes needed to warm-up the compiled graph
+    # VIDEO params (see inference/video.py): the detector runs only on the keyframes, the tracker propagates the boxes in between
+    keyframe_interval: int = 5 # maximum number of frames between two keyframes (1 runs the detector on every frame)
+    motion_threshold: float = 0.05 # mean abs difference (of a 32x32 gray thumbnail) from the last keyframe which triggers a new keyframe
+    scene_change_threshold: float = 0.15 # above this difference it is a scene change: the tracks are also reset
+    # CASCADE params (see inference/cascade.py): the nano model runs on every frame, the medium one only on the hard frames
+    cascade_min_score: float = 0.5 # the frame is escalated if the highest objectness of the nano detections is lower
+    cascade_uncertain_scores: tuple = (0.1, 0.5) # detections with a score in this range are uncertain...
+    cascade_max_uncertain: int = 3 # ...and the frame is escalated if there are more of them
+    cascade_escalation: str = "frame" # "frame" (the medium model sees the whole frame) or "crop" (only the region of the uncertain boxes)
+
+# HOST PROFILES: the values of the hyperparameters which depend on the machine (batch size, dataloader workers, ...)
+# are searched by 'src/tuning.py' and saved as a small json of overrides, one for each host.
+def host_profile_path(profile_dir="profiles", host=None):
+    return os.path.join(profile_dir, f"{host if host is not None else socket.gethostname()}.json")
+
+def load_host_profile(hparams, profile_dir="profiles", host=None):
+    """ Updates (in place) the 'hparams' dictionary with the overrides of the host profile, if there is one. """
+    path = host_profile_path(profile_dir, host)
+    if os.path.exists(path):
+        overrides = json.load(open(path))
+        print(f"Loading the host profile {path}: {overrides}")
+        hparams.update(overrides)
+    return hparams
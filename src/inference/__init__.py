@@ -0,0 +1,18 @@
+# lightweight inference package: it only depends on torch and torchvision (no Lightning, wandb or torchmetrics)
+from .network import ANCHORS, STRIDE, FROZEN_LAYERS, YOLOV5_FAMILY, BACKBONES, NECKS, HEADS, family_hparams, build_architecture
+from .box_ops import box_convert, to_corners_, from_corners_, scale_boxes_, box_iou, pairwise_box_iou
+from .image_io import open_image
+from .decode import make_grids, cells_to_bboxes, non_max_suppression
+from .detector import URBE_Detector
+from .video import BoxTracker, VideoDetector
+from .cascade import ConfidenceGate, CascadeDetector
+from .detection_log import DetectionLogWriter, DetectionLogReader
+
+__all__ = ["ANCHORS", "STRIDE", "FROZEN_LAYERS", "YOLOV5_FAMILY", "BACKBONES", "NECKS", "HEADS", "family_hparams", "build_architecture",
+           "box_convert", "to_corners_", "from_corners_", "scale_boxes_", "box_iou", "pairwise_box_iou",
+           "open_image",
+           "make_grids", "cells_to_bboxes", "non_max_suppression",
+           "URBE_Detector",
+           "BoxTracker", "VideoDetector",
+           "ConfidenceGate", "CascadeDetector",
+           "DetectionLogWriter", "DetectionLogReader"]
@@ -0,0 +1,107 @@
+import math
+import torch
+
+########################################################### BOX OPS ##########################################################
+# All the box math of the project (loss, NMS, metrics and visualization) lives here. The supported formats are
+#   - "yolo"    --> (xc, yc, w, h)
+#   - "coco"    --> (x1, y1, w, h)
+#   - "corners" --> (x1, y1, x2, y2)
+# The functions ending with '_' work in-place on the last dimension (no new tensor is allocated, so they are meant
+# for inference), the others return new tensors and are differentiable (so they can be used in the loss).
+FORMATS = ("yolo", "coco", "corners")
+
+def check_format(box_format):
+    if box_format not in FORMATS:
+        raise ValueError(f"Unknown box format '{box_format}', choose among {list(FORMATS)}")
+
+def to_corners_(boxes, box_format):
+    """ In-place conversion of 'boxes' (..., 4) from 'box_format' to (x1, y1, x2, y2). """
+    check_format(box_format)
+    if box_format == "yolo":
+        boxes[..., 0:2].add_(boxes[..., 2:4], alpha=-0.5) # (x1, y1, w, h)
+    if box_format != "corners":
+        boxes[..., 2:4].add_(boxes[..., 0:2]) # (x1, y1, x2, y2)
+    return boxes
+
+def from_corners_(boxes, box_format):
+    """ In-place conversion of 'boxes' (..., 4) from (x1, y1, x2, y2) to 'box_format'. """
+    check_format(box_format)
+    if box_format != "corners":
+        boxes[..., 2:4].sub_(boxes[..., 0:2]) # (x1, y1, w, h)
+    if box_format == "yolo":
+        boxes[..., 0:2].add_(boxes[..., 2:4], alpha=0.5) # (xc, yc, w, h)
+    return boxes
+
+def box_convert(boxes, in_format, out_format):
+    """ Conversion between two formats: only one new tensor is allocated (and it is differentiable). """
+    if in_format == out_format:
+        return boxes[..., :4]
+    return from_corners_(to_corners_(boxes[..., :4].clone(), in_format), out_format)
+
+def scale_boxes_(boxes, from_size, to_size):
+    """ In-place rescaling of the boxes (any format) from an image of size 'from_size' (w, h) to one of size 'to_size' (w, h). """
+    boxes[..., 0::2].mul_(to_size[0] / from_size[0])
+    boxes[..., 1::2].mul_(to_size[1] / from_size[1])
+    return boxes
+
+def corners(boxes, box_format):
+    # the four coordinates (x1, y1, x2, y2) as separate tensors: the last dimension is unbound and never re-sliced
+    check_format(box_format)
+    a, b, c, d = boxes[..., :4].unbind(dim=-1)
+    if box_format == "yolo":
+        return a - c / 2, b - d / 2, a + c / 2, b + d / 2
+    elif box_format == "coco":
+        return a, b, a + c, b + d
+    return a, b, c, d
+
+def iou_from_corners(box1, box2, iou_type="iou", eps=1e-7):
+    # 'box1' and 'box2' are (x1, y1, x2, y2) tuples of broadcastable tensors
+    b1_x1, b1_y1, b1_x2, b1_y2 = box1
+    b2_x1, b2_y1, b2_x2, b2_y2 = box2
+    w1, h1, w2, h2 = b1_x2 - b1_x1, b1_y2 - b1_y1, b2_x2 - b2_x1, b2_y2 - b2_y1
+
+    # Intersection area
+    # clamp(0) is for the cases when they do not intersect
+    inter = (torch.min(b1_x2, b2_x2) - torch.max(b1_x1, b2_x1)).clamp(0) * \
+            (torch.min(b1_y2, b2_y2) - torch.max(b1_y1, b2_y1)).clamp(0)
+    # Union Area
+    union = (w1 * h1) + (w2 * h2) - inter + eps
+    iou = inter / union
+    if iou_type == "iou":
+        return iou
+
+    cw = torch.max(b1_x2, b2_x2) - torch.min(b1_x1, b2_x1)  # convex (smallest enclosing box) width
+    ch = torch.max(b1_y2, b2_y2) - torch.min(b1_y1, b2_y1)
+    if iou_type == "giou": # https://arxiv.org/pdf/1902.09630.pdf
+        c_area = cw * ch + eps  # convex area
+        return iou - (c_area - union) / c_area
+    c2 = cw ** 2 + ch ** 2 + eps  # convex diagonal squared
+    rho2 = ((b2_x1 + b2_x2 - b1_x1 - b1_x2) ** 2 + (b2_y1 + b2_y2 - b1_y1 - b1_y2) ** 2) / 4  # center distance squared
+    if iou_type == "diou": # https://arxiv.org/abs/1911.08287v1
+        return iou - rho2 / c2
+    elif iou_type == "ciou": # https://github.com/Zzh-tju/DIoU-SSD-pytorch/blob/master/utils/box/box_utils.py#L47
+        v = (4 / math.pi ** 2) * torch.pow(torch.atan(w2 / h2) - torch.atan(w1 / h1), 2)
+        with torch.no_grad():
+            alpha = v / (v - iou + (1 + eps))
+        return iou - (rho2 / c2 + v * alpha)
+    raise ValueError(f"Unknown iou type '{iou_type}', choose among ['iou', 'giou', 'diou', 'ciou']")
+
+def box_iou(boxes1, boxes2, box_format="corners", iou_type="iou", eps=1e-7):
+    """
+    Element-wise IoU (or GIoU/DIoU/CIoU with 'iou_type') between two sets of boxes with broadcastable shapes (..., 4).
+    Returns:
+        tensor: (...) one value for each pair of boxes
+    """
+    return iou_from_corners(corners(boxes1, box_format), corners(boxes2, box_format), iou_type, eps)
+
+def pairwise_box_iou(boxes1, boxes2, box_format="corners", iou_type="iou", eps=1e-7):
+    """
+    IoU (or GIoU/DIoU/CIoU) matrix between every box of 'boxes1' (..., N, 4) and every box of 'boxes2' (..., M, 4).
+    The leading dimensions (e.g. the batch) are broadcast, so it also works on batches of images.
+    Returns:
+        tensor: (..., N, M)
+    """
+    box1 = tuple(c.unsqueeze(-1) for c in corners(boxes1, box_format)) # (..., N, 1)
+    box2 = tuple(c.unsqueeze(-2) for c in corners(boxes2, box_format)) # (..., 1, M)
+    return iou_from_corners(box1, box2, iou_type, eps)
+##############################################################################################################################
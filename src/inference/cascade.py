@@ -0,0 +1,119 @@
+import torch
+import torch.nn.functional as F
+from collections import Counter
+
+########################################################## CASCADE ###########################################################
+# The nano model (first_out=16) runs on every frame and the medium one (first_out=48) only on the frames where the nano
+# detections are uncertain. The gate decides which frames are "hard", the escalation decides what the medium model sees.
+class ConfidenceGate:
+    """
+    Default escalation policy: a frame is hard if the highest score of the nano detections is low, or if too many of them
+    are uncertain (their score is in 'uncertain_scores'). Any callable with the same signature can be used as gate.
+    """
+    def __init__(self, min_score=0.5, uncertain_scores=(0.1, 0.5), max_uncertain=3):
+        self.min_score = min_score
+        self.uncertain_scores = uncertain_scores
+        self.max_uncertain = max_uncertain
+
+    def uncertain(self, detections):
+        # mask of the uncertain detections (n, 6)
+        scores = detections[:, 1]
+        return (scores >= self.uncertain_scores[0]) & (scores < self.uncertain_scores[1])
+
+    def __call__(self, detections):
+        """
+        Parameters:
+            detections (tensor): (n, 6) detections [class, score, x1, y1, x2, y2] of the nano model for one frame
+        Returns:
+            str: the reason of the escalation ("low_score" or "uncertain"), None to keep the nano detections
+        """
+        if detections.shape[0] == 0 or detections[:, 1].max() < self.min_score:
+            return "low_score"
+        elif int(self.uncertain(detections).sum()) > self.max_uncertain:
+            return "uncertain"
+        return None
+
+class CascadeDetector:
+    """
+    Cascade of two detectors (URBE_Detector or URBE_Perception) with the same 'img_size'.
+    With escalation="frame" the medium model replaces the nano detections of the hard frames, with escalation="crop" it only
+    sees (resized to 'img_size') the region around the uncertain detections, and its detections replace the nano ones there.
+    """
+    def __init__(self, student, teacher, gate=None, escalation=None, crop_margin=0.1, min_crop=0.25,
+                 conf_threshold=None, iou_threshold=None, max_detections=50):
+        self.student = getattr(student, "detector", student)
+        self.teacher = getattr(teacher, "detector", teacher)
+        config = self.student.config
+        assert config.img_size == self.teacher.config.img_size, "The two models of the cascade must have the same image size!"
+        self.img_size = config.img_size
+        self.gate = gate if gate is not None else ConfidenceGate(config.cascade_min_score, config.cascade_uncertain_scores, config.cascade_max_uncertain)
+        self.escalation = config.cascade_escalation if escalation is None else escalation
+        if self.escalation not in ("frame", "crop"):
+            raise ValueError(f"Unknown escalation '{self.escalation}', choose among ['frame', 'crop']")
+        self.crop_margin = crop_margin # added around the uncertain detections (fraction of 'img_size')
+        self.min_crop = min_crop # minimum side of the crop (fraction of 'img_size')
+        self.conf_threshold = conf_threshold
+        self.iou_threshold = iou_threshold
+        self.max_detections = max_detections
+        self.stats = Counter() # "frames" and the number of escalations for each reason
+
+    def crop_region(self, detections):
+        # (x1, y1, x2, y2) region of the input around the uncertain detections (the whole frame if there are none)
+        uncertain = self.gate.uncertain(detections) if hasattr(self.gate, "uncertain") else torch.zeros(detections.shape[0], dtype=torch.bool)
+        if not uncertain.any():
+            return 0, 0, self.img_size, self.img_size
+        boxes = detections[uncertain, 2:6]
+        margin, min_side = self.crop_margin * self.img_size, self.min_crop * self.img_size
+        region = []
+        for low, high in ((boxes[:, 0].min(), boxes[:, 2].max()), (boxes[:, 1].min(), boxes[:, 3].max())):
+            low, high = float(low) - margin, float(high) + margin
+            if high - low < min_side:
+                center = (low + high) / 2
+                low, high = center - min_side / 2, center + min_side / 2
+            region.append((int(max(low, 0)), int(min(high, self.img_size))))
+        (x1, x2), (y1, y2) = region
+        return x1, y1, x2, y2
+
+    def escalate_crops(self, imgs, detections):
+        regions = [self.crop_region(d) for d in detections]
+        crops = torch.cat([F.interpolate(img[None, :, y1:y2, x1:x2], size=(self.img_size, self.img_size), mode="bilinear", align_corners=False)
+                           for img, (x1, y1, x2, y2) in zip(imgs, regions)])
+        teacher_detections = [t.reshape(-1, 6) for t in self.teacher.detect(crops, self.conf_threshold, self.iou_threshold, self.max_detections)]
+        merged = []
+        for d, t, (x1, y1, x2, y2) in zip(detections, teacher_detections, regions):
+            # from the pixels of the crop to the ones of the frame
+            t = t.clone()
+            t[:, 2:6:2] = t[:, 2:6:2] * (x2 - x1) / self.img_size + x1
+            t[:, 3:6:2] = t[:, 3:6:2] * (y2 - y1) / self.img_size + y1
+            # the nano detections centered inside the crop are replaced by the medium ones
+            xc, yc = (d[:, 2] + d[:, 4]) / 2, (d[:, 3] + d[:, 5]) / 2
+            outside = (xc < x1) | (xc >= x2) | (yc < y1) | (yc >= y2)
+            merged.append(torch.cat([d[outside], t.to(d.dtype)]))
+        return merged
+
+    @torch.no_grad()
+    def __call__(self, imgs):
+        """
+        Parameters:
+            imgs (tensor): batch of preprocessed frames (bs, C, img_size, img_size) on the device of the two models
+        Returns:
+            tuple: (list of (n, 6) detections [class, score, x1, y1, x2, y2] for each frame, list of escalation reasons or None)
+        """
+        # the NMS gives a 1-D 'torch.tensor([])' for the frames without detections
+        detections = [d.reshape(-1, 6) for d in self.student.detect(imgs, self.conf_threshold, self.iou_threshold, self.max_detections)]
+        reasons = [self.gate(d) for d in detections]
+        hard = [i for i, reason in enumerate(reasons) if reason is not None]
+        if len(hard) > 0: # the hard frames are escalated together
+            if self.escalation == "frame":
+                escalated = [d.reshape(-1, 6) for d in self.teacher.detect(imgs[hard], self.conf_threshold, self.iou_threshold, self.max_detections)]
+            else:
+                escalated = self.escalate_crops(imgs[hard], [detections[i] for i in hard])
+            for i, d in zip(hard, escalated):
+                detections[i] = d
+        self.stats["frames"] += len(reasons)
+        self.stats.update(reason for reason in reasons if reason is not None)
+        return detections, reasons
+
+    def escalation_rate(self):
+        return sum(v for k, v in self.stats.items() if k != "frames") / max(self.stats["frames"], 1)
+##############################################################################################################################
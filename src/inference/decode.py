@@ -0,0 +1,109 @@
+import torch
+from torchvision.ops import batched_nms
+from .box_ops import to_corners_
+
+######################################## FROM THE GRID CELLS TO THE BOUNDING BOXES ###########################################
+def make_grids(anchors, naxs, stride, nx, ny, i, device):
+
+    x_grid = torch.arange(nx)
+    x_grid = x_grid.repeat(ny).reshape(ny, nx)
+
+    y_grid = torch.arange(ny).unsqueeze(0)
+    y_grid = y_grid.T.repeat(1, nx).reshape(ny, nx)
+
+    xy_grid = torch.stack([x_grid, y_grid], dim=-1)
+    xy_grid = xy_grid.expand(1, naxs, ny, nx, 2)
+    anchor_grid = (anchors[i]*stride).reshape((1, naxs, 1, 1, 2)).expand(1, naxs, ny, nx, 2)
+
+    return xy_grid.to(device), anchor_grid.to(device)
+
+def cells_to_bboxes(predictions, anchors, strides, device, is_pred=False):
+    """
+    Parameters:
+        predictions (list): output of the head (or targets) for each scale --> (bs, 3, 80/40/20, 80/40/20, 5 + num_classes)
+        anchors (tensor): anchors divided by the stride (the 'anchors' buffer of the head)
+        strides (list): stride of each scale
+        is_pred (bool): if they are the predictions of the model or the ground truth targets
+    Returns:
+        tensor: (bs, number of cells, 6) with [class, objectness, xc, yc, w, h] for each cell
+    """
+    num_out_layers = len(predictions) # num of scales
+    grid = [torch.empty(0) for _ in range(num_out_layers)]  # initialization
+    anchor_grid = [torch.empty(0) for _ in range(num_out_layers)]  # initialization
+
+    all_bboxes = []
+    for i in range(num_out_layers):
+        bs, naxs, ny, nx, _ = predictions[i].shape # (bs, 3, 80/40/20, 80/40/20, _)
+        stride = strides[i] # 8/16/32
+        # 'grid' represents the grid (80x80, 40x40, ...) with indices
+        # 'anchor_grid' has the same number of cells, but with anchors values
+        grid[i], anchor_grid[i] = make_grids(anchors, naxs, stride=stride, ny=ny, nx=nx, i=i, device=device) # both torch.Size([1, 3, 80/40/20, 80/40/20, 2])
+        if is_pred: # if they are the predicitons made by the model
+            # formula taken from here: https://github.com/ultralytics/yolov5/issues/471
+            layer_prediction = predictions[i].sigmoid()
+            obj = layer_prediction[..., 4:5]
+            xy = (2 * (layer_prediction[..., 0:2]) + grid[i] - 0.5) * stride
+            wh = ((2*layer_prediction[..., 2:4])**2) * anchor_grid[i]
+            best_class = torch.argmax(layer_prediction[..., 5:], dim=-1).unsqueeze(-1)
+
+        else: # when we want to re-convert the ground_truth labels to images bboxes
+            if i != num_out_layers-1:
+                continue
+            predictions[i] = predictions[i].to(device, non_blocking=True)
+            obj = predictions[i][..., 4:5]
+            xy = (predictions[i][..., 0:2] + grid[i]) * stride
+            wh = predictions[i][..., 2:4] * stride
+            best_class = predictions[i][..., 5:6]
+
+        scale_bboxes = torch.cat((best_class, obj, xy, wh), dim=-1).reshape(bs, -1, 6)
+        all_bboxes.append(scale_bboxes)
+    return torch.cat(all_bboxes, dim=1)
+
+def non_max_suppression(batch_bboxes, iou_threshold, threshold, max_detections=50, is_pred=False, filenames=None):
+    """
+    Parameters:
+        batch_bboxes (tensor): output of 'cells_to_bboxes' --> (bs, number of cells, 6)
+        filenames (list): names of the images of the batch (only used to report the images without predictions)
+    Returns:
+        list: one (n, 6) tensor for each image with [class, score, x1, y1, x2, y2] (for predictions, also the
+              ratio of the cells kept by the confidence threshold and the ratio of the boxes kept by the nms)
+    """
+    # for statistics purposes
+    conf_thresh_ratio = 0
+    nms_ratio = 0
+
+    bboxes_after_nms = []
+    for i, boxes in enumerate(batch_bboxes): # we iterate over the batches
+        # 'boxes' is the set of cells for one batch --> (25200, 6) for 640x640 images
+        num_cells = boxes.shape[0]
+        # FIRST FILTER on the probability of objectness
+        boxes = torch.masked_select(boxes, boxes[..., 1:2] > threshold).reshape(-1, 6) # if objectness is greater than the threshold, we continue...
+        conf_thresh_ratio += len(boxes) / num_cells
+        # from (xc, yc, w, h) to (x1, y1, x2, y2) --> it is perfect for wandb bbox logging visualization!
+        to_corners_(boxes[..., 2:6], "yolo") # in-place ('boxes' is already a new tensor after the masked_select)
+
+        # we perform non maxima suppression(nms)
+        if is_pred:
+            indices = batched_nms(boxes[..., 2:], boxes[..., 1], boxes[..., 0].int(), iou_threshold)
+
+            if indices.numel() == 0:
+                if filenames is not None:
+                    print(f"***NO PREDICTIONS for image {filenames[i]}***") # in this way we know which image is not predicted and we can check it!
+                boxes = torch.tensor([])
+            else:
+                before_nms = len(boxes)
+                boxes = boxes[indices]
+                nms_ratio += len(boxes) / before_nms
+
+                # we set a maximum number of predictions for each image
+                if boxes.shape[0] > max_detections:
+                    boxes = boxes[:max_detections, :]
+
+        bboxes_after_nms.append(boxes)
+
+    # if we're dealing with predictions we also want to save some statistics
+    if is_pred:
+        return conf_thresh_ratio/len(batch_bboxes), nms_ratio/len(batch_bboxes), bboxes_after_nms # it's a list of tensors --> len(bboxes_after_nms) == batch_size
+    else:
+        return bboxes_after_nms
+##############################################################################################################################
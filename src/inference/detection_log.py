@@ -0,0 +1,195 @@
+import os
+import numpy as np
+import torch
+
+####################################################### DETECTION LOG ########################################################
+# The detections after the NMS are appended (frame by frame, in frame order) to a log directory of numpy chunks:
+#   <log_dir>/chunk-00000.npz, chunk-00001.npz, ... each one with the columns
+#       frame_id (int64), timestamp (float64), num_detections (int32) --> one row for each frame (also without detections)
+#       cls (int16), score (float32), box (float32, n x 4 [x1, y1, x2, y2] pixels of the input) --> one row for each detection
+# A chunk is never modified once written (tmp file + rename), so the log can be read while it is written.
+CHUNK_SUFFIX = ".npz"
+
+def chunk_files(log_dir):
+    return sorted(f for f in os.listdir(log_dir) if f.startswith("chunk-") and f.endswith(CHUNK_SUFFIX)) if os.path.isdir(log_dir) else []
+
+class DetectionLogWriter:
+    """
+    Buffered writer: 'append' only moves a whole batch to the CPU (one copy for all its detections) and a chunk is written
+    every 'chunk_detections' detections (or 'chunk_frames' frames). Reopening an existing log appends new chunks to it.
+    """
+    def __init__(self, log_dir, chunk_detections=65536, chunk_frames=4096):
+        self.log_dir = log_dir
+        self.chunk_detections = chunk_detections
+        self.chunk_frames = chunk_frames
+        os.makedirs(log_dir, exist_ok=True)
+        chunks = chunk_files(log_dir)
+        self.num_chunks = len(chunks)
+        # the frame ids must grow (random access by frame relies on it): we continue from the last written frame
+        self.last_frame = None
+        if len(chunks) > 0:
+            with np.load(os.path.join(log_dir, chunks[-1])) as chunk:
+                self.last_frame = int(chunk["frame_id"][-1])
+        self.reset_buffers()
+
+    def next_frame_id(self):
+        # the first frame id accepted by 'append' (0 for a new log)
+        return 0 if self.last_frame is None else self.last_frame + 1
+
+    def reset_buffers(self):
+        self.frames, self.timestamps, self.counts, self.detections = [], [], [], []
+        self.buffered = 0
+
+    def append(self, frame_ids, detections, timestamps=None):
+        """
+        Parameters:
+            frame_ids (list): ids of the frames (increasing), by default the consecutive ids after the last frame of the log
+            detections (list): for each frame, the (n, 6) [class, score, x1, y1, x2, y2] output of the NMS (tensor or array)
+            timestamps (list): time of each frame in seconds (by default NaN)
+        """
+        if frame_ids is None:
+            frame_ids = range(self.next_frame_id(), self.next_frame_id() + len(detections))
+        frame_ids = [int(f) for f in frame_ids]
+        if len(frame_ids) != len(detections):
+            raise ValueError(f"{len(frame_ids)} frame ids for {len(detections)} frames")
+        previous = self.last_frame
+        for frame_id in frame_ids:
+            if previous is not None and frame_id <= previous:
+                raise ValueError(f"The frame ids of the detection log must be increasing (frame {frame_id} after frame {previous})")
+            previous = frame_id
+        if len(frame_ids) == 0:
+            return
+        # the NMS gives 'torch.tensor([])' for the images without predictions
+        detections = [d.reshape(-1, 6) if torch.is_tensor(d) else torch.as_tensor(np.asarray(d, dtype=np.float32)).reshape(-1, 6) for d in detections]
+        self.detections.append(torch.cat([d.float() for d in detections]).cpu().numpy())
+        self.counts += [d.shape[0] for d in detections]
+        self.frames += frame_ids
+        self.timestamps += list(timestamps) if timestamps is not None else [float("nan")] * len(frame_ids)
+        self.last_frame = frame_ids[-1]
+        self.buffered += self.detections[-1].shape[0]
+        if self.buffered >= self.chunk_detections or len(self.frames) >= self.chunk_frames:
+            self.flush()
+
+    def flush(self):
+        # the buffered frames become a new chunk
+        if len(self.frames) == 0:
+            return
+        detections = np.concatenate(self.detections) if len(self.detections) > 0 else np.zeros((0, 6), dtype=np.float32)
+        path = os.path.join(self.log_dir, f"chunk-{self.num_chunks:05d}{CHUNK_SUFFIX}")
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, frame_id=np.array(self.frames, dtype=np.int64), timestamp=np.array(self.timestamps, dtype=np.float64),
+                     num_detections=np.array(self.counts, dtype=np.int32), cls=detections[:, 0].astype(np.int16),
+                     score=detections[:, 1].astype(np.float32), box=detections[:, 2:6].astype(np.float32))
+        os.replace(path + ".tmp", path)
+        self.num_chunks += 1
+        self.reset_buffers()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class DetectionLogReader:
+    """
+    Random access by frame (binary search on the frame ids of the chunks, only the chunk of the frame is loaded) and
+    vectorized filtering by class/score/frame range over the whole log.
+    """
+    def __init__(self, log_dir, cache_chunks=2):
+        self.log_dir = log_dir
+        self.cache_chunks = cache_chunks
+        self.cache = {} # chunk index --> columns (the most recently used chunks)
+        self.refresh()
+
+    def refresh(self):
+        # (re)reads the frame tables of the chunks (e.g. new chunks of a log which is still written)
+        self.chunks = chunk_files(self.log_dir)
+        frame_ids, timestamps, chunk_idx, starts = [], [], [], []
+        for c, name in enumerate(self.chunks):
+            with np.load(os.path.join(self.log_dir, name)) as chunk: # npz members are read lazily: only the frame columns
+                frame_ids.append(chunk["frame_id"])
+                timestamps.append(chunk["timestamp"])
+                counts = chunk["num_detections"]
+            chunk_idx.append(np.full(len(counts), c, dtype=np.int32))
+            starts.append(np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)) # offsets of the detections of each frame
+        self.frame_ids = np.concatenate(frame_ids) if len(frame_ids) > 0 else np.zeros(0, dtype=np.int64)
+        self.timestamps = np.concatenate(timestamps) if len(timestamps) > 0 else np.zeros(0, dtype=np.float64)
+        self.frame_chunk = np.concatenate(chunk_idx) if len(chunk_idx) > 0 else np.zeros(0, dtype=np.int32)
+        self.chunk_starts = starts
+        self.chunk_first = np.cumsum([0] + [len(f) for f in frame_ids])[:-1] # index of the first frame of each chunk
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.frame_ids)
+
+    def load_chunk(self, c):
+        if c in self.cache: # it becomes the most recently used
+            self.cache[c] = self.cache.pop(c)
+        else:
+            if len(self.cache) >= self.cache_chunks:
+                self.cache.pop(next(iter(self.cache)))
+            with np.load(os.path.join(self.log_dir, self.chunks[c])) as chunk:
+                self.cache[c] = {key : chunk[key] for key in ("cls", "score", "box")}
+        return self.cache[c]
+
+    def frame_index(self, frame_id):
+        i = int(np.searchsorted(self.frame_ids, frame_id))
+        if i == len(self.frame_ids) or self.frame_ids[i] != frame_id:
+            raise KeyError(frame_id)
+        return i
+
+    def timestamp(self, frame_id):
+        return float(self.timestamps[self.frame_index(frame_id)])
+
+    def frame(self, frame_id):
+        """
+        Returns:
+            np.array: (n, 6) detections [class, score, x1, y1, x2, y2] of the frame (the same layout of the NMS output)
+        """
+        i = self.frame_index(frame_id)
+        c = int(self.frame_chunk[i])
+        local = i - int(self.chunk_first[c])
+        start, end = self.chunk_starts[c][local], self.chunk_starts[c][local + 1]
+        columns = self.load_chunk(c)
+        return np.concatenate([columns["cls"][start:end, None].astype(np.float32), columns["score"][start:end, None], columns["box"][start:end]], axis=1)
+
+    def __getitem__(self, frame_id):
+        return self.frame(frame_id)
+
+    def query(self, classes=None, min_score=None, max_score=None, start_frame=None, end_frame=None):
+        """
+        Detections of the whole log (or of the frames in [start_frame, end_frame)) filtered by class and score.
+        Returns:
+            dict: columns "frame_id", "timestamp", "cls", "score", "box" (one row for each kept detection)
+        """
+        out = {key : [] for key in ("frame_id", "timestamp", "cls", "score", "box")}
+        for c in range(len(self.chunks)):
+            first = int(self.chunk_first[c])
+            frames = self.frame_ids[first:first + len(self.chunk_starts[c]) - 1]
+            if len(frames) == 0 or (start_frame is not None and frames[-1] < start_frame) or (end_frame is not None and frames[0] >= end_frame):
+                continue # the chunk is outside the range: it is not even loaded
+            counts = np.diff(self.chunk_starts[c])
+            columns = self.load_chunk(c)
+            keep = np.ones(len(columns["cls"]), dtype=bool)
+            frame_of_detection = np.repeat(frames, counts)
+            if start_frame is not None:
+                keep &= frame_of_detection >= start_frame
+            if end_frame is not None:
+                keep &= frame_of_detection < end_frame
+            if classes is not None:
+                keep &= np.isin(columns["cls"], np.asarray(classes))
+            if min_score is not None:
+                keep &= columns["score"] >= min_score
+            if max_score is not None:
+                keep &= columns["score"] < max_score
+            out["frame_id"].append(frame_of_detection[keep])
+            out["timestamp"].append(np.repeat(self.timestamps[first:first + len(frames)], counts)[keep])
+            for key in ("cls", "score", "box"):
+                out[key].append(columns[key][keep])
+        empty = {"frame_id" : np.zeros(0, np.int64), "timestamp" : np.zeros(0, np.float64), "cls" : np.zeros(0, np.int16),
+                 "score" : np.zeros(0, np.float32), "box" : np.zeros((0, 4), np.float32)}
+        return {key : np.concatenate(values) if len(values) > 0 else empty[key] for key, values in out.items()}
+##############################################################################################################################
@@ -0,0 +1,149 @@
+import torch
+from torch import nn
+from types import SimpleNamespace
+from dataclasses import asdict
+from ..hyperparameters import Hparams
+from .network import ANCHORS, STRIDE, CheckpointedBlock, SPPF, bn_safe_checkpoint, build_architecture
+from .decode import cells_to_bboxes, non_max_suppression
+
+class URBE_Detector(nn.Module):
+    """
+    Inference-only version of URBE_Perception: the Backbone-Neck-Head network together with the decoding of the
+    predictions and the NMS. It is a plain nn.Module (no Lightning, wandb, torchmetrics or loss imports), so it is
+    cheap to import on the edge devices. URBE_Perception composes it for the training.
+    """
+    ANCHORS = ANCHORS
+    STRIDE = STRIDE
+    # stages where activation checkpointing can be enabled (see 'set_checkpointing')
+    CHECKPOINT_STAGES = ("backbone", "sppf", "neck", "head")
+
+    def __init__(self, hparams):
+        super(URBE_Detector, self).__init__()
+        # the missing hyperparameters (e.g. older checkpoints) take the default value
+        self.config = SimpleNamespace(**{**asdict(Hparams()), **dict(hparams)})
+
+        # any backbone/neck/head combination of the registry (the default one is our YOLOv5)
+        self.backbone, self.neck, self.head = build_architecture(self.config)
+        self.set_checkpointing(self.config.checkpointing)
+
+        # graph-captured version of the forward (see 'compile_network'), None means eager mode
+        self.compiled_forward = None
+
+    @property
+    def device(self):
+        return self.head.anchors.device
+
+    def forward(self, x): # we expect x to be the stack of images
+        if self.compiled_forward is not None:
+            return self.compiled_forward(x)
+        return self.eager_forward(x)
+
+    def eager_forward(self, x, return_features=False):
+        x, backbone_connection = self.backbone(x)
+        return self.forward_neck_head(x, backbone_connection, return_features)
+
+    def forward_from_features(self, c4, c6, return_features=False):
+        """ Forward pass which starts after the frozen layers of the YOLOv5 backbone (see 'feature_cache.py'). """
+        x, backbone_connection = self.backbone.forward_suffix(c4, c6)
+        return self.forward_neck_head(x, backbone_connection, return_features)
+
+    def forward_neck_head(self, x, backbone_connection, return_features=False):
+        # with 'return_features' the three outputs of the neck are also returned (see 'distillation.py')
+        features = self.neck(x, backbone_connection)
+        if self.checkpoint_head and self.training:
+            out = bn_safe_checkpoint(self.head, self.head, features)
+        else:
+            out = self.head(features) # [(batch, 3, 80, 80, 8), (batch, 3, 40, 40, 8), (batch, 3, 20, 20, 8)]
+        return (features, out) if return_features else out
+
+    def set_checkpointing(self, stages):
+        """
+        Activation checkpointing (only during the training): the activations of the selected stages are recomputed in the
+        backward pass instead of being kept in memory, so larger batches fit at the cost of some throughput.
+        Parameters:
+            stages (list): any of "backbone" (C3 blocks), "sppf", "neck" (C3 blocks of the neck) and "head" (empty to disable it)
+        """
+        stages = [stages] if isinstance(stages, str) else list(stages or [])
+        for stage in stages:
+            if stage not in self.CHECKPOINT_STAGES:
+                raise ValueError(f"Unknown checkpointing stage '{stage}', choose among {list(self.CHECKPOINT_STAGES)}")
+        # only our blocks support it (e.g. the DarkNet backbone and the PA-FPN necks are left untouched)
+        for module in self.backbone.modules():
+            if isinstance(module, CheckpointedBlock):
+                module.checkpointing = ("sppf" if isinstance(module, SPPF) else "backbone") in stages
+        for module in self.neck.modules():
+            if isinstance(module, CheckpointedBlock):
+                module.checkpointing = "neck" in stages
+        self.checkpoint_head = "head" in stages
+        return self
+
+    def compile_network(self, mode=None, warmup=None, example_input=None):
+        """
+        Opt-in graph capture of the Backbone-Neck-Head forward (meant for INFERENCE).
+        Call it once the model is on its final device, because the scripted modules keep the buffers they had at scripting time.
+        Parameters:
+            mode (str): "compile" (torch.compile), "script" (torch.jit.script) or "eager" (no graph capture).
+                        By default (None) it is taken from 'hparams.compile_mode'.
+            warmup (int): number of forward passes run right away, so that compilation/profiling is not paid
+                          by the first real frames. By default it is taken from 'hparams.compile_warmup'.
+            example_input (tensor): input used for the warm-up (by default a black batch of one image of size 'img_size')
+        """
+        mode = self.config.compile_mode if mode is None else mode
+        warmup = self.config.compile_warmup if warmup is None else warmup
+        self.eval()
+        if mode is None or mode == "eager":
+            self.compiled_forward = None
+            return self
+        elif mode == "compile":
+            assert hasattr(torch, "compile"), "torch.compile requires PyTorch >= 2.0!"
+            # we compile the bound method and not the modules, so the state_dict keys are not changed
+            self.compiled_forward = torch.compile(self.eager_forward)
+        elif mode == "script":
+            backbone, neck, head = torch.jit.script(self.backbone), torch.jit.script(self.neck), torch.jit.script(self.head)
+            def scripted_forward(x):
+                x, backbone_connection = backbone(x)
+                return head(neck(x, backbone_connection))
+            self.compiled_forward = scripted_forward
+        else:
+            raise ValueError(f"Unsupported compile mode: {mode}")
+
+        # WARM-UP: the first calls trigger the compilation (or the profiling executor for TorchScript)
+        if example_input is None:
+            example_input = torch.zeros((1, self.config.img_channels, self.config.img_size, self.config.img_size), device=self.device)
+        with torch.no_grad():
+            for _ in range(warmup):
+                _ = self(example_input)
+        return self
+
+    def decode(self, predictions, conf_threshold=None, iou_threshold=None, max_detections=50, log=None, frame_ids=None, timestamps=None):
+        """
+        From the raw output of the head to the final detections.
+        Parameters:
+            log (DetectionLogWriter): if given, the detections are also appended to it with 'frame_ids' (by default the
+                                      consecutive ids after the last frame of the log) and 'timestamps'
+        Returns:
+            list: one (n, 6) tensor for each image with [class, score, x1, y1, x2, y2] (pixels of the input image)
+        """
+        conf_threshold = self.config.conf_threshold if conf_threshold is None else conf_threshold
+        iou_threshold = self.config.nms_iou_thresh if iou_threshold is None else iou_threshold
+        boxes = cells_to_bboxes(predictions, self.head.anchors, self.head.stride, self.device, is_pred=True)
+        _, _, boxes = non_max_suppression(boxes, iou_threshold=iou_threshold, threshold=conf_threshold, max_detections=max_detections, is_pred=True)
+        if log is not None:
+            log.append(frame_ids, boxes, timestamps)
+        return boxes
+
+    @torch.no_grad()
+    def detect(self, imgs, conf_threshold=None, iou_threshold=None, max_detections=50, log=None, frame_ids=None, timestamps=None):
+        """ Forward pass + decoding of a batch of (already normalized) images, see 'decode'. """
+        return self.decode(self(imgs), conf_threshold, iou_threshold, max_detections, log, frame_ids, timestamps)
+
+    def save(self, path):
+        # hyperparameters and weights in plain python/torch objects: loading them doesn't need Lightning
+        torch.save({"hparams" : vars(self.config), "state_dict" : self.state_dict()}, path)
+
+    @classmethod
+    def load(cls, path, map_location="cpu"):
+        saved = torch.load(path, map_location=map_location)
+        detector = cls(saved["hparams"])
+        detector.load_state_dict(saved["state_dict"])
+        return detector.eval()
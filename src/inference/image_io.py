@@ -0,0 +1,22 @@
+import math
+from PIL import Image
+
+########################################################## IMAGE DECODING ####################################################
+# Our frames are 1280x720 JPEGs but the network sees them at img_size x img_size: with the draft mode of PIL the JPEG decoder
+# scales the image in the DCT domain (by 1/2, 1/4 or 1/8), so we don't pay the decoding of pixels we throw away right after.
+# The decoder never goes below the requested size, so the image is then resized exactly as before (only from fewer pixels).
+def open_image(path, draft_size=None, oversample=1.0):
+    """
+    Parameters:
+        path (str): image file
+        draft_size (tuple): (width, height) the image will be resized to, None for a full decode
+        oversample (float): the reduced JPEG is at least 'oversample' times 'draft_size' (more quality, less speed-up)
+    Returns:
+        PIL Image: the RGB image, decoded at full resolution or at the smallest JPEG scale >= oversample * draft_size.
+                   Non-JPEG files (and JPEGs the decoder can't scale) fall back to the full decode.
+    """
+    img = Image.open(path)
+    if draft_size is not None and img.format == "JPEG":
+        img.draft(None, (math.ceil(draft_size[0] * oversample), math.ceil(draft_size[1] * oversample)))
+    return img.convert("RGB")
+##############################################################################################################################
@@ -0,0 +1,506 @@
+import torch
+from torch import nn
+from typing import List
+from torch.utils.checkpoint import checkpoint
+import math
+from ..other_architecures.alternative_arch import DarknetCSP, PA_FPN_CSP, PA_FPN_AL, DecoupledHead as YOLOX_DecoupledHead
+
+# After the computation of the 'autoanchor' algorithm, we acknowledge that these are the "best" anchors (the default ones used in YOLOv5)
+# https://github.com/ultralytics/yolov5/blob/master/models/yolov5m.yaml
+ANCHORS = [ [(10, 13), (16, 30), (33, 23)],  # P3/8
+        [(30, 61), (62, 45), (59, 119)],  # P4/16
+        [(116, 90), (156, 198), (373, 326)] ]  # P5/32
+STRIDE = [8, 16, 32]
+
+########################################## BASIC BUILDING BLOCKS ##############################################
+##                                                                                                           ##
+## All these blocks are entirely taken (with just few little changes) from the repo of an italian AI         ##
+## enthusiast who implemented a "personal implementation of YOLOv5". That was exactly what I needed!         ##
+## Thanks to https://github.com/AlessandroMondin/YOLOV5m :)                                                  ##
+##                                                                                                           ##
+###############################################################################################################
+# performs a convolution, a batch_norm and then applies a SiLU activation function
+class CBL(nn.Module):
+    def __init__(self, in_channels, out_channels, kernel_size, stride, padding):
+        super(CBL, self).__init__()
+
+        conv = nn.Conv2d(in_channels, out_channels, kernel_size, stride, padding, bias=False)
+        bn = nn.BatchNorm2d(out_channels, eps=1e-3, momentum=0.03)
+
+        self.cbl = nn.Sequential(
+            conv,
+            bn,
+            # https://pytorch.org/docs/stable/generated/torch.nn.SiLU.html
+            nn.SiLU(inplace=True)
+        )
+
+    def forward(self, x):
+        #print(self.cbl(x).shape)
+        return self.cbl(x)
+
+# Opt-in activation checkpointing (see URBE_Detector.set_checkpointing): during the training the activations inside
+# the block are not stored but recomputed in the backward pass --> less memory (larger batches) for one more forward
+def bn_safe_checkpoint(module, function, *args):
+    """
+    Non-reentrant checkpoint of 'function' (the forward of 'module'). The recomputation in the backward pass runs the
+    BatchNorm layers in train mode again: it must use the same batch statistics (so the gradients are the exact ones),
+    but it would also update the running statistics a second time. We restore them right after the recomputation,
+    so a checkpointed training step leaves the same running_mean/running_var/num_batches_tracked of a normal one.
+    """
+    calls = [0]
+    def run(*inputs):
+        calls[0] += 1
+        if calls[0] == 1: # the forward pass
+            return function(*inputs)
+        stats = [(buffer, buffer.clone()) for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)
+                 for buffer in (m.running_mean, m.running_var, m.num_batches_tracked) if buffer is not None]
+        try:
+            return function(*inputs)
+        finally: # also when the recomputation is stopped early (once every saved tensor has been recomputed)
+            with torch.no_grad():
+                for buffer, saved in stats:
+                    buffer.copy_(saved)
+    # the non-reentrant version also works when the input doesn't require grad (e.g. after the frozen layers)
+    return checkpoint(run, *args, use_reentrant=False)
+
+class CheckpointedBlock(nn.Module):
+    def __init__(self):
+        super(CheckpointedBlock, self).__init__()
+        self.checkpointing = False
+
+    def forward(self, x):
+        if self.checkpointing and self.training:
+            return self.checkpointed_forward(x)
+        return self.block_forward(x)
+
+    @torch.jit.unused # never used in inference, so the block stays scriptable
+    def checkpointed_forward(self, x):
+        return bn_safe_checkpoint(self, self.block_forward, x)
+
+# which is just a residual block
+class Bottleneck(nn.Module):
+    """
+    Parameters:
+        in_channels (int): number of channel of the input tensor
+        out_channels (int): number of channel of the output tensor
+        width_multiple (float): it controls the number of channels (and weights)
+                                of all the convolutions beside the
+                                first and last one. If closer to 0,
+                                the simpler the modelIf closer to 1,
+                                the model becomes more complex
+    """
+    def __init__(self, in_channels, out_channels, width_multiple=1):
+        super(Bottleneck, self).__init__()
+        c_ = int(width_multiple*in_channels)
+        self.c1 = CBL(in_channels, c_, kernel_size=1, stride=1, padding=0)
+        self.c2 = CBL(c_, out_channels, kernel_size=3, stride=1, padding=1)
+
+    def forward(self, x):
+        return self.c2(self.c1(x)) + x
+
+# kind of CSP backbone (https://arxiv.org/pdf/1911.11929v1.pdf)
+class C3(CheckpointedBlock):
+    """
+    Parameters:
+        in_channels (int): number of channel of the input tensor
+        out_channels (int): number of channel of the output tensor
+        width_multiple (float): it controls the number of channels (and weights)
+                                of all the convolutions beside the
+                                first and last one. If closer to 0,
+                                the simpler the modelIf closer to 1,
+                                the model becomes more complex
+        depth (int): it controls the number of times the bottleneck (residual block)
+                        is repeated within the C3 block
+        backbone (bool): if True, self.seq will be composed by bottlenecks 1, if False
+                            it will be composed by bottlenecks 2 (check in the image linked below)
+        https://user-images.githubusercontent.com/31005897/172404576-c260dcf9-76bb-4bc8-b6a9-f2d987792583.png
+
+    """
+    def __init__(self, in_channels, out_channels, width_multiple=1, depth=1, backbone=True):
+        super(C3, self).__init__()
+        c_ = int(width_multiple*in_channels)
+
+        self.c1 = CBL(in_channels, c_, kernel_size=1, stride=1, padding=0)
+        self.c_skipped = CBL(in_channels,  c_, kernel_size=1, stride=1, padding=0)
+        if backbone:
+            self.seq = nn.Sequential(
+                *[Bottleneck(c_, c_, width_multiple=1) for _ in range(depth)]
+            )
+        else:
+            self.seq = nn.Sequential(
+                *[nn.Sequential(
+                    CBL(c_, c_, 1, 1, 0),
+                    CBL(c_, c_, 3, 1, 1)
+                ) for _ in range(depth)]
+            )
+        self.c_out = CBL(c_ * 2, out_channels, kernel_size=1, stride=1, padding=0)
+
+    def block_forward(self, x):
+        x = torch.cat([self.seq(self.c1(x)), self.c_skipped(x)], dim=1)
+        return self.c_out(x)
+
+# Spatial Pyramid Pooling - Fast (SPPF) layer for YOLOv5 by Glenn Jocher
+class SPPF(CheckpointedBlock):
+    def __init__(self, in_channels, out_channels):
+        super(SPPF, self).__init__()
+
+        c_ = int(in_channels//2)
+
+        self.c1 = CBL(in_channels, c_, 1, 1, 0)
+        self.pool = nn.MaxPool2d(kernel_size=5, stride=1, padding=2)
+        self.c_out = CBL(c_ * 4, out_channels, 1, 1, 0)
+
+    def block_forward(self, x):
+        x = self.c1(x)
+        pool1 = self.pool(x)
+        pool2 = self.pool(pool1)
+        pool3 = self.pool(pool2)
+
+        return self.c_out(torch.cat([x, pool1, pool2, pool3], dim=1))
+
+# in the PANET the C3 block is different: no more CSP but a residual block composed
+# a sequential branch of n SiLUs and a skipped branch with one SiLU
+class C3_NECK(CheckpointedBlock):
+    def __init__(self, in_channels, out_channels, width, depth):
+        super(C3_NECK, self).__init__()
+        c_ = int(in_channels*width)
+        self.in_channels = in_channels
+        self.c_ = c_
+        self.out_channels = out_channels
+        self.c_skipped = CBL(in_channels, c_, 1, 1, 0)
+        self.c_out = CBL(c_*2, out_channels, 1, 1, 0)
+        self.silu_block = self.make_silu_block(depth)
+
+    def make_silu_block(self, depth):
+        layers = []
+        for i in range(depth):
+            if i == 0:
+                layers.append(CBL(self.in_channels, self.c_, 1, 1, 0))
+            elif i % 2 == 0:
+                layers.append(CBL(self.c_, self.c_, 3, 1, 1))
+            elif i % 2 != 0:
+                layers.append(CBL(self.c_, self.c_, 1, 1, 0))
+        return nn.Sequential(*layers)
+
+    def block_forward(self, x):
+        return self.c_out(torch.cat([self.silu_block(x), self.c_skipped(x)], dim=1))
+##############################################################################################################################
+
+
+################################################### MODEL SCALING ###########################################################
+# (depth_multiple, width_multiple) of the official YOLOv5 family, see https://github.com/ultralytics/yolov5/tree/master/models
+YOLOV5_FAMILY = {
+    "n" : (0.33, 0.25),
+    "s" : (0.33, 0.50),
+    "m" : (0.67, 0.75),
+    "l" : (1.0, 1.0),
+    "x" : (1.33, 1.25),
+}
+
+def family_hparams(size):
+    """ Hyperparameters overrides for the YOLOv5 n/s/m/l/x variant (e.g. hparams.update(family_hparams("s"))). """
+    depth_multiple, width_multiple = YOLOV5_FAMILY[size]
+    return {"depth_multiple" : depth_multiple, "width_multiple" : width_multiple}
+
+def scaled_depth(n, depth_multiple):
+    # number of bottlenecks of a C3 block: same rule of the official repo (models/yolo.py --> parse_model)
+    return max(round(n * depth_multiple), 1) if n > 1 else n
+
+def scaled_first_out(hparams):
+    # channels of the first convolution: 64 * width_multiple rounded up to a multiple of 8 (16 for n, 48 for m, ...)
+    if hparams.width_multiple is None:
+        return hparams.first_out
+    return int(math.ceil(64 * hparams.width_multiple / 8) * 8)
+##############################################################################################################################
+
+####################################################### BACKBONE #############################################################
+# number of backbone layers frozen when we fine-tune the pretrained weights (the output of the last one is 'c6')
+FROZEN_LAYERS = 7
+
+class Backbone(nn.Module):
+    """
+    Parameters:
+        first_out (int): number of channels of the first convolution, all the others are multiples of it
+        depth_multiple (float): it scales the depths (3, 6, 9, 3) of the C3 blocks of the official YOLOv5 backbone.
+                                If None we keep our original depths (2, 4, 6, 2)
+    """
+    def __init__(self, first_out=48, depth_multiple=None):
+        super().__init__()
+        self.backbone = nn.ModuleList()
+        self.first_out = first_out
+        depths = (2, 4, 6, 2) if depth_multiple is None else [scaled_depth(n, depth_multiple) for n in (3, 6, 9, 3)]
+        self.backbone += [
+            CBL(in_channels=3, out_channels=self.first_out, kernel_size=6, stride=2, padding=2),
+            CBL(in_channels=self.first_out, out_channels=self.first_out*2, kernel_size=3, stride=2, padding=1),
+            C3(in_channels=self.first_out*2, out_channels=self.first_out*2, width_multiple=0.5, depth=depths[0]),
+            CBL(in_channels=self.first_out*2, out_channels=self.first_out*4, kernel_size=3, stride=2, padding=1),
+            C3(in_channels=self.first_out*4, out_channels=self.first_out*4, width_multiple=0.5, depth=depths[1]),
+            CBL(in_channels=self.first_out*4, out_channels=self.first_out*8, kernel_size=3, stride=2, padding=1),
+            C3(in_channels=self.first_out*8, out_channels=self.first_out*8, width_multiple=0.5, depth=depths[2]),
+            CBL(in_channels=self.first_out*8, out_channels=self.first_out*16, kernel_size=3, stride=2, padding=1),
+            C3(in_channels=self.first_out*16, out_channels=self.first_out*16, width_multiple=0.5, depth=depths[3]),
+            SPPF(in_channels=self.first_out*16, out_channels=self.first_out*16)
+        ]
+    
+    def forward(self, x):
+        assert x.shape[2] % 32 == 0 and x.shape[3] % 32 == 0, "Width and Height aren't divisible by 32!"
+        c4, c6 = self.forward_prefix(x)
+        return self.forward_suffix(c4, c6)
+
+    # fixed layer schedule (no branching on the layer index) --> the graph can be captured by torch.compile/torch.jit.script
+    def forward_prefix(self, x):
+        # layers 0-6, the ones we freeze when we fine-tune the pretrained weights (see FROZEN_LAYERS)
+        x = self.backbone[0](x)
+        x = self.backbone[1](x)
+        x = self.backbone[2](x)
+        x = self.backbone[3](x)
+        c4 = self.backbone[4](x) # out of the 2nd C3 block
+        x = self.backbone[5](c4)
+        c6 = self.backbone[6](x) # out of the 3rd C3 block
+        return c4, c6
+
+    def forward_suffix(self, c4, c6):
+        # layers 7-9: 'c6' is both the input of the 7th layer and a skip connection
+        x = self.backbone[7](c6)
+        x = self.backbone[8](x)
+        x = self.backbone[9](x)
+        return x, [c4, c6]
+
+######################################################### NECK ###############################################################
+class Neck(nn.Module):
+    """
+    Parameters:
+        first_out (int): the same 'first_out' of the backbone
+        depth_multiple (float): it scales the depth (3) of the C3 blocks of the official YOLOv5 neck.
+                                If None we keep our original depth (2)
+    """
+    def __init__(self, first_out=48, depth_multiple=None):
+        super().__init__()
+        self.neck = nn.ModuleList()
+        self.first_out = first_out
+        depth = 2 if depth_multiple is None else scaled_depth(3, depth_multiple)
+        self.neck += [
+            CBL(in_channels=self.first_out*16, out_channels=self.first_out*8, kernel_size=1, stride=1, padding=0),
+            C3(in_channels=self.first_out*16, out_channels=self.first_out*8, width_multiple=0.25, depth=depth, backbone=False),
+            CBL(in_channels=self.first_out*8, out_channels=self.first_out*4, kernel_size=1, stride=1, padding=0),
+            C3(in_channels=self.first_out*8, out_channels=self.first_out*4, width_multiple=0.25, depth=depth, backbone=False),
+            CBL(in_channels=self.first_out*4, out_channels=self.first_out*4, kernel_size=3, stride=2, padding=1),
+            C3(in_channels=self.first_out*8, out_channels=self.first_out*8, width_multiple=0.5, depth=depth, backbone=False),
+            CBL(in_channels=self.first_out*8, out_channels=self.first_out*8, kernel_size=3, stride=2, padding=1),
+            C3(in_channels=self.first_out*16, out_channels=self.first_out*16, width_multiple=0.5, depth=depth, backbone=False)
+        ]
+        # a static upsampling module instead of building a new torchvision 'Resize' at each call
+        self.upsample = nn.Upsample(scale_factor=2, mode="nearest")
+    
+    def forward(self, x, backbone_connection: List[torch.Tensor]):
+        # same computation as iterating over the layers, but with a fixed schedule (no isinstance checks
+        # nor index membership tests) so that the forward is friendly to torch.compile and torch.jit.script
+        n0 = self.neck[0](x)
+        x = torch.cat([self.upsample(n0), backbone_connection[1]], dim=1)
+        x = self.neck[1](x)
+        n2 = self.neck[2](x)
+        x = torch.cat([self.upsample(n2), backbone_connection[0]], dim=1)
+        out_small = self.neck[3](x) # P3/8
+        x = torch.cat([self.neck[4](out_small), n2], dim=1)
+        out_medium = self.neck[5](x) # P4/16
+        x = torch.cat([self.neck[6](out_medium), n0], dim=1)
+        out_large = self.neck[7](x) # P5/32
+        return [out_small, out_medium, out_large]
+
+######################################################### HEADs ##############################################################
+class SimpleHead(nn.Module):
+    def __init__(self, nc=3, ch=()):  # detection layer
+        super(SimpleHead, self).__init__()
+        self.nc = nc  # number of classes
+        self.nl = len(ANCHORS)  # number of detection layers
+        self.naxs = len(ANCHORS[0])
+
+        # https://pytorch.org/docs/stable/generated/torch.nn.Module.html command+f register_buffer
+        # has the same result as self.anchors = anchors but, it's a way to register a buffer (make
+        # a variable available in runtime) that should not be considered a model parameter
+        self.stride = STRIDE
+
+        # anchors are divided by the stride (anchors_for_head_1/8, anchors_for_head_1/16 etc.)
+        anchors_ = torch.tensor(ANCHORS).float().view(self.nl, -1, 2) / torch.tensor(self.stride).repeat(6, 1).T.reshape(3, 3, 2)
+        self.register_buffer('anchors', anchors_)  # shape(nl,na,2)
+
+        self.out_convs = nn.ModuleList()
+        for in_channels in ch:
+            self.out_convs += [
+                nn.Conv2d(in_channels=in_channels, out_channels=(5+self.nc) * self.naxs, kernel_size=1)
+            ]
+
+    def forward(self, x: List[torch.Tensor]):
+        outputs = []
+        for i, out_conv in enumerate(self.out_convs):
+            # performs out_convolution
+            out = out_conv(x[i])
+
+            bs, _, grid_y, grid_x = out.shape
+            # reshaping output to be (bs, n_scale_predictions, n_grid_y, n_grid_x, 5 + num_classes)
+            # why .permute? Here https://github.com/ultralytics/yolov5/issues/10524#issuecomment-1356822063
+            outputs.append(out.view(bs, self.naxs, (5+self.nc), grid_y, grid_x).permute(0, 1, 3, 4, 2).contiguous())
+        
+        return outputs
+
+# a BASIC convolutional block which computes also Normalization and Activation afterwards
+class BaseConv(nn.Module):
+	"""A Convolution2d -> Normalization -> Activation"""
+	def __init__(self, in_channels, out_channels, ksize, stride, padding=None, groups=1, bias=False, norm="bn", act="silu"):
+		super().__init__()
+		pad = (ksize - 1) // 2 if padding is None else padding
+		self.conv = nn.Conv2d(in_channels, out_channels, kernel_size=ksize, stride=stride, padding=pad, groups=groups, bias=bias,)
+		self.norm = nn.BatchNorm2d(out_channels, eps=1e-3, momentum=0.03)
+		self.act = nn.SiLU(inplace=True)
+	def forward(self, x):
+		# normalization and activation are always present here (no 'is None' branches to capture)
+		return self.act(self.norm(self.conv(x)))
+
+# this is the implementation of the Decoupled Head (an alternative to the above "SimpleHead")
+class DecoupledHead(nn.Module):
+    def __init__(self, nc=3, ch=()):  # detection layer
+        super(DecoupledHead, self).__init__()
+        self.nc = nc  # number of classes
+        self.nl = len(ANCHORS)  # number of detection layers
+        self.naxs = len(ANCHORS[0])
+        self.stride = STRIDE
+        anchors_ = torch.tensor(ANCHORS).float().view(self.nl, -1, 2) / torch.tensor(self.stride).repeat(6, 1).T.reshape(3, 3, 2)
+        self.register_buffer('anchors', anchors_)  # shape(nl,na,2)
+        
+        self.stems = nn.ModuleList() # stem layer performs a sort of compression mechanism
+        self.cls_convs = nn.ModuleList() # block to extract features for the CLASSIFICATION HEAD
+        self.cls_preds = nn.ModuleList()
+        self.reg_convs = nn.ModuleList() # block to extract features for the REGRESSION HEAD
+        self.reg_preds = nn.ModuleList()
+        self.obj_preds = nn.ModuleList()
+        for i in range(len(ch)): # for each layer
+            self.stems.append(BaseConv(ch[i], ch[0], ksize=1, stride=1))
+            self.cls_convs.append(nn.Sequential(*[BaseConv(ch[0], ch[0], ksize=3, stride=1),
+                                                  BaseConv(ch[0], ch[0], ksize=3, stride=1),]
+                                               )
+                                 )
+            self.cls_preds.append(nn.Conv2d(ch[0], self.nc * self.naxs, kernel_size=(1, 1), stride=(1, 1), padding=0))
+            self.reg_convs.append(nn.Sequential(*[BaseConv(ch[0], ch[0], ksize=3, stride=1),
+                                                  BaseConv(ch[0], ch[0], ksize=3, stride=1),]
+                                               )
+                                 )
+            self.reg_preds.append(nn.Conv2d(ch[0], self.naxs * 4, kernel_size=(1, 1), stride=(1, 1), padding=0))
+            self.obj_preds.append(nn.Conv2d(ch[0], self.naxs * 1, kernel_size=(1, 1), stride=(1, 1), padding=0))
+
+    def forward(self, inputs: List[torch.Tensor]):
+        outputs = []
+        k = 0
+        # zipping the module lists (instead of indexing them with 'k') keeps the forward scriptable
+        for stem, cls_conv, cls_pred, reg_conv, reg_pred, obj_pred in zip(self.stems, self.cls_convs, self.cls_preds, self.reg_convs, self.reg_preds, self.obj_preds):
+            x = stem(inputs[k])
+            k += 1
+            cls_x = x
+            reg_x = x
+
+            cls_feat = cls_conv(cls_x)
+            cls_output = cls_pred(cls_feat)
+            reg_feat = reg_conv(reg_x)
+            reg_output = reg_pred(reg_feat)
+            obj_output = obj_pred(reg_feat)
+            # the order of each "grid" output is objectness, bboxes and finally the predicted classes
+            output = torch.cat([reg_output, obj_output, cls_output], 1)
+            
+            bs, _, grid_y, grid_x = output.shape
+            output = output.view(bs, self.naxs, (5+self.nc), grid_y, grid_x).permute(0, 1, 3, 4, 2).contiguous()
+            outputs.append(output)
+        return outputs
+##############################################################################################################################
+
+################################################# ARCHITECTURE REGISTRY ######################################################
+# Every backbone/neck/head combination must speak the same "language":
+#   - backbone(x) --> (P5 features, [P3 features, P4 features]) exactly like 'Backbone'
+#   - neck(x, backbone_connection) --> [P3, P4, P5] exactly like 'Neck'
+#   - head(features) --> list of (bs, 3, grid_y, grid_x, 5 + num_classes) tensors (and it exposes 'anchors', 'stride' and 'nl' for YOLO_Loss)
+# The alternative modules of 'other_architecures' are wrapped by the following adapters.
+class DarknetBackbone(nn.Module):
+    def __init__(self, depths, channels):
+        super().__init__()
+        self.darknet = DarknetCSP(depths=depths, channels=channels, out_features=("stage2", "stage3", "stage4"))
+
+    def forward(self, x):
+        assert x.shape[2] % 32 == 0 and x.shape[3] % 32 == 0, "Width and Height aren't divisible by 32!"
+        c3, c4, c5 = self.darknet(x)
+        return c5, [c3, c4]
+
+class PAFPNNeck(nn.Module):
+    def __init__(self, fpn):
+        super().__init__()
+        self.fpn = fpn
+
+    def forward(self, x, backbone_connection: List[torch.Tensor]):
+        return list(self.fpn([backbone_connection[0], backbone_connection[1], x]))
+
+class YOLOXHead(nn.Module):
+    def __init__(self, nc=3, ch=()):
+        super(YOLOXHead, self).__init__()
+        self.nc = nc  # number of classes
+        self.nl = len(ANCHORS)  # number of detection layers
+        self.naxs = len(ANCHORS[0])
+        self.stride = STRIDE
+        anchors_ = torch.tensor(ANCHORS).float().view(self.nl, -1, 2) / torch.tensor(self.stride).repeat(6, 1).T.reshape(3, 3, 2)
+        self.register_buffer('anchors', anchors_)  # shape(nl,na,2)
+        self.yolox = YOLOX_DecoupledHead(num_classes=nc, n_anchors=self.naxs, in_channels=list(ch))
+
+    def forward(self, x: List[torch.Tensor]):
+        outputs = []
+        for out in self.yolox(x):
+            # the YOLOX head concatenates [reg (naxs*4), obj (naxs), cls (naxs*nc)] along the channels:
+            # we regroup them anchor by anchor --> (bs, n_scale_predictions, n_grid_y, n_grid_x, 5 + num_classes)
+            bs, _, grid_y, grid_x = out.shape
+            reg = out[:, :self.naxs*4].view(bs, self.naxs, 4, grid_y, grid_x)
+            obj = out[:, self.naxs*4:self.naxs*5].view(bs, self.naxs, 1, grid_y, grid_x)
+            cls = out[:, self.naxs*5:].view(bs, self.naxs, self.nc, grid_y, grid_x)
+            outputs.append(torch.cat([reg, obj, cls], dim=2).permute(0, 1, 3, 4, 2).contiguous())
+        return outputs
+
+# DarkNet configurations --> (depths, channels), see the docstring of 'DarknetCSP'
+DARKNET_CONFIGS = {
+    "darknet_tiny" : ((1, 3, 3, 1), (24, 48, 96, 192, 384)),
+    "darknet_small" : ((2, 6, 6, 2), (32, 64, 128, 256, 512)),
+    "darknet_base" : ((3, 9, 9, 3), (64, 128, 256, 512, 1024)),
+    "darknet_large" : ((4, 12, 12, 4), (64, 128, 256, 512, 1024)),
+}
+
+# each builder returns the module and the number of channels of its three outputs (P3, P4, P5)
+def build_yolov5_backbone(hparams):
+    first_out = scaled_first_out(hparams)
+    return Backbone(first_out, hparams.depth_multiple), (first_out*4, first_out*8, first_out*16)
+
+def build_darknet_backbone(name):
+    def builder(hparams):
+        depths, channels = DARKNET_CONFIGS[name]
+        return DarknetBackbone(depths, channels), tuple(channels[2:])
+    return builder
+
+def build_yolov5_neck(hparams, in_channels):
+    # the YOLOv5 neck is parametrized by 'first_out' and needs (4, 8, 16) * first_out input channels
+    first_out = in_channels[0] // 4
+    assert tuple(in_channels) == (first_out*4, first_out*8, first_out*16), f"The YOLOv5 neck can't be attached to a backbone with {in_channels} channels!"
+    return Neck(first_out, hparams.depth_multiple), tuple(in_channels)
+
+def build_pafpn_csp_neck(hparams, in_channels):
+    return PAFPNNeck(PA_FPN_CSP(in_channels=tuple(in_channels))), tuple(in_channels)
+
+def build_pafpn_al_neck(hparams, in_channels):
+    return PAFPNNeck(PA_FPN_AL(in_channels=tuple(in_channels))), tuple(in_channels)
+
+BACKBONES = {"yolov5" : build_yolov5_backbone, **{name : build_darknet_backbone(name) for name in DARKNET_CONFIGS}}
+NECKS = {"yolov5" : build_yolov5_neck, "pafpn_csp" : build_pafpn_csp_neck, "pafpn_al" : build_pafpn_al_neck}
+HEADS = {"simple" : SimpleHead, "decoupled" : DecoupledHead, "yolox" : YOLOXHead}
+
+def build_architecture(hparams):
+    """ Builds the (backbone, neck, head) combination selected by 'hparams.backbone', 'hparams.neck' and 'hparams.head'. """
+    for kind, name, registry in [("backbone", hparams.backbone, BACKBONES), ("neck", hparams.neck, NECKS), ("head", hparams.head, HEADS)]:
+        if name not in registry:
+            raise ValueError(f"Unknown {kind} '{name}', choose one among {list(registry.keys())}")
+    backbone, backbone_channels = BACKBONES[hparams.backbone](hparams)
+    neck, neck_channels = NECKS[hparams.neck](hparams, backbone_channels)
+    head = HEADS[hparams.head](nc=hparams.num_classes, ch=neck_channels)
+    neck.out_channels = tuple(neck_channels) # (P3, P4, P5) channels, e.g. for the feature imitation of the distillation
+    return backbone, neck, head
+##############################################################################################################################
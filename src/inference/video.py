@@ -0,0 +1,183 @@
+import torch
+import torch.nn.functional as F
+from collections import Counter
+from .box_ops import box_convert, pairwise_box_iou
+
+########################################################### TRACKER ##########################################################
+# SORT-style tracker: each track is a constant-velocity Kalman filter on (xc, yc, w, h) and the detections of the keyframes
+# are associated to the tracks by (same class) IoU. All the tracks are updated together with batched tensors on CPU.
+# The noise of the filter is proportional to the size of the box (like in DeepSORT), so it doesn't depend on the image size.
+class BoxTracker:
+    def __init__(self, iou_threshold=0.3, max_misses=2, std_position=1/20, std_velocity=1/160, score_decay=0.95):
+        """
+        Parameters:
+            iou_threshold (float): minimum IoU between a predicted track and a detection to associate them
+            max_misses (int): a track is removed after this number of consecutive keyframes without a detection
+            std_position/std_velocity (float): standard deviations of the noise, relative to the size of the box
+            score_decay (float): the score of a track is multiplied by it for every frame without a detection
+        """
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.std_position = std_position
+        self.std_velocity = std_velocity
+        self.score_decay = score_decay
+        self.F = torch.eye(8)
+        self.F[:4, 4:] = torch.eye(4) # x(t+1) = x(t) + v(t)
+        self.reset()
+
+    def reset(self):
+        self.x = torch.zeros((0, 8)) # state: (xc, yc, w, h, vxc, vyc, vw, vh)
+        self.P = torch.zeros((0, 8, 8)) # covariance
+        self.labels = torch.zeros(0)
+        self.scores = torch.zeros(0)
+        self.misses = torch.zeros(0, dtype=torch.long)
+
+    def __len__(self):
+        return self.x.shape[0]
+
+    def noise(self, std):
+        # diagonal covariance (T, 8, 8) or (T, 4, 4) with standard deviations proportional to (w, h, w, h) of each track
+        size = self.x[:, 2:4].repeat(1, 2)
+        return torch.diag_embed(torch.cat([(s * size) ** 2 for s in std], dim=-1))
+
+    def boxes(self):
+        """ The tracks as detections --> (T, 6) with [class, score, x1, y1, x2, y2]. """
+        return torch.cat([self.labels.unsqueeze(-1), self.scores.unsqueeze(-1), box_convert(self.x[:, :4], "yolo", "corners")], dim=-1)
+
+    def predict(self):
+        """ Moves all the tracks to the next frame. """
+        self.x = self.x @ self.F.T
+        self.x[:, 2:4].clamp_(min=1) # the boxes can't collapse
+        self.P = self.F @ self.P @ self.F.T + self.noise((self.std_position, self.std_velocity))
+        self.scores = self.scores * self.score_decay
+        return self.boxes()
+
+    def match(self, detections):
+        # greedy association (highest IoU first) of the tracks with the detections of the same class
+        iou = pairwise_box_iou(self.boxes()[:, 2:], detections[:, 2:])
+        iou[self.labels.unsqueeze(-1) != detections[:, 0].unsqueeze(0)] = 0
+        matches = []
+        while iou.numel() > 0:
+            value, idx = iou.flatten().max(dim=0)
+            if value < self.iou_threshold:
+                break
+            t, d = divmod(int(idx), iou.shape[1])
+            matches.append((t, d))
+            iou[t, :] = 0
+            iou[:, d] = 0
+        return matches
+
+    def update(self, detections):
+        """ Kalman update of the tracks with the detections (n, 6) of a keyframe: new tracks are created, the lost ones are removed. """
+        # the NMS gives a 1-D 'torch.tensor([])' for a frame without detections
+        detections = detections.detach().float().cpu().reshape(-1, 6)
+        matches = self.match(detections)
+        tracks = torch.tensor([t for t, _ in matches], dtype=torch.long)
+        matched = torch.tensor([d for _, d in matches], dtype=torch.long)
+        if len(matches) > 0:
+            z = box_convert(detections[matched, 2:6], "corners", "yolo")
+            P = self.P[tracks]
+            S = P[:, :4, :4] + self.noise((self.std_position,))[tracks] # innovation covariance
+            K = torch.linalg.solve(S, P[:, :4, :]).transpose(1, 2) # Kalman gain (P and S are symmetric)
+            self.x[tracks] = self.x[tracks] + (K @ (z - self.x[tracks, :4]).unsqueeze(-1)).squeeze(-1)
+            self.P[tracks] = P - K @ P[:, :4, :]
+            self.scores[tracks] = detections[matched, 1]
+        self.misses += 1
+        self.misses[tracks] = 0
+        keep = self.misses <= self.max_misses
+        self.x, self.P, self.labels, self.scores, self.misses = self.x[keep], self.P[keep], self.labels[keep], self.scores[keep], self.misses[keep]
+
+        # the detections without a track start a new one (still, with a large uncertainty)
+        new = torch.ones(detections.shape[0], dtype=torch.bool)
+        new[matched] = False
+        if new.any():
+            z = box_convert(detections[new, 2:6], "corners", "yolo")
+            size = z[:, 2:4].repeat(1, 2)
+            P = torch.diag_embed(torch.cat([(2 * self.std_position * size) ** 2, (10 * self.std_velocity * size) ** 2], dim=-1))
+            self.x = torch.cat([self.x, torch.cat([z, torch.zeros_like(z)], dim=-1)])
+            self.P = torch.cat([self.P, P])
+            self.labels = torch.cat([self.labels, detections[new, 0]])
+            self.scores = torch.cat([self.scores, detections[new, 1]])
+            self.misses = torch.cat([self.misses, torch.zeros(int(new.sum()), dtype=torch.long)])
+##############################################################################################################################
+
+######################################################## VIDEO INFERENCE #####################################################
+def thumbnail(img, size=32):
+    # tiny gray version of the frame (1, C, H, W) used to detect the motion and the scene changes
+    return F.adaptive_avg_pool2d(img.float().mean(dim=-3, keepdim=True), size).flatten().cpu()
+
+class VideoDetector:
+    """
+    Video inference: the detector runs only on the keyframes, in the frames in between the boxes are propagated by the
+    BoxTracker (on CPU). A frame is a keyframe if (in this order):
+        - "scene_change": it is too different from the last keyframe (the tracks are also reset)
+        - "motion": it is different enough from the last keyframe
+        - "interval": 'keyframe_interval' frames have passed since the last keyframe
+    """
+    TRIGGERS = ("first", "scene_change", "motion", "interval")
+
+    def __init__(self, detector, keyframe_interval=None, motion_threshold=None, scene_change_threshold=None, tracker=None,
+                 conf_threshold=None, iou_threshold=None, max_detections=50, detection_log=None):
+        # URBE_Perception is also accepted (the detector is one of its modules)
+        self.detector = getattr(detector, "detector", detector)
+        config = self.detector.config
+        self.keyframe_interval = config.keyframe_interval if keyframe_interval is None else keyframe_interval
+        self.motion_threshold = config.motion_threshold if motion_threshold is None else motion_threshold
+        self.scene_change_threshold = config.scene_change_threshold if scene_change_threshold is None else scene_change_threshold
+        self.tracker = tracker if tracker is not None else BoxTracker()
+        self.conf_threshold = conf_threshold
+        self.iou_threshold = iou_threshold
+        self.max_detections = max_detections
+        self.detection_log = detection_log # DetectionLogWriter which receives the boxes of every frame (also the tracked ones)
+        # it keeps growing across the videos (the frame ids of the log must be increasing): a reopened log continues after its last frame
+        self.frame_id = detection_log.next_frame_id() if detection_log is not None else 0
+        self.reset()
+
+    def reset(self):
+        """ To be called before a new video. """
+        self.tracker.reset()
+        self.key_thumbnail = None
+        self.since_keyframe = 0
+        self.stats = Counter() # trigger --> number of frames ("tracked" for the frames without the detector)
+
+    def keyframe_trigger(self, thumb):
+        if self.key_thumbnail is None:
+            return "first"
+        difference = (thumb - self.key_thumbnail).abs().mean()
+        if difference > self.scene_change_threshold:
+            return "scene_change"
+        elif difference > self.motion_threshold:
+            return "motion"
+        elif self.since_keyframe >= self.keyframe_interval:
+            return "interval"
+        return None
+
+    def __call__(self, img, timestamp=None):
+        """
+        Parameters:
+            img (tensor): one preprocessed frame (1, C, img_size, img_size) on the device of the detector
+            timestamp (float): time of the frame in seconds (only for the detection log)
+        Returns:
+            tuple: (detections (n, 6) on CPU with [class, score, x1, y1, x2, y2], trigger of the keyframe or None)
+        """
+        thumb = thumbnail(img)
+        trigger = self.keyframe_trigger(thumb)
+        if trigger is None:
+            boxes = self.tracker.predict()
+        else:
+            if trigger == "scene_change":
+                self.tracker.reset()
+            boxes = self.detector.detect(img, self.conf_threshold, self.iou_threshold, self.max_detections)[0].float().cpu().reshape(-1, 6)
+            self.tracker.predict()
+            self.tracker.update(boxes)
+            self.key_thumbnail = thumb
+            self.since_keyframe = 0
+        self.since_keyframe += 1
+        self.stats[trigger if trigger is not None else "tracked"] += 1
+        if self.detection_log is not None:
+            # the writer can also be shared with other VideoDetectors: we never go back before its last frame
+            self.frame_id = max(self.frame_id, self.detection_log.next_frame_id())
+            self.detection_log.append([self.frame_id], [boxes], [timestamp if timestamp is not None else float("nan")])
+        self.frame_id += 1
+        return boxes, trigger
+##############################################################################################################################
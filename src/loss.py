@@ -1,28 +1,29 @@
 import torch
 import torch.nn as nn
-import math
+from .inference.box_ops import box_iou
+from .inference.network import STRIDE
 
 ####################################################### UTILS ####################################################################
 ##################################################################################################################################
 # these two functions are partially taken form https://github.com/aladdinpersson/Machine-Learning-Collection
 
 # it is only needed during the 'targets transformation function'
-def iou_width_height(gt_box, anchors, strided_anchors=True, stride=[8, 16, 32]):
+def iou_width_height(gt_box, anchors, strided_anchors=True, stride=[8, 16, 32], img_size=640):
     """
     Parameters:
         gt_box (tensor): width and height of the ground truth box
         anchors (tensor): lists of anchors containing width and height
         strided_anchors (bool): if the anchors are divided by the stride or not
+        img_size (int): resolution of the input images (the anchors are normalized by it, like the gt_box)
     Returns:
         tensor: Intersection over union between the gt_box and each of the n-anchors
     """
-    anchors = anchors.float().to("cuda")
-    anchors /= 640
+    # (not in-place: 'anchors' could already be a float tensor on the same device, and we must not modify it)
+    anchors = anchors.float().to(gt_box.device) / img_size
     if strided_anchors:
-        anchors = anchors.reshape(9, 2) * torch.tensor(stride).repeat(6, 1).T.reshape(9, 2).to("cuda")
+        anchors = anchors.reshape(9, 2) * torch.tensor(stride).repeat(6, 1).T.reshape(9, 2).to(gt_box.device)
     else:
         anchors = anchors.reshape(9, 2)
-    anchors = anchors.to("cuda")
     
     intersection = torch.min(gt_box[..., 0], anchors[..., 0]) * torch.min(
         gt_box[..., 1], anchors[..., 1]
@@ -33,7 +34,7 @@ def iou_width_height(gt_box, anchors, strided_anchors=True, stride=[8, 16, 32]):
     return intersection / union
 
 # added the possibility of computing also GIoU, DIoU and CIoU --> using only GIoU is the best choice!
-# we only use this function for the loss during training
+# we only use this function for the loss during training (the box math is in 'inference/box_ops.py')
 def intersection_over_union(boxes_preds, boxes_labels, box_format="yolo", GIoU=False, DIoU=False, CIoU=False, eps=1e-7):
     """
     This function calculates intersection over union (iou) given pred boxes
@@ -49,73 +50,35 @@ def intersection_over_union(boxes_preds, boxes_labels, box_format="yolo", GIoU=F
         eps (float): for numerical stability
 
     Returns:
-        tensor: Intersection over union for all examples
+        tensor: Intersection over union for all examples (BATCH_SIZE, 1)
     """
-    if box_format == "yolo":
-        box1_x1 = boxes_preds[..., 0:1] - (boxes_preds[..., 2:3]/2)
-        box1_y1 = boxes_preds[..., 1:2] - (boxes_preds[..., 3:4]/2)
-        box1_x2 = boxes_preds[..., 0:1] + (boxes_preds[..., 2:3]/2)
-        box1_y2 = boxes_preds[..., 1:2] + (boxes_preds[..., 3:4]/2)
-        box2_x1 = boxes_labels[..., 0:1] - (boxes_labels[..., 2:3]/2)
-        box2_y1 = boxes_labels[..., 1:2] - (boxes_labels[..., 3:4]/2)
-        box2_x2 = boxes_labels[..., 0:1] + (boxes_labels[..., 2:3]/2)
-        box2_y2 = boxes_labels[..., 1:2] + (boxes_labels[..., 3:4]/2)
-        
-    elif box_format == "coco":
-        box1_x1 = boxes_preds[..., 0:1]
-        box1_y1 = boxes_preds[..., 1:2] 
-        box1_x2 = boxes_preds[..., 0:1] + boxes_preds[..., 2:3] 
-        box1_y2 = boxes_preds[..., 1:2] + boxes_preds[..., 3:4]
-        box2_x1 = boxes_labels[..., 0:1] 
-        box2_y1 = boxes_labels[..., 1:2] 
-        box2_x2 = boxes_labels[..., 0:1] + boxes_labels[..., 2:3]
-        box2_y2 = boxes_labels[..., 1:2] + boxes_labels[..., 3:4]
+    iou_type = "diou" if DIoU else "ciou" if CIoU else "giou" if GIoU else "iou"
+    return box_iou(boxes_preds, boxes_labels, box_format=box_format, iou_type=iou_type, eps=eps).unsqueeze(-1)
+##################################################################################################################################
 
-    else:
-        box1_x1 = boxes_preds[..., 0:1]
-        box1_y1 = boxes_preds[..., 1:2]
-        box1_x2 = boxes_preds[..., 2:3]
-        box1_y2 = boxes_preds[..., 3:4]
-        box2_x1 = boxes_labels[..., 0:1]
-        box2_y1 = boxes_labels[..., 1:2]
-        box2_x2 = boxes_labels[..., 2:3]
-        box2_y2 = boxes_labels[..., 3:4]
-
-    w1, h1, w2, h2 = box1_x2 - box1_x1, box1_y2 - box1_y1, box2_x2 - box2_x1, box2_y2 - box2_y1
-    
-    # Intersection area
-    # clamp(0) is for the cases when they do not intersect
-    inter = (torch.min(box1_x2, box2_x2) - torch.max(box1_x1, box2_x1)).clamp(0) * \
-            (torch.min(box1_y2, box2_y2) - torch.max(box1_y1, box2_y1)).clamp(0)
-
-    # Union Area
-    union = (w1 * h1) + (w2 * h2) - inter + eps
-
-    iou = inter / union
-
-    if GIoU or DIoU or CIoU:
-        cw = torch.max(box1_x2, box2_x2) - torch.min(box1_x1, box2_x1)  # convex (smallest enclosing box) width
-        ch = torch.max(box1_y2, box2_y2) - torch.min(box1_y1, box2_y1)
-        if CIoU or DIoU:
-            c2 = cw ** 2 + ch ** 2 + eps  # convex diagonal squared
-            rho2 = ((box2_x1 + box2_x2 - box1_x1 - box1_x2) ** 2 +
-                    (box2_y1 + box2_y2 - box1_y1 - box1_y2) ** 2) / 4  # center distance squared
-            if DIoU:
-                return iou - rho2 / c2  # DIoU
-            elif CIoU:
-                v = (4 / math.pi ** 2) * torch.pow(torch.atan(w2 / h2) - torch.atan(w1 / h1), 2)
-                with torch.no_grad():
-                    alpha = v / (v - iou + (1 + eps))
-                return iou - (rho2 / c2 + v * alpha)  # CIoU
+# TARGET CACHE: without augmentation the targets of an image are always the same, so (when 'hparams.target_cache' is set)
+# the sparse assignments of 'YOLO_Loss.assign_targets' are computed only the first time and then reused every epoch.
+def anchors_key(anchors):
+    return tuple(anchors.detach().float().cpu().flatten().tolist())
+
+class TargetCache:
+    """
+    Sparse target assignments keyed by (image id, grid sizes, anchors): the grid sizes follow the image size, so if the
+    image size or the anchors change the old entries are simply never hit again (and the new ones are computed).
+    """
+    def __init__(self):
+        self.assignments = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, image_id, bboxes, anchors, key_anchors, grid_sizes, num_anchors_per_scale=3):
+        key = (image_id, tuple(grid_sizes), key_anchors)
+        if key in self.assignments:
+            self.hits += 1
         else:
-            c_area = cw * ch + eps  # convex area
-            return iou - (c_area - union) / c_area  # GIoU
-        c_area = cw * ch + eps  # convex height
-        return iou - (c_area - union) / c_area  # GIoU https://arxiv.org/pdf/1902.09630.pdf
-    
-    else: # simple IoU
-        return iou 
-##################################################################################################################################
+            self.misses += 1
+            self.assignments[key] = YOLO_Loss.assign_targets(bboxes, anchors, grid_sizes, num_anchors_per_scale)
+        return self.assignments[key]
 
 class YOLO_Loss:
     
@@ -124,10 +87,19 @@ class YOLO_Loss:
     
     @staticmethod
     # this function deal with one image at a time
-    def transform_targets(input_tensor, bboxes, anchors, strides, num_anchors_per_scale=3):
-        targets = [torch.zeros((num_anchors_per_scale, input_tensor[i].shape[2], input_tensor[i].shape[3], 6))
-                   for i in range(len(strides))]
-        
+    def assign_targets(bboxes, anchors, grid_sizes, num_anchors_per_scale=3):
+        """
+        Anchor assignment of the ground truth boxes of one image (sparse version of the target grids).
+        Parameters:
+            bboxes (tensor): (max_labels_batch, 5) with [class, xc, yc, w, h] (the padding rows are all zeros)
+            anchors (tensor): anchors for the 'iou_width_height' function
+            grid_sizes (list): (grid_y, grid_x) of each scale (they also give the resolution of the images, see the resolution schedule)
+        Returns:
+            tuple: (n, 5) int16 tensor with [scale, anchor, i, j, class] and (n, 4) float tensor with the box w.r.t. the cell,
+                   one row for each positive cell
+        """
+        bboxes = bboxes.cpu() # lots of tiny operations: they are much faster on the cpu
+        img_size = grid_sizes[0][1] * STRIDE[0] # the active resolution of the batch
         # bboxes is relative to a single batch --> (max_labels_batch, 5)
         classes = bboxes[:, 0].tolist()
         bboxes = bboxes[:, 1:]
@@ -138,32 +110,59 @@ class YOLO_Loss:
                 bboxes = bboxes[:i]
                 break
 
+        taken = set() # (scale, anchor, i, j) cells already assigned to an object
+        indices, boxes = [], []
         for idx, box in enumerate(bboxes):
-            iou_anchors = iou_width_height(box[2:4], anchors) # we calculate the iou for the particular box and all the anchors
-            anchor_indices = iou_anchors.argsort(descending=True, dim=0) # which anchors are the best?
+            iou_anchors = iou_width_height(box[2:4], anchors, img_size=img_size) # we calculate the iou for the particular box and all the anchors
+            anchor_indices = iou_anchors.argsort(descending=True, dim=0).tolist() # which anchors are the best?
             x, y, width, height = box
             has_anchor = [False] * 3 # we make sure that there is an anchor for each scale for each particular box
             for anchor_idx in anchor_indices: # we iterate starting from the "best ones" first
-                scale_idx = torch.div(anchor_idx, num_anchors_per_scale, rounding_mode="floor") # in this way we know to which scale the anchor belongs to
+                scale_idx = anchor_idx // num_anchors_per_scale # in this way we know to which scale the anchor belongs to
                 anchor_on_scale = anchor_idx % num_anchors_per_scale # which anchor in the particular scale
                 
-                scale_y = input_tensor[int(scale_idx)].shape[2]
-                scale_x = input_tensor[int(scale_idx)].shape[3]
+                scale_y, scale_x = grid_sizes[scale_idx]
                 i, j = int(scale_y * y), int(scale_x * x) # coordinates of the particular cell
-                anchor_taken = targets[scale_idx][anchor_on_scale, i, j, 4]
                 
                 # if the cell at a particular scale is not already taken (by another object) and we didn't pick it yet a cell at the particular scale
-                if not anchor_taken and not has_anchor[scale_idx]:
-                    targets[scale_idx][anchor_on_scale, i, j, 4] = 1 # we say that is "taken"
+                if (scale_idx, anchor_on_scale, i, j) not in taken and not has_anchor[scale_idx]:
+                    taken.add((scale_idx, anchor_on_scale, i, j)) # we say that is "taken"
                     
                     x_cell, y_cell = scale_x * x - j, scale_y * y - i # coordinates of x and y w.r.t. the cell
                     width_cell, height_cell = (width * scale_x, height * scale_y,)
                     
-                    box_coordinates = torch.tensor([x_cell, y_cell, width_cell, height_cell]) # w.r.t. the cell
-                    targets[scale_idx][anchor_on_scale, i, j, 0:4] = box_coordinates
-                    targets[scale_idx][anchor_on_scale, i, j, 5] = int(classes[idx])
+                    indices.append([scale_idx, anchor_on_scale, i, j, int(classes[idx])])
+                    boxes.append([float(x_cell), float(y_cell), float(width_cell), float(height_cell)]) # w.r.t. the cell
                     has_anchor[scale_idx] = True # for this scale and for this particular bbox we have the anchor
+        if len(indices) == 0:
+            return torch.zeros((0, 5), dtype=torch.int16), torch.zeros((0, 4))
+        return torch.tensor(indices, dtype=torch.int16), torch.tensor(boxes)
+
+    @staticmethod
+    def densify_targets(assignments, grid_sizes, device, num_anchors_per_scale=3):
+        """
+        From the sparse assignments of the images of a batch to the dense target grids, directly on 'device'.
+        Returns:
+            list: one (bs, 3, grid_y, grid_x, 6) tensor for each scale with [x, y, w, h, objectness, class] in each cell
+        """
+        targets = [torch.zeros((len(assignments), num_anchors_per_scale, gy, gx, 6), device=device) for gy, gx in grid_sizes]
+        batch_idx = torch.cat([torch.full((len(indices),), b, dtype=torch.long) for b, (indices, _) in enumerate(assignments)]).to(device)
+        if batch_idx.numel() == 0:
+            return targets
+        indices = torch.cat([indices for indices, _ in assignments]).long().to(device)
+        boxes = torch.cat([boxes for _, boxes in assignments]).to(device)
+        for s in range(len(grid_sizes)):
+            mask = indices[:, 0] == s
+            values = torch.cat([boxes[mask], torch.ones_like(boxes[mask][:, :1]), indices[mask][:, 4:5].float()], dim=1)
+            targets[s][batch_idx[mask], indices[mask][:, 1], indices[mask][:, 2], indices[mask][:, 3]] = values
         return targets
+
+    @staticmethod
+    # this function deal with one image at a time
+    def transform_targets(input_tensor, bboxes, anchors, strides, num_anchors_per_scale=3):
+        grid_sizes = [(input_tensor[i].shape[2], input_tensor[i].shape[3]) for i in range(len(strides))]
+        assignment = YOLO_Loss.assign_targets(bboxes, anchors, grid_sizes, num_anchors_per_scale)
+        return [target[0] for target in YOLO_Loss.densify_targets([assignment], grid_sizes, "cpu", num_anchors_per_scale)]
     
     def __init__(self, hparams, anchors, stride, nl):
 
@@ -171,7 +170,8 @@ class YOLO_Loss:
         self.BCE_obj = nn.BCEWithLogitsLoss(pos_weight=torch.tensor(1.0))
         self.sigmoid = nn.Sigmoid()
         
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        # opt-in cache of the targets (it makes sense only if the images are always the same)
+        self.target_cache = TargetCache() if hparams.get("target_cache", False) and not hparams["augmentation"] else None
         
         self.nc = hparams["num_classes"] # number of classes
         self.nl = nl # number of scale/layers
@@ -189,15 +189,35 @@ class YOLO_Loss:
         self.lambda_box = hparams["weight_box"] * (3 / self.nl) # scale to image size and layers
 
         self.balance = YOLO_Loss.BALANCE
+        # all the scales in a single pass (see 'fused_loss')
+        self.fused = hparams.get("fused_loss", False)
 
-    def __call__(self, preds, targets):
+    def build_targets(self, preds, targets, ids=None, anchors=None):
+        """
+        Dense target grids of a batch (on the device of the predictions), through the target cache if enabled.
+        Parameters:
+            targets (tensor): (bs, max_labels_batch, 5) labels of the batch
+            ids (list): ids of the images of the batch (needed by the target cache)
+            anchors (tensor): by default the anchors of the head
+        """
+        grid_sizes = [(p.shape[2], p.shape[3]) for p in preds]
+        assignments = self.build_assignments(grid_sizes, targets, ids, anchors)
+        return YOLO_Loss.densify_targets(assignments, grid_sizes, preds[0].device, self.num_anchors_per_scale)
 
-        # we transform the targets in order to be able to compare them with the predictions output by the model
-        targets = [YOLO_Loss.transform_targets(preds, bboxes, self.anchors, self.S, self.num_anchors_per_scale) for bboxes in targets]
+    def build_assignments(self, grid_sizes, targets, ids=None, anchors=None):
+        # sparse assignments of each image of the batch (see 'assign_targets'), through the target cache if enabled
+        anchors = self.anchors if anchors is None else anchors
+        if self.target_cache is not None and ids is not None:
+            key_anchors = anchors_key(anchors)
+            return [self.target_cache.get(image_id, bboxes, anchors, key_anchors, grid_sizes, self.num_anchors_per_scale) for image_id, bboxes in zip(ids, targets)]
+        return [YOLO_Loss.assign_targets(bboxes, anchors, grid_sizes, self.num_anchors_per_scale) for bboxes in targets]
 
-        t1 = torch.stack([target[0] for target in targets], dim=0).to(self.device, non_blocking=True)
-        t2 = torch.stack([target[1] for target in targets], dim=0).to(self.device, non_blocking=True)
-        t3 = torch.stack([target[2] for target in targets], dim=0).to(self.device, non_blocking=True)
+    def __call__(self, preds, targets, ids=None):
+        if self.fused:
+            return self.fused_loss(preds, targets, ids)
+
+        # we transform the targets in order to be able to compare them with the predictions output by the model
+        t1, t2, t3 = self.build_targets(preds, targets, ids)
         
         # we compute it layer by layer...
         loss = (
@@ -212,7 +232,7 @@ class YOLO_Loss:
         bs = preds.shape[0]
         # originally anchors have shape (3,2) --> 3 set of anchors of width and height
         anchors = anchors.reshape(1, 3, 1, 1, 2)
-        anchors = anchors.to("cuda")
+        anchors = anchors.to(preds.device)
         
         obj = targets[..., 4] == 1
         
@@ -239,8 +259,88 @@ class YOLO_Loss:
         # ================== #
         #   FOR CLASS LOSS   #
         # ================== #
-        tcls = torch.zeros_like(preds[..., 5:][obj], device=self.device) # in order to make it comparable with the predictions, we augment the class field from 1 to 3 --> [0, 0, 0]
+        tcls = torch.zeros_like(preds[..., 5:][obj]) # in order to make it comparable with the predictions, we augment the class field from 1 to 3 --> [0, 0, 0]
         tcls[torch.arange(tcls.size(0)), targets[..., 5][obj].long()] = 1.0  # and we set to one the class to which the object belongs
         lcls = self.BCE_cls(preds[..., 5:][obj], tcls)
 
-        return (self.lambda_box * lbox + self.lambda_obj * lobj + self.lambda_class * lcls) * bs # like in YOLOv5 official code
\ No newline at end of file
+        return (self.lambda_box * lbox + self.lambda_obj * lobj + self.lambda_class * lcls) * bs # like in YOLOv5 official code
+
+    # KNOWLEDGE DISTILLATION (see distillation.py)
+    def distill_loss(self, preds, teacher_preds, temperature=1.0):
+        """
+        Soft targets of a teacher with the same anchors and grids: its objectness probabilities for all the cells and
+        its class probabilities for the cells where it sees an object (the class loss of each cell is weighted by the
+        teacher objectness). Both models' logits are divided by 'temperature' (and the loss is multiplied by its square).
+        """
+        bs = preds[0].shape[0]
+        lobj, lcls = 0, 0
+        for p, t, balance in zip(preds, teacher_preds, self.balance):
+            assert p.shape == t.shape, f"The teacher predictions {tuple(t.shape)} don't match the student ones {tuple(p.shape)}!"
+            t = t.detach().float() / temperature
+            p = p.float() / temperature
+            tobj = t[..., 4].sigmoid()
+            lobj = lobj + nn.functional.binary_cross_entropy_with_logits(p[..., 4], tobj) * balance
+            cell_lcls = nn.functional.binary_cross_entropy_with_logits(p[..., 5:], t[..., 5:].sigmoid(), reduction="none").mean(dim=-1)
+            lcls = lcls + (cell_lcls * tobj).sum() / tobj.sum().clamp(min=1e-6)
+        return (self.lambda_obj * lobj + self.lambda_class * lcls) * bs * temperature ** 2
+
+    # the same loss of '__call__' + 'compute_loss', but computed for all the scales at once
+    def fused_loss(self, preds, targets, ids=None):
+        """
+        All the scales are flattened into one (bs, number of cells, 5 + num_classes) tensor and we directly work with the
+        sparse assignments: the box and class losses only touch the positive cells (no dense targets, no masks), and the
+        objectness loss is one BCE over all the cells where each cell is weighted by the 'balance' of its scale divided
+        by the number of cells of the scale (i.e. the per-scale means of 'compute_loss').
+        NB: when a scale has no positives in the whole batch 'compute_loss' returns NaN, here that scale gives 0.
+        """
+        bs = preds[0].shape[0]
+        device = preds[0].device
+        grid_sizes = [(p.shape[2], p.shape[3]) for p in preds]
+        assignments = self.build_assignments(grid_sizes, targets, ids)
+
+        cells = [self.num_anchors_per_scale * gy * gx for gy, gx in grid_sizes]
+        flat_preds = torch.cat([p.reshape(bs, -1, p.shape[-1]) for p in preds], dim=1)
+        obj_weights = torch.cat([torch.full((c,), self.balance[s] / c) for s, c in enumerate(cells)]).to(device)
+
+        # ======================== #
+        #     POSITIVE CELLS       #
+        # ======================== #
+        batch_idx = torch.cat([torch.full((len(indices),), b, dtype=torch.long) for b, (indices, _) in enumerate(assignments)]).to(device)
+        indices = torch.cat([indices for indices, _ in assignments]).long().to(device)
+        tbox = torch.cat([boxes for _, boxes in assignments]).to(device)
+        scale, anchor, i, j, cls = indices.unbind(dim=1)
+        offsets = torch.tensor([0] + cells[:-1], device=device).cumsum(0)
+        grid_x = torch.tensor([gx for _, gx in grid_sizes], device=device)
+        grid_y = torch.tensor([gy for gy, _ in grid_sizes], device=device)
+        cell = offsets[scale] + (anchor * grid_y[scale] + i) * grid_x[scale] + j # index in the flattened cells
+        num_pos = torch.bincount(scale, minlength=len(preds)).float() # positives of each scale
+
+        tobj = torch.zeros(flat_preds.shape[:2], device=device)
+        lbox, lcls = flat_preds.new_zeros(()).float(), flat_preds.new_zeros(()).float()
+        if batch_idx.numel() > 0:
+            ppos = flat_preds[batch_idx, cell]
+            pxy = (ppos[:, 0:2].sigmoid() * 2) - 0.5
+            pwh = ((ppos[:, 2:4].sigmoid() * 2) ** 2) * self.anchors_d.to(device)[scale, anchor]
+            iou = intersection_over_union(torch.cat((pxy, pwh), dim=-1), tbox, box_format="yolo", GIoU=True).squeeze(-1)
+
+            # ======================== #
+            #   FOR BOX COORDINATES    #
+            # ======================== #
+            lbox = ((1.0 - iou) / num_pos[scale]).sum()
+
+            # ================== #
+            #   FOR CLASS LOSS   #
+            # ================== #
+            tcls = torch.zeros_like(ppos[:, 5:])
+            tcls[torch.arange(tcls.size(0), device=device), cls] = 1.0
+            lcls = (nn.functional.binary_cross_entropy_with_logits(ppos[:, 5:], tcls, reduction="none").sum(dim=1) / (num_pos[scale] * self.nc)).sum()
+
+            tobj[batch_idx, cell] = iou.detach().clamp(0).to(tobj.dtype) # instead of simply having objectness=1 for the targets
+
+        # ======================= #
+        #   FOR OBJECTNESS SCORE  #
+        # ======================= #
+        lobj = (nn.functional.binary_cross_entropy_with_logits(flat_preds[..., 4], tobj, reduction="none") * obj_weights).sum() / bs
+
+        return (self.lambda_box * lbox + self.lambda_obj * lobj + self.lambda_class * lcls) * bs
+
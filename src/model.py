@@ -1,362 +1,101 @@
 import torch
-from torch import optim, nn
+from torch import optim
 from torch.optim.lr_scheduler import ReduceLROnPlateau
-from torchvision.transforms import Resize
-from torchvision.transforms import InterpolationMode
-import wandb
 import pytorch_lightning as pl
 from .loss import YOLO_Loss
+from .distillation import Teacher, feature_adapters, feature_imitation_loss
+from .hyperparameters import Hparams
+from dataclasses import asdict
 import random
-from torchmetrics.detection.mean_ap import MeanAveragePrecision
-from torchvision.ops import batched_nms
-import torchvision.transforms as T
+# the network and the decoding of its predictions live in the lightweight 'inference' package
+# (the blocks, the registries and the YOLOv5 family scaling are imported from there, e.g. 'from src.inference import family_hparams')
+from .inference import URBE_Detector, ANCHORS, STRIDE, FROZEN_LAYERS, make_grids, cells_to_bboxes, non_max_suppression
+# NB: wandb, torchvision.transforms and torchmetrics are imported only where they are used
 
-########################################## BASIC BUILDING BLOCKS ##############################################
-##                                                                                                           ##
-## All these blocks are entirely taken (with just few little changes) from the repo of an italian AI         ##
-## enthusiast who implemented a "personal implementation of YOLOv5". That was exactly what I needed!         ##
-## Thanks to https://github.com/AlessandroMondin/YOLOV5m :)                                                  ##
-##                                                                                                           ##
-###############################################################################################################
-# performs a convolution, a batch_norm and then applies a SiLU activation function
-class CBL(nn.Module):
-    def __init__(self, in_channels, out_channels, kernel_size, stride, padding):
-        super(CBL, self).__init__()
-
-        conv = nn.Conv2d(in_channels, out_channels, kernel_size, stride, padding, bias=False)
-        bn = nn.BatchNorm2d(out_channels, eps=1e-3, momentum=0.03)
-
-        self.cbl = nn.Sequential(
-            conv,
-            bn,
-            # https://pytorch.org/docs/stable/generated/torch.nn.SiLU.html
-            nn.SiLU(inplace=True)
-        )
-
-    def forward(self, x):
-        #print(self.cbl(x).shape)
-        return self.cbl(x)
-
-# which is just a residual block
-class Bottleneck(nn.Module):
-    """
-    Parameters:
-        in_channels (int): number of channel of the input tensor
-        out_channels (int): number of channel of the output tensor
-        width_multiple (float): it controls the number of channels (and weights)
-                                of all the convolutions beside the
-                                first and last one. If closer to 0,
-                                the simpler the modelIf closer to 1,
-                                the model becomes more complex
-    """
-    def __init__(self, in_channels, out_channels, width_multiple=1):
-        super(Bottleneck, self).__init__()
-        c_ = int(width_multiple*in_channels)
-        self.c1 = CBL(in_channels, c_, kernel_size=1, stride=1, padding=0)
-        self.c2 = CBL(c_, out_channels, kernel_size=3, stride=1, padding=1)
-
-    def forward(self, x):
-        return self.c2(self.c1(x)) + x
-
-# kind of CSP backbone (https://arxiv.org/pdf/1911.11929v1.pdf)
-class C3(nn.Module):
-    """
-    Parameters:
-        in_channels (int): number of channel of the input tensor
-        out_channels (int): number of channel of the output tensor
-        width_multiple (float): it controls the number of channels (and weights)
-                                of all the convolutions beside the
-                                first and last one. If closer to 0,
-                                the simpler the modelIf closer to 1,
-                                the model becomes more complex
-        depth (int): it controls the number of times the bottleneck (residual block)
-                        is repeated within the C3 block
-        backbone (bool): if True, self.seq will be composed by bottlenecks 1, if False
-                            it will be composed by bottlenecks 2 (check in the image linked below)
-        https://user-images.githubusercontent.com/31005897/172404576-c260dcf9-76bb-4bc8-b6a9-f2d987792583.png
-
-    """
-    def __init__(self, in_channels, out_channels, width_multiple=1, depth=1, backbone=True):
-        super(C3, self).__init__()
-        c_ = int(width_multiple*in_channels)
-
-        self.c1 = CBL(in_channels, c_, kernel_size=1, stride=1, padding=0)
-        self.c_skipped = CBL(in_channels,  c_, kernel_size=1, stride=1, padding=0)
-        if backbone:
-            self.seq = nn.Sequential(
-                *[Bottleneck(c_, c_, width_multiple=1) for _ in range(depth)]
-            )
-        else:
-            self.seq = nn.Sequential(
-                *[nn.Sequential(
-                    CBL(c_, c_, 1, 1, 0),
-                    CBL(c_, c_, 3, 1, 1)
-                ) for _ in range(depth)]
-            )
-        self.c_out = CBL(c_ * 2, out_channels, kernel_size=1, stride=1, padding=0)
-
-    def forward(self, x):
-        x = torch.cat([self.seq(self.c1(x)), self.c_skipped(x)], dim=1)
-        return self.c_out(x)
-
-# Spatial Pyramid Pooling - Fast (SPPF) layer for YOLOv5 by Glenn Jocher
-class SPPF(nn.Module):
-    def __init__(self, in_channels, out_channels):
-        super(SPPF, self).__init__()
-
-        c_ = int(in_channels//2)
-
-        self.c1 = CBL(in_channels, c_, 1, 1, 0)
-        self.pool = nn.MaxPool2d(kernel_size=5, stride=1, padding=2)
-        self.c_out = CBL(c_ * 4, out_channels, 1, 1, 0)
-
-    def forward(self, x):
-        x = self.c1(x)
-        pool1 = self.pool(x)
-        pool2 = self.pool(pool1)
-        pool3 = self.pool(pool2)
-
-        return self.c_out(torch.cat([x, pool1, pool2, pool3], dim=1))
-
-# in the PANET the C3 block is different: no more CSP but a residual block composed
-# a sequential branch of n SiLUs and a skipped branch with one SiLU
-class C3_NECK(nn.Module):
-    def __init__(self, in_channels, out_channels, width, depth):
-        super(C3_NECK, self).__init__()
-        c_ = int(in_channels*width)
-        self.in_channels = in_channels
-        self.c_ = c_
-        self.out_channels = out_channels
-        self.c_skipped = CBL(in_channels, c_, 1, 1, 0)
-        self.c_out = CBL(c_*2, out_channels, 1, 1, 0)
-        self.silu_block = self.make_silu_block(depth)
-
-    def make_silu_block(self, depth):
-        layers = []
-        for i in range(depth):
-            if i == 0:
-                layers.append(CBL(self.in_channels, self.c_, 1, 1, 0))
-            elif i % 2 == 0:
-                layers.append(CBL(self.c_, self.c_, 3, 1, 1))
-            elif i % 2 != 0:
-                layers.append(CBL(self.c_, self.c_, 1, 1, 0))
-        return nn.Sequential(*layers)
-
-    def forward(self, x):
-        return self.c_out(torch.cat([self.silu_block(x), self.c_skipped(x)], dim=1))
-##############################################################################################################################
-
-
-####################################################### BACKBONE #############################################################
-class Backbone(nn.Module):
-    def __init__(self, first_out=48):
-        super().__init__()
-        self.backbone = nn.ModuleList()
-        self.first_out = first_out
-        self.backbone += [
-            CBL(in_channels=3, out_channels=self.first_out, kernel_size=6, stride=2, padding=2),
-            CBL(in_channels=self.first_out, out_channels=self.first_out*2, kernel_size=3, stride=2, padding=1),
-            C3(in_channels=self.first_out*2, out_channels=self.first_out*2, width_multiple=0.5, depth=2),
-            CBL(in_channels=self.first_out*2, out_channels=self.first_out*4, kernel_size=3, stride=2, padding=1),
-            C3(in_channels=self.first_out*4, out_channels=self.first_out*4, width_multiple=0.5, depth=4),
-            CBL(in_channels=self.first_out*4, out_channels=self.first_out*8, kernel_size=3, stride=2, padding=1),
-            C3(in_channels=self.first_out*8, out_channels=self.first_out*8, width_multiple=0.5, depth=6),
-            CBL(in_channels=self.first_out*8, out_channels=self.first_out*16, kernel_size=3, stride=2, padding=1),
-            C3(in_channels=self.first_out*16, out_channels=self.first_out*16, width_multiple=0.5, depth=2),
-            SPPF(in_channels=self.first_out*16, out_channels=self.first_out*16)
-        ]
-    
-    def forward(self, x):
-        assert x.shape[2] % 32 == 0 and x.shape[3] % 32 == 0, "Width and Height aren't divisible by 32!"
-        backbone_connection = []
-        for idx, layer in enumerate(self.backbone):
-            # takes the out of the 2nd and 3rd C3 block and stores it
-            x = layer(x)
-            if idx in [4, 6]:
-                backbone_connection.append(x)
-        return x, backbone_connection
-
-######################################################### NECK ###############################################################
-class Neck(nn.Module):
-    def __init__(self, first_out=48):
-        super().__init__()
-        self.neck = nn.ModuleList()
-        self.first_out = first_out
-        self.neck += [
-            CBL(in_channels=self.first_out*16, out_channels=self.first_out*8, kernel_size=1, stride=1, padding=0),
-            C3(in_channels=self.first_out*16, out_channels=self.first_out*8, width_multiple=0.25, depth=2, backbone=False),
-            CBL(in_channels=self.first_out*8, out_channels=self.first_out*4, kernel_size=1, stride=1, padding=0),
-            C3(in_channels=self.first_out*8, out_channels=self.first_out*4, width_multiple=0.25, depth=2, backbone=False),
-            CBL(in_channels=self.first_out*4, out_channels=self.first_out*4, kernel_size=3, stride=2, padding=1),
-            C3(in_channels=self.first_out*8, out_channels=self.first_out*8, width_multiple=0.5, depth=2, backbone=False),
-            CBL(in_channels=self.first_out*8, out_channels=self.first_out*8, kernel_size=3, stride=2, padding=1),
-            C3(in_channels=self.first_out*16, out_channels=self.first_out*16, width_multiple=0.5, depth=2, backbone=False)
-        ]
-    
-    def forward(self, x, backbone_connection):
-        neck_connection = []
-        outputs = []
-        for idx, layer in enumerate(self.neck):
-            if idx in [0, 2]:
-                x = layer(x)
-                neck_connection.append(x)
-                x = Resize([x.shape[2]*2, x.shape[3]*2], interpolation=InterpolationMode.NEAREST)(x)
-                x = torch.cat([x, backbone_connection.pop(-1)], dim=1)
-
-            elif idx in [4, 6]:
-                x = layer(x)
-                x = torch.cat([x, neck_connection.pop(-1)], dim=1)
-
-            elif (isinstance(layer, C3_NECK) and idx > 2) or (isinstance(layer, C3) and idx > 2):
-                x = layer(x)
-                outputs.append(x)
-
-            else:
-                x = layer(x)
-        return outputs
-
-######################################################### HEADs ##############################################################
-class SimpleHead(nn.Module):
-    def __init__(self, nc=3, ch=()):  # detection layer
-        super(SimpleHead, self).__init__()
-        self.nc = nc  # number of classes
-        self.nl = len(URBE_Perception.ANCHORS)  # number of detection layers
-        self.naxs = len(URBE_Perception.ANCHORS[0])
-
-        # https://pytorch.org/docs/stable/generated/torch.nn.Module.html command+f register_buffer
-        # has the same result as self.anchors = anchors but, it's a way to register a buffer (make
-        # a variable available in runtime) that should not be considered a model parameter
-        self.stride = URBE_Perception.STRIDE
-
-        # anchors are divided by the stride (anchors_for_head_1/8, anchors_for_head_1/16 etc.)
-        anchors_ = torch.tensor(URBE_Perception.ANCHORS).float().view(self.nl, -1, 2) / torch.tensor(self.stride).repeat(6, 1).T.reshape(3, 3, 2)
-        self.register_buffer('anchors', anchors_)  # shape(nl,na,2)
-
-        self.out_convs = nn.ModuleList()
-        for in_channels in ch:
-            self.out_convs += [
-                nn.Conv2d(in_channels=in_channels, out_channels=(5+self.nc) * self.naxs, kernel_size=1)
-            ]
-
-    def forward(self, x):
-        for i in range(self.nl):
-            # performs out_convolution and stores the result in place
-            x[i] = self.out_convs[i](x[i])
-
-            bs, _, grid_y, grid_x = x[i].shape
-            # reshaping output to be (bs, n_scale_predictions, n_grid_y, n_grid_x, 5 + num_classes)
-            # why .permute? Here https://github.com/ultralytics/yolov5/issues/10524#issuecomment-1356822063
-            x[i] = x[i].view(bs, self.naxs, (5+self.nc), grid_y, grid_x).permute(0, 1, 3, 4, 2).contiguous()
-        
-        return x
-
-# a BASIC convolutional block which computes also Normalization and Activation afterwards
-class BaseConv(nn.Module):
-	"""A Convolution2d -> Normalization -> Activation"""
-	def __init__(self, in_channels, out_channels, ksize, stride, padding=None, groups=1, bias=False, norm="bn", act="silu"):
-		super().__init__()
-		pad = (ksize - 1) // 2 if padding is None else padding
-		self.conv = nn.Conv2d(in_channels, out_channels, kernel_size=ksize, stride=stride, padding=pad, groups=groups, bias=bias,)
-		self.norm = nn.BatchNorm2d(out_channels, eps=1e-3, momentum=0.03)
-		self.act = nn.SiLU(inplace=True)
-	def forward(self, x):
-		if self.norm is None and self.act is None:
-			return self.conv(x)
-		elif self.act is None:
-			return self.norm(self.conv(x))
-		elif self.norm is None:
-			return self.act(self.conv(x))
-		return self.act(self.norm(self.conv(x)))
-
-# this is the implementation of the Decoupled Head (an alternative to the above "SimpleHead")
-class DecoupledHead(nn.Module):
-    def __init__(self, nc=3, ch=()):  # detection layer
-        super(DecoupledHead, self).__init__()
-        self.nc = nc  # number of classes
-        self.nl = len(URBE_Perception.ANCHORS)  # number of detection layers
-        self.naxs = len(URBE_Perception.ANCHORS[0])
-        self.stride = URBE_Perception.STRIDE
-        anchors_ = torch.tensor(URBE_Perception.ANCHORS).float().view(self.nl, -1, 2) / torch.tensor(self.stride).repeat(6, 1).T.reshape(3, 3, 2)
-        self.register_buffer('anchors', anchors_)  # shape(nl,na,2)
-        
-        self.stems = nn.ModuleList() # stem layer performs a sort of compression mechanism
-        self.cls_convs = nn.ModuleList() # block to extract features for the CLASSIFICATION HEAD
-        self.cls_preds = nn.ModuleList()
-        self.reg_convs = nn.ModuleList() # block to extract features for the REGRESSION HEAD
-        self.reg_preds = nn.ModuleList()
-        self.obj_preds = nn.ModuleList()
-        for i in range(len(ch)): # for each layer
-            self.stems.append(BaseConv(ch[i], ch[0], ksize=1, stride=1))
-            self.cls_convs.append(nn.Sequential(*[BaseConv(ch[0], ch[0], ksize=3, stride=1),
-                                                  BaseConv(ch[0], ch[0], ksize=3, stride=1),]
-                                               )
-                                 )
-            self.cls_preds.append(nn.Conv2d(ch[0], self.nc * self.naxs, kernel_size=(1, 1), stride=(1, 1), padding=0))
-            self.reg_convs.append(nn.Sequential(*[BaseConv(ch[0], ch[0], ksize=3, stride=1),
-                                                  BaseConv(ch[0], ch[0], ksize=3, stride=1),]
-                                               )
-                                 )
-            self.reg_preds.append(nn.Conv2d(ch[0], self.naxs * 4, kernel_size=(1, 1), stride=(1, 1), padding=0))
-            self.obj_preds.append(nn.Conv2d(ch[0], self.naxs * 1, kernel_size=(1, 1), stride=(1, 1), padding=0))
-
-    def forward(self, inputs):
-        outputs = []
-        for k, (cls_conv, reg_conv, x) in enumerate(zip(self.cls_convs, self.reg_convs, inputs)):
-            x = self.stems[k](x)
-            cls_x = x
-            reg_x = x
-
-            cls_feat = cls_conv(cls_x)
-            cls_output = self.cls_preds[k](cls_feat)
-            reg_feat = reg_conv(reg_x)
-            reg_output = self.reg_preds[k](reg_feat)
-            obj_output = self.obj_preds[k](reg_feat)
-            # the order of each "grid" output is objectness, bboxes and finally the predicted classes
-            output = torch.cat([reg_output, obj_output, cls_output], 1)
-            
-            bs, _, grid_y, grid_x = output.shape
-            output = output.view(bs, self.naxs, (5+self.nc), grid_y, grid_x).permute(0, 1, 3, 4, 2).contiguous()
-            outputs.append(output)
-        return outputs
-##############################################################################################################################
+# the detector and the anchors are still importable from here (as before the 'inference' package)
+__all__ = ["URBE_Perception", "URBE_Detector", "ANCHORS", "STRIDE"]
 
 class URBE_Perception(pl.LightningModule):
     
     # After the computation of the 'autoanchor' algorithm, we acknowledge that these are the "best" anchors (the default ones used in YOLOv5)
     # https://github.com/ultralytics/yolov5/blob/master/models/yolov5m.yaml
-    ANCHORS = [ [(10, 13), (16, 30), (33, 23)],  # P3/8
-            [(30, 61), (62, 45), (59, 119)],  # P4/16
-            [(116, 90), (156, 198), (373, 326)] ]  # P5/32
-    
-    # https://pytorch.org/docs/stable/generated/torch.nn.Module.html command+f register_buffer
-    # has the same result as self.anchors = anchors but, it's a way to register a buffer (make
-    # a variable available in runtime) that should not be considered a model parameter
-    STRIDE = [8, 16, 32]
+    ANCHORS = ANCHORS
+    STRIDE = STRIDE
     
     """ custom YOLOv5 """
     def __init__(self, hparams):
         super(URBE_Perception, self).__init__()
         self.save_hyperparameters(hparams)
+        # checkpoints saved before some hyperparameters were introduced: the missing ones take the default value
+        for key, value in asdict(Hparams()).items():
+            self.hparams.setdefault(key, value)
     
-        self.backbone = Backbone(self.hparams.first_out)
-        self.neck = Neck(self.hparams.first_out)
-        if self.hparams.head == "simple":
-            self.head = SimpleHead(ch=(self.hparams.first_out * 4, self.hparams.first_out * 8, self.hparams.first_out * 16))
-        elif self.hparams.head == "decoupled":
-            self.head = DecoupledHead(ch=(self.hparams.first_out * 4, self.hparams.first_out * 8, self.hparams.first_out * 16))
+        # the network (any backbone/neck/head combination of the registry) is the inference-only URBE_Detector,
+        # here we only add what is needed for the training (loss, metrics and logging)
+        self.detector = URBE_Detector(self.hparams)
+        # checkpoints saved before the split have 'backbone.*', 'neck.*' and 'head.*' keys
+        self._register_load_state_dict_pre_hook(self.load_old_state_dict)
         
         # if are loaded backbone/neck pretrained weights I don't train some layers to save memory space!
-        if self.hparams.load_pretrained:
-            for param in self.backbone.backbone[:7].parameters(): # until the 6th backbone layer
+        # (pretrained weights only exist for the YOLOv5 backbone)
+        self.frozen = self.hparams.load_pretrained and self.hparams.backbone == "yolov5"
+        if self.frozen:
+            for param in self.backbone.backbone[:FROZEN_LAYERS].parameters(): # until the 6th backbone layer
                 param.requires_grad = False
                 
         self.loss = YOLO_Loss(self.hparams, self.head.anchors, self.head.stride, self.head.nl)
+
+        # KNOWLEDGE DISTILLATION: the 1x1 convs which adapt the neck outputs to the teacher channels are trained with the
+        # student (they are not part of the detector), the frozen teacher is loaded only when it is needed (see 'get_teacher')
+        self.teacher = None
+        if self.hparams.teacher_checkpoint is not None:
+            if self.hparams.get("teacher_channels") is None: # saved with the hyperparameters: the student can be reloaded without the teacher
+                self.hparams.teacher_channels = list(self.get_teacher().neck_channels)
+            self.distill_adapters = feature_adapters(self.neck.out_channels, self.hparams.teacher_channels)
+        from torchmetrics.detection.mean_ap import MeanAveragePrecision
         self.mAP = MeanAveragePrecision()
 
+    @staticmethod
+    def load_old_state_dict(state_dict, prefix, *args):
+        for key in list(state_dict.keys()):
+            if key.startswith(tuple(prefix + part for part in ("backbone.", "neck.", "head."))):
+                state_dict[prefix + "detector." + key[len(prefix):]] = state_dict.pop(key)
+
+    def train(self, mode=True):
+        super(URBE_Perception, self).train(mode)
+        # the BatchNorms of the frozen layers are frozen too: they always normalize with the pretrained running statistics
+        # (otherwise they would keep updating them and the activations of an image would depend on the rest of the batch)
+        if self.frozen:
+            self.backbone.backbone[:FROZEN_LAYERS].eval()
+        return self
+
+    @property
+    def backbone(self):
+        return self.detector.backbone
+
+    @property
+    def neck(self):
+        return self.detector.neck
+
+    @property
+    def head(self):
+        return self.detector.head
+
     def forward(self, x): # we expect x to be the stack of images
-        x, backbone_connection = self.backbone(x)
-        features = self.neck(x, backbone_connection)
-        return self.head(features) # [(batch, 3, 80, 80, 8), (batch, 3, 40, 40, 8), (batch, 3, 20, 20, 8)]
+        return self.detector(x)
+    
+    def eager_forward(self, x):
+        return self.detector.eager_forward(x)
+    
+    def compile_network(self, mode=None, warmup=None, example_input=None):
+        """ Opt-in graph capture of the forward (meant for INFERENCE), see URBE_Detector.compile_network. """
+        self.eval()
+        self.detector.compile_network(mode, warmup, example_input)
+        return self
+
+    def export_detector(self, path):
+        """ Saves the inference-only network, which can be loaded with URBE_Detector.load(path) without Lightning. """
+        self.detector.save(path)
     
     def configure_optimizers(self):
         optimizer = optim.Adam(self.parameters(), lr=self.hparams.lr, eps=self.hparams.adam_eps, weight_decay=self.hparams.wd)
@@ -370,107 +109,56 @@ class URBE_Perception(pl.LightningModule):
             },
         }
 
+    def get_teacher(self):
+        if self.teacher is None:
+            self.teacher = Teacher(self.hparams.teacher_checkpoint)
+        return self.teacher
+
+    def distillation_loss(self, batch, features, out):
+        # the teacher outputs come from the teacher cache (see 'distillation.py') or they are computed live
+        if "teacher_pred_0" in batch:
+            teacher_features = [batch[f"teacher_feature_{s}"] for s in range(3)]
+            teacher_preds = [batch[f"teacher_pred_{s}"] for s in range(3)]
+        else:
+            teacher_features, teacher_preds = self.get_teacher()(batch["img"])
+        feature_loss = feature_imitation_loss(self.distill_adapters, features, teacher_features)
+        soft_loss = self.loss.distill_loss(out, teacher_preds, self.hparams.distill_temperature)
+        return self.hparams.weight_feature * feature_loss, self.hparams.weight_distill * soft_loss
+
     def training_step(self, batch, batch_idx):
-        imgs = batch['img']
-        out = self(imgs)
-        loss = self.loss(out, batch["labels"])
+        distillation = self.hparams.teacher_checkpoint is not None # we also need the neck outputs
+        if "c4" in batch: # the activations of the frozen layers come from the feature cache (see 'feature_cache.py')
+            out = self.detector.forward_from_features(batch["c4"].float(), batch["c6"].float(), return_features=distillation)
+        elif distillation:
+            out = self.detector.eager_forward(batch['img'], return_features=True)
+        else:
+            imgs = batch['img']
+            out = self(imgs)
+        if distillation:
+            features, out = out
+        loss = self.loss(out, batch["labels"], batch["id"])
+        if distillation:
+            feature_loss, soft_loss = self.distillation_loss(batch, features, out)
+            self.log_dict({"feature_loss": feature_loss, "soft_loss": soft_loss})
+            loss = loss + feature_loss + soft_loss
         # LOSS
-        self.log_dict({"loss": loss})
+        self.log_dict({"loss": loss, "img_size": float(out[0].shape[2] * self.head.stride[0])}) # the active resolution (see 'resolution.py')
         return {"loss": loss}
 
     # =======================================================================================#
     def make_grids(self, anchors, naxs, stride, nx, ny, i):
-
-        x_grid = torch.arange(nx)
-        x_grid = x_grid.repeat(ny).reshape(ny, nx)
-
-        y_grid = torch.arange(ny).unsqueeze(0)
-        y_grid = y_grid.T.repeat(1, nx).reshape(ny, nx)
-
-        xy_grid = torch.stack([x_grid, y_grid], dim=-1)
-        xy_grid = xy_grid.expand(1, naxs, ny, nx, 2)
-        anchor_grid = (anchors[i]*stride).reshape((1, naxs, 1, 1, 2)).expand(1, naxs, ny, nx, 2)
-
-        return xy_grid.to(self.device), anchor_grid.to(self.device)
+        return make_grids(anchors, naxs, stride, nx, ny, i, self.device)
 
     def cells_to_bboxes(self, predictions, anchors, strides, device, is_pred=False):
-        num_out_layers = len(predictions) # num of scales 
-        grid = [torch.empty(0) for _ in range(num_out_layers)]  # initialization
-        anchor_grid = [torch.empty(0) for _ in range(num_out_layers)]  # initialization
-        
-        all_bboxes = []
-        for i in range(num_out_layers):
-            bs, naxs, ny, nx, _ = predictions[i].shape # (bs, 3, 80/40/20, 80/40/20, _)
-            stride = strides[i] # 8/16/32
-            # 'grid' represents the grid (80x80, 40x40, ...) with indices
-            # 'anchor_grid' has the same number of cells, but with anchors values
-            grid[i], anchor_grid[i] = self.make_grids(anchors, naxs, stride=stride, ny=ny, nx=nx, i=i) # both torch.Size([1, 3, 80/40/20, 80/40/20, 2])
-            if is_pred: # if they are the predicitons made by the model
-                # formula taken from here: https://github.com/ultralytics/yolov5/issues/471
-                layer_prediction = predictions[i].sigmoid()
-                obj = layer_prediction[..., 4:5]
-                xy = (2 * (layer_prediction[..., 0:2]) + grid[i] - 0.5) * stride
-                wh = ((2*layer_prediction[..., 2:4])**2) * anchor_grid[i]
-                best_class = torch.argmax(layer_prediction[..., 5:], dim=-1).unsqueeze(-1)
-
-            else: # when we want to re-convert the ground_truth labels to images bboxes
-                if i != num_out_layers-1:
-                    continue
-                predictions[i] = predictions[i].to(device, non_blocking=True)
-                obj = predictions[i][..., 4:5]
-                xy = (predictions[i][..., 0:2] + grid[i]) * stride
-                wh = predictions[i][..., 2:4] * stride
-                best_class = predictions[i][..., 5:6]
-
-            scale_bboxes = torch.cat((best_class, obj, xy, wh), dim=-1).reshape(bs, -1, 6)
-            all_bboxes.append(scale_bboxes)
-        return torch.cat(all_bboxes, dim=1)
+        return cells_to_bboxes(predictions, anchors, strides, device, is_pred)
 
     def non_max_suppression(self, batch_bboxes, iou_threshold, threshold, max_detections=50, is_pred=False, filenames=None):
-        # for statistics purposes
-        conf_thresh_ratio = 0
-        nms_ratio = 0
-        
-        bboxes_after_nms = []
-        for i, boxes in enumerate(batch_bboxes): # we iterate over the batches
-            # 'boxes' is the set of cells for one batch --> (25200, 6)
-            # FIRST FILTER on the probability of objectness
-            boxes = torch.masked_select(boxes, boxes[..., 1:2] > threshold).reshape(-1, 6) # if objectness is greater than the threshold, we continue...
-            conf_thresh_ratio += len(boxes) / 25200
-            # from (xc, yc, w, h) to (x1, y1, x2, y2) --> it is perfect for wandb bbox logging visualization!
-            w = boxes[..., 4:5]
-            h = boxes[..., 5:6]
-            boxes[..., 2:3] = boxes[..., 2:3] - (w/2) # x1
-            boxes[..., 3:4] = boxes[..., 3:4] - (h/2) # y1
-            boxes[..., 4:5] = boxes[..., 2:3] + w # x2
-            boxes[..., 5:6] = boxes[..., 3:4] + h # y2
-            
-            # we perform non maxima suppression(nms)
-            if is_pred:
-                indices = batched_nms(boxes[..., 2:], boxes[..., 1], boxes[..., 0].int(), iou_threshold)
-                
-                if indices.numel() == 0:
-                    print(f"***NO PREDICTIONS for image {filenames[i]}***") # in this way we know which image is not predicted and we can check it!
-                    boxes = torch.tensor([])
-                else:
-                    before_nms = len(boxes)
-                    boxes = boxes[indices]
-                    nms_ratio += len(boxes) / before_nms
-                    
-                    # we set a maximum number of predictions for each image
-                    if boxes.shape[0] > max_detections:
-                        boxes = boxes[:max_detections, :]
-            
-            bboxes_after_nms.append(boxes)
-        
-        # if we're dealing with predictions we also want to save some statistics    
-        if is_pred:
-            return conf_thresh_ratio/len(batch_bboxes), nms_ratio/len(batch_bboxes), bboxes_after_nms # it's a list of tensors --> len(bboxes_after_nms) == batch_size
-        else:
-            return bboxes_after_nms
+        return non_max_suppression(batch_bboxes, iou_threshold, threshold, max_detections, is_pred, filenames)
     
     # images logging during training phase but used for validation images
     def get_images_for_log(self, imgs, bboxes, labels, scores):
+        import wandb
+        import torchvision.transforms as T
         # we prepare each image
         transform = T.ToPILImage()
         images_list = [transform(img) for img in imgs]
@@ -489,13 +177,10 @@ class URBE_Perception(pl.LightningModule):
         return example_images
     # =======================================================================================#
     
-    def predict(self, predictions, targets, file_names):
-        targets = [YOLO_Loss.transform_targets(predictions, bboxes, torch.tensor(URBE_Perception.ANCHORS), URBE_Perception.STRIDE) for bboxes in targets] # giving the not strided ANCHORS everything works!
+    def predict(self, predictions, targets, file_names, ids=None):
+        # giving the not strided ANCHORS everything works! (they are another key of the target cache)
         # I want targets to be the same shape as predictions --> (bs, 3 , 80/40/20, 80/40/20, 6)
-        t1 = torch.stack([target[0] for target in targets], dim=0).to(self.device,non_blocking=True)
-        t2 = torch.stack([target[1] for target in targets], dim=0).to(self.device,non_blocking=True)
-        t3 = torch.stack([target[2] for target in targets], dim=0).to(self.device,non_blocking=True)
-        targets = [t1, t2, t3] # all the batches are grouped according to the scale
+        targets = self.loss.build_targets(predictions, targets, ids, anchors=torch.tensor(URBE_Perception.ANCHORS)) # all the batches are grouped according to the scale
         
         ## Custom "ACCURACY" for classes and objectness ##
         ##################################################
@@ -542,12 +227,12 @@ class URBE_Perception(pl.LightningModule):
 
         imgs = batch['img']
         out = self(imgs)
-        val_loss = self.loss(out, batch["labels"])
+        val_loss = self.loss(out, batch["labels"], batch["id"])
         
         # LOSS
         self.log("val_loss", val_loss, on_step=False, on_epoch=True, batch_size=imgs.shape[0])
         
-        conf_thresh_ratio, nms_ratio, pred = self.predict(out, batch['labels'], batch['file_name'])
+        conf_thresh_ratio, nms_ratio, pred = self.predict(out, batch['labels'], batch['file_name'], batch['id'])
         # STATISTICS
         self.log("conf_thresh_ratio", conf_thresh_ratio, on_step=False, on_epoch=True, prog_bar=True, batch_size=self.hparams.batch_size)
         self.log("nms_ratio", nms_ratio, on_step=False, on_epoch=True, prog_bar=True, batch_size=self.hparams.batch_size)
@@ -291,15 +291,15 @@ class PA_FPN_AL(nn.Module):
 		self.shrink_conv4 = BaseConv(in_channels[1], in_channels[0], 1, 1, norm=norm, act=act)
 		self.upsample = nn.Upsample(scale_factor=2, mode="bicubic")
 		
-		self.p5_p4 = CSPLayer(in_channels[1], num_bottle=depths[0], shortcut=False, norm=norm, act=act,)
-		self.p4_p3 = CSPLayer(in_channels[0], num_bottle=depths[0], shortcut=False, norm=norm, act=act,)
+		self.p5_p4 = CSPLayer(in_channels[1], in_channels[1], num_bottle=depths[0], shortcut=False, norm=norm, act=act,)
+		self.p4_p3 = CSPLayer(in_channels[0], in_channels[0], num_bottle=depths[0], shortcut=False, norm=norm, act=act,)
 
 		# bottom-up conv
 		self.downsample_conv1 = BaseConv(int(in_channels[0]), int(in_channels[0]), 3, 2, norm=norm, act=act)
 		self.downsample_conv2 = BaseConv(int(in_channels[1]), int(in_channels[1]), 3, 2, norm=norm, act=act)
 
-		self.n3_n4 = CSPLayer(in_channels[1], num_bottle=depths[0], shortcut=False, norm=norm, act=act,)
-		self.n4_n5 = CSPLayer( in_channels[2], num_bottle=depths[0], shortcut=False, norm=norm, act=act,)
+		self.n3_n4 = CSPLayer(in_channels[1], in_channels[1], num_bottle=depths[0], shortcut=False, norm=norm, act=act,)
+		self.n4_n5 = CSPLayer(in_channels[2], in_channels[2], num_bottle=depths[0], shortcut=False, norm=norm, act=act,)
 
 	def forward(self, inputs):
 		#  backbone
@@ -410,25 +410,16 @@ class DecoupledHead(nn.Module):
 		for k, (cls_conv, reg_conv, x) in enumerate(zip(self.cls_convs, self.reg_convs, inputs)):
 			# Change all inputs to the same channel.
 			x = self.stems[k](x)
-			print(k)
 			cls_x = x
 			reg_x = x
-			print(x.shape)
 
 			cls_feat = cls_conv(cls_x)
-			print(cls_feat.shape)
 			cls_output = self.cls_preds[k](cls_feat)
-			print(cls_output.shape)
-			print("------")
 			reg_feat = reg_conv(reg_x)
-			print(reg_feat.shape)
 			reg_output = self.reg_preds[k](reg_feat)
 			obj_output = self.obj_preds[k](reg_feat)
-			print(reg_output.shape)
-			print(obj_output.shape)
 
 			# output: [batch_size, n_ch, h, w]
 			output = torch.cat([reg_output, obj_output, cls_output], 1)
-			print(output.shape)
 			outputs.append(output)
 		return outputs
\ No newline at end of file
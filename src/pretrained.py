@@ -0,0 +1,144 @@
+import os
+import re
+import json
+import hashlib
+import torch
+
+###################################### ULTRALYTICS --> URBE_Perception WEIGHTS MAPPING ######################################
+# Instead of matching tensors by shape (O(N^2) and wrong as soon as two layers have the same shape), every Ultralytics layer
+# is explicitly mapped to the corresponding layer of our Backbone/Neck (the Detect layer, 24, is never loaded because it has 80 classes).
+# Ultralytics layer index --> (our module, index inside it, block type)
+LAYERS = {
+    0 : ("backbone", 0, "conv"), 1 : ("backbone", 1, "conv"), 2 : ("backbone", 2, "c3"), 3 : ("backbone", 3, "conv"),
+    4 : ("backbone", 4, "c3"), 5 : ("backbone", 5, "conv"), 6 : ("backbone", 6, "c3"), 7 : ("backbone", 7, "conv"),
+    8 : ("backbone", 8, "c3"), 9 : ("backbone", 9, "sppf"),
+    # 11, 12, 15, 16, 19 and 22 are Upsample/Concat layers (no weights)
+    10 : ("neck", 0, "conv"), 13 : ("neck", 1, "c3_neck"), 14 : ("neck", 2, "conv"), 17 : ("neck", 3, "c3_neck"),
+    18 : ("neck", 4, "conv"), 20 : ("neck", 5, "c3_neck"), 21 : ("neck", 6, "conv"), 23 : ("neck", 7, "c3_neck"),
+}
+
+# names of the sub-blocks (Ultralytics --> ours) for each block type
+SUBMODULES = {
+    "conv" : [],
+    "c3" : [(r"cv1", "c1"), (r"cv2", "c_skipped"), (r"cv3", "c_out"), (r"m\.(\d+)\.cv1", r"seq.\1.c1"), (r"m\.(\d+)\.cv2", r"seq.\1.c2")],
+    # in the neck the C3 blocks have no residual, so the bottlenecks are plain nn.Sequential(CBL, CBL)
+    "c3_neck" : [(r"cv1", "c1"), (r"cv2", "c_skipped"), (r"cv3", "c_out"), (r"m\.(\d+)\.cv1", r"seq.\1.0"), (r"m\.(\d+)\.cv2", r"seq.\1.1")],
+    "sppf" : [(r"cv1", "c1"), (r"cv2", "c_out")],
+}
+
+def translate_key(ultralytics_key):
+    """
+    Parameters:
+        ultralytics_key (str): e.g. "model.4.m.1.cv2.bn.running_mean"
+    Returns:
+        tuple: (our module, key inside it) e.g. ("backbone", "backbone.4.seq.1.c2.cbl.1.running_mean"), or None if the layer is not mapped
+    """
+    match = re.fullmatch(r"model\.(\d+)\.(.+)", ultralytics_key)
+    if match is None or int(match.group(1)) not in LAYERS:
+        return None
+    part, index, block = LAYERS[int(match.group(1))]
+    rest = match.group(2)
+    prefix = ""
+    for ultralytics_name, our_name in SUBMODULES[block]:
+        sub = re.fullmatch(ultralytics_name + r"\.(.+)", rest)
+        if sub is not None:
+            prefix = sub.expand(our_name) + "."
+            rest = sub.group(sub.re.groups) # what follows the sub-block name (e.g. "bn.running_mean")
+            break
+    # every Ultralytics 'Conv' is our CBL: conv --> cbl.0 and bn --> cbl.1
+    conv_bn = re.fullmatch(r"(conv|bn)\.(\w+)", rest)
+    if conv_bn is None:
+        return None
+    layer = "cbl.0" if conv_bn.group(1) == "conv" else "cbl.1"
+    return part, f"{part}.{index}.{prefix}{layer}.{conv_bn.group(2)}"
+
+def resolve_mapping(model, pretrained_weights, partial=False):
+    """
+    Builds and validates the mapping between the Ultralytics state_dict and the state_dicts of 'model.backbone' and 'model.neck'.
+    Every tensor of our backbone and neck must receive exactly one pretrained tensor with the same shape.
+    The depths and widths must be the ones of the checkpoint, i.e. the model has to be built with the family scaling
+    (e.g. hparams.update(family_hparams("n")) for "ultralytics_yolov5n.pt").
+    Parameters:
+        partial (bool): LEGACY models only (e.g. first_out=16 without 'depth_multiple', which has the C3 depths of the m model
+                        on the widths of the n model). Our extra bottlenecks are allowed to receive no weight (they keep their
+                        random initialization) and are listed under "unmapped". Every pretrained tensor must still be used.
+    Returns:
+        dict: {"backbone" : {our key : ultralytics key}, "neck" : {...}} (and "unmapped" : [our keys] if 'partial')
+    """
+    ours = {"backbone" : model.backbone.state_dict(), "neck" : model.neck.state_dict()}
+    mapping = {"backbone" : {}, "neck" : {}}
+    errors = []
+    for ultralytics_key, weight in pretrained_weights.items():
+        translated = translate_key(ultralytics_key)
+        if translated is None:
+            continue
+        part, our_key = translated
+        if our_key not in ours[part]:
+            errors.append(f"{ultralytics_key} --> {part}.{our_key} doesn't exist in our model (different depth?)")
+        elif ours[part][our_key].shape != weight.shape:
+            errors.append(f"{ultralytics_key} --> {part}.{our_key}: shape {tuple(weight.shape)} != {tuple(ours[part][our_key].shape)} (different width?)")
+        else:
+            mapping[part][our_key] = ultralytics_key
+    unmapped = [f"{part}.{our_key}" for part in ours for our_key in ours[part] if our_key not in mapping[part]]
+    if not partial:
+        errors += [f"{key} doesn't receive any pretrained weight" for key in unmapped]
+    else:
+        # with 'partial' only the bottlenecks of the deeper C3 blocks can be left without weights
+        errors += [f"{key} doesn't receive any pretrained weight (not an extra bottleneck)" for key in unmapped if re.search(r"\.seq\.\d+\.", key) is None]
+    if len(errors) > 0:
+        raise ValueError(f"The pretrained weights can't be mapped to this model ({len(errors)} errors):\n" + "\n".join(errors[:20]))
+    if partial:
+        mapping["unmapped"] = unmapped
+    return mapping
+
+def architecture_signature(model):
+    # the cache depends on the architecture (first_out, depths, ...) and not on the head
+    signature = [(k, tuple(v.shape)) for part in (model.backbone, model.neck) for k, v in part.state_dict().items()]
+    return hashlib.sha1(json.dumps(signature).encode()).hexdigest()[:16]
+
+def load_ultralytics_weights(model, weights_path, cache_dir="pretrained/cache", partial=False):
+    """
+    Loads the Ultralytics YOLOv5 weights (e.g. "pretrained/ultralytics_yolov5m.pt") inside the Backbone and the Neck of 'model'
+    (whatever 'first_out', 'depth_multiple', 'width_multiple' or 'head' it has).
+    The first time, the mapping is resolved and the remapped tensors are cached on disk, the following times the cached file
+    is loaded with mmap (so neither the Ultralytics checkpoint nor its code are needed anymore and the startup is fast).
+    Parameters:
+        model (URBE_Perception): any model with the YOLOv5 'backbone' and 'neck'
+        weights_path (str): Ultralytics checkpoint ({"model" : DetectionModel}) or its plain state_dict
+        cache_dir (str): folder of the cached (remapped) weights
+        partial (bool): only for the legacy models whose C3 blocks are deeper than the checkpoint ones (see 'resolve_mapping')
+    Returns:
+        dict: the resolved mapping {"backbone" : {our key : ultralytics key}, "neck" : {...}}
+    """
+    stat = os.stat(weights_path)
+    key = hashlib.sha1(f"{os.path.abspath(weights_path)}|{stat.st_size}|{stat.st_mtime}|{architecture_signature(model)}|{partial}".encode()).hexdigest()[:16]
+    cache_path = os.path.join(cache_dir, f"{os.path.splitext(os.path.basename(weights_path))[0]}_{key}.pt")
+
+    if os.path.exists(cache_path):
+        try:
+            cached = torch.load(cache_path, map_location="cpu", mmap=True)
+        except TypeError: # mmap is only available from PyTorch 2.1
+            cached = torch.load(cache_path, map_location="cpu")
+    else:
+        # loading the Ultralytics checkpoint needs their repository in the path (see the notebook)
+        try:
+            pretrained = torch.load(weights_path, map_location="cpu", weights_only=False) # it is a pickled model, not only tensors
+        except TypeError: # 'weights_only' is only available from PyTorch 1.13
+            pretrained = torch.load(weights_path, map_location="cpu")
+        if isinstance(pretrained, dict) and "model" in pretrained:
+            pretrained = pretrained["model"]
+        pretrained_weights = pretrained.state_dict() if hasattr(pretrained, "state_dict") else pretrained
+        mapping = resolve_mapping(model, pretrained_weights, partial)
+        cached = {"mapping" : mapping,
+                  "backbone" : {k : pretrained_weights[v].float() if pretrained_weights[v].is_floating_point() else pretrained_weights[v] for k, v in mapping["backbone"].items()},
+                  "neck" : {k : pretrained_weights[v].float() if pretrained_weights[v].is_floating_point() else pretrained_weights[v] for k, v in mapping["neck"].items()}}
+        os.makedirs(cache_dir, exist_ok=True)
+        torch.save(cached, cache_path + ".tmp")
+        os.replace(cache_path + ".tmp", cache_path)
+
+    # strict loading: the mapping has already been validated, so every tensor is present (except the 'unmapped' ones of a partial mapping)
+    model.backbone.load_state_dict(cached["backbone"], strict=not partial)
+    model.neck.load_state_dict(cached["neck"], strict=not partial)
+    if partial:
+        print(f"Partial mapping: {len(cached['mapping']['unmapped'])} tensors of the extra bottlenecks keep their initialization")
+    return cached["mapping"]
@@ -0,0 +1,96 @@
+import math
+import random
+from PIL import Image
+from torch.utils.data import Dataset, Sampler
+
+##################################################### RESOLUTION SCHEDULE ####################################################
+# Progressive resizing: the first epochs are trained at a smaller resolution (the model is still learning coarse features)
+# which grows up to 'img_size'. Multi-scale: each batch takes a random resolution below the one of the epoch.
+# The resolutions are always multiples of 32 (the largest stride) and the images of a batch always have the same one.
+class ResolutionSchedule:
+    def __init__(self, img_size, min_img_size=320, ramp_epochs=10, progressive=True, multi_scale=False, multi_scale_range=0.5):
+        """
+        Parameters:
+            img_size (int): target resolution (reached after 'ramp_epochs' epochs)
+            min_img_size (int): resolution of the first epoch (and lower bound of the multi-scale)
+            progressive (bool): if False, every epoch is trained at 'img_size'
+            multi_scale (bool): random resolution for each batch in [(1 - multi_scale_range) * size, size]
+        """
+        self.img_size = img_size
+        self.min_img_size = min(self.round(min_img_size), img_size)
+        self.ramp_epochs = ramp_epochs
+        self.progressive = progressive
+        self.multi_scale = multi_scale
+        self.multi_scale_range = multi_scale_range
+
+    @staticmethod
+    def round(size):
+        return max(32, int(round(size / 32)) * 32)
+
+    @classmethod
+    def from_hparams(cls, hparams):
+        # None if the resolution is fixed
+        if not (hparams.progressive_resize or hparams.multi_scale):
+            return None
+        return cls(hparams.img_size, hparams.min_img_size, hparams.resize_ramp_epochs, hparams.progressive_resize, hparams.multi_scale, hparams.multi_scale_range)
+
+    def epoch_size(self, epoch):
+        # linear ramp from 'min_img_size' to 'img_size'
+        if not self.progressive or epoch >= self.ramp_epochs:
+            return self.img_size
+        return self.round(self.min_img_size + (self.img_size - self.min_img_size) * epoch / self.ramp_epochs)
+
+    def batch_size_for(self, epoch, rng=random):
+        """ Resolution of a batch of the epoch 'epoch'. """
+        size = self.epoch_size(epoch)
+        if not self.multi_scale:
+            return size
+        low = max(self.min_img_size, self.round(size * (1 - self.multi_scale_range)))
+        return rng.randrange(low, size + 1, 32) if low < size else size
+
+class ResolutionBatchSampler(Sampler):
+    """
+    Batches of (index, resolution) pairs for the MultiScaleDataset: all the samples of a batch have the same resolution.
+    Each iteration is an epoch (the epoch counter is advanced at every '__iter__', starting from 'start_epoch').
+    """
+    def __init__(self, num_samples, batch_size, schedule, shuffle=True, start_epoch=0, seed=0):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.schedule = schedule
+        self.shuffle = shuffle
+        self.epoch = start_epoch
+        self.seed = seed
+
+    def __len__(self):
+        return math.ceil(self.num_samples / self.batch_size)
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        indices = list(range(self.num_samples))
+        if self.shuffle:
+            rng.shuffle(indices)
+        epoch = self.epoch
+        self.epoch += 1
+        for start in range(0, self.num_samples, self.batch_size):
+            size = self.schedule.batch_size_for(epoch, rng)
+            yield [(idx, size) for idx in indices[start:start + self.batch_size]]
+
+class MultiScaleDataset(Dataset):
+    """ The training URBE_Dataset indexed by (index, resolution): the image (stored at 'img_size') is resized to the resolution. """
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, item):
+        idx, size = item
+        sample = dict(self.dataset[idx])
+        img = sample["img"]
+        if not isinstance(img, Image.Image): # numpy array after the augmentation
+            img = Image.fromarray(img)
+        if img.size != (size, size):
+            img = img.resize((size, size), Image.BILINEAR)
+        sample["img"] = img
+        return sample
+##############################################################################################################################
@@ -0,0 +1,146 @@
+import io
+import os
+import json
+import queue
+import random
+import threading
+import torch
+from tqdm import tqdm
+from dataclasses import asdict
+from torchvision import transforms
+from torch.utils.data import IterableDataset, get_worker_info
+from .hyperparameters import Hparams
+from .data_module import make_labels, make_augmentation, augment
+from .inference.image_io import open_image
+
+########################################################### SHARDS ###########################################################
+# On a mounted drive (e.g. /content/drive/MyDrive/...) opening thousands of small JPEGs is dominated by the latency of each
+# file. We pack the (still encoded) images of a split into a few large shard files which are only read sequentially:
+#   <shard_dir>/<split>/shard-00000.bin, shard-00001.bin, ... --> the JPEG bytes one after the other
+#   <shard_dir>/<split>/index.json --> for each shard, the samples with their offset/length and their labels
+def write_shards(images_dir, annotations_file_path, out_dir, shard_size=64 * 2**20, max_images=None):
+    """
+    Packs the images of 'images_dir' (e.g. <dataset_dir>/train) and their labels into shards of about 'shard_size' bytes.
+    Returns:
+        dict: the index of the shards
+    """
+    annotations = json.load(open(annotations_file_path, "r"))
+    timeofday = {img["id"] : img["timeofday"] for img in annotations["images"]}
+    ann_lists = {}
+    for ann in annotations["annotations"]:
+        ann_lists.setdefault(ann["image_id"], []).append(ann)
+    os.makedirs(out_dir, exist_ok=True)
+
+    # same images (and same order) of 'URBE_Dataset.make_data'
+    file_names = [os.path.join(images_dir, e) for e in os.listdir(images_dir)][:max_images]
+    index = {"shards" : []}
+    shard, f = None, None
+    for file_name in tqdm(file_names):
+        if shard is None or shard["size"] >= shard_size:
+            if f is not None:
+                f.close()
+                os.replace(os.path.join(out_dir, shard["file"] + ".tmp"), os.path.join(out_dir, shard["file"]))
+            shard = {"file" : f"shard-{len(index['shards']):05d}.bin", "size" : 0, "samples" : []}
+            index["shards"].append(shard)
+            f = open(os.path.join(out_dir, shard["file"] + ".tmp"), "wb")
+        image_id = (file_name.split("_")[-1])[:-4]
+        data = open(file_name, "rb").read()
+        f.write(data)
+        shard["samples"].append({"id" : image_id, "time" : timeofday[image_id], "file_name" : file_name, "labels" : make_labels(ann_lists.get(image_id, [])),
+                                 "offset" : shard["size"], "length" : len(data)})
+        shard["size"] += len(data)
+    if f is not None:
+        f.close()
+        os.replace(os.path.join(out_dir, shard["file"] + ".tmp"), os.path.join(out_dir, shard["file"]))
+    # the index is written last: if it exists, the shards are complete
+    with open(os.path.join(out_dir, "index.json.tmp"), "w") as f:
+        json.dump(index, f)
+    os.replace(os.path.join(out_dir, "index.json.tmp"), os.path.join(out_dir, "index.json"))
+    print(f"{len(file_names)} images packed in {len(index['shards'])} shards in {out_dir}")
+    return index
+
+def write_dataset_shards(hparams, shard_dir=None, shard_size=64 * 2**20):
+    # the three splits of the dataset (same number of images of URBE_Dataset)
+    shard_dir = shard_dir if shard_dir is not None else hparams["shard_dir"]
+    for data_type in ("train", "val", "test"):
+        max_number = round(hparams["max_number_images"]/8) if data_type in ("val", "test") else hparams["max_number_images"]
+        write_shards(os.path.join(hparams["dataset_dir"], data_type), hparams["annotations_file_path"], os.path.join(shard_dir, data_type), shard_size, max_number)
+
+def read_ahead(paths, num_shards):
+    # the next 'num_shards' shards are read (each one in a single sequential read) by a background thread while the current one is decoded
+    shards = queue.Queue(maxsize=max(num_shards, 1))
+    def reader():
+        try:
+            for path in paths:
+                with open(path, "rb") as f:
+                    shards.put(f.read())
+        except Exception as e: # raised in the consumer
+            shards.put(e)
+        shards.put(None)
+    threading.Thread(target=reader, daemon=True).start()
+    while True:
+        data = shards.get()
+        if data is None:
+            return
+        if isinstance(data, Exception):
+            raise data
+        yield data
+
+class ShardedDataset(IterableDataset):
+    """
+    Streaming version of URBE_Dataset (same samples) which reads the shards of 'write_shards'.
+    The shards are split among the ranks (distributed training) and then among the dataloader workers, each worker
+    reads its shards sequentially with read-ahead. Shuffling is done at shard level (order of the shards) and inside each
+    shard (order of its samples), with a different seed every epoch (the epoch counter is advanced at every '__iter__',
+    so with more workers the dataloader must have persistent workers, like in 'make_dataloader').
+    """
+    def __init__(self, shard_dir, hparams, data_type="train", shuffle=False, num_read_ahead=2, seed=0):
+        self.shard_dir = shard_dir
+        self.hparams = hparams
+        self.data_type = data_type
+        self.shuffle = shuffle
+        self.num_read_ahead = num_read_ahead
+        self.seed = seed
+        self.epoch = 0
+        self.index = json.load(open(os.path.join(shard_dir, "index.json")))
+        self.resize = transforms.Resize((self.hparams.img_size, self.hparams.img_size))
+        self.augmentation = make_augmentation() if self.hparams.augmentation and self.data_type == "train" else None
+
+    def rank_shards(self):
+        # shards of this rank (all of them without distributed training)
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+        else:
+            rank, world_size = 0, 1
+        return self.index["shards"][rank::world_size]
+
+    def __len__(self):
+        return sum(len(shard["samples"]) for shard in self.rank_shards())
+
+    def decode(self, data, sample):
+        draft_size = (self.hparams.img_size, self.hparams.img_size) if self.hparams.jpeg_draft else None
+        img = self.resize(open_image(io.BytesIO(data), draft_size, self.hparams.jpeg_draft_oversample))
+        sample = {"id" : sample["id"], "img" : img, "time" : sample["time"], "file_name" : sample["file_name"], "labels" : sample["labels"]}
+        return augment(self.augmentation, sample) if self.augmentation is not None else sample
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch) # the same in all the workers, so they agree on the order of the shards
+        self.epoch += 1
+        shards = list(self.rank_shards())
+        if self.shuffle:
+            rng.shuffle(shards)
+        worker = get_worker_info()
+        if worker is not None:
+            shards = shards[worker.id::worker.num_workers]
+        paths = [os.path.join(self.shard_dir, shard["file"]) for shard in shards]
+        for shard, data in zip(shards, read_ahead(paths, self.num_read_ahead)):
+            samples = list(shard["samples"])
+            if self.shuffle:
+                rng.shuffle(samples)
+            view = memoryview(data)
+            for sample in samples:
+                yield self.decode(view[sample["offset"]:sample["offset"] + sample["length"]], sample)
+##############################################################################################################################
+
+if __name__ == "__main__":
+    write_dataset_shards(asdict(Hparams()))
@@ -4,6 +4,8 @@ from pytorch_lightning.loggers.wandb import WandbLogger
 from pytorch_lightning.callbacks.early_stopping import EarlyStopping
 from pytorch_lightning.callbacks import ModelCheckpoint
 from pytorch_lightning.callbacks import QuantizationAwareTraining # it doesn't work :(
+from .feature_cache import attach_feature_cache
+from .distillation import attach_teacher_cache
 
 def train_model(data, model, experiment_name, patience, metric_to_monitor, mode, epochs):
     logger =  WandbLogger()
@@ -21,6 +23,13 @@ def train_model(data, model, experiment_name, patience, metric_to_monitor, mode,
     else:
         callbacks = [early_stop_callback, checkpoint_callback]
     
+    # the frozen backbone layers are computed only once for each training image
+    if model.hparams.feature_cache:
+        attach_feature_cache(model, data)
+    # the outputs of the distillation teacher are computed only once for each training image
+    if model.hparams.teacher_checkpoint is not None and model.hparams.teacher_cache:
+        attach_teacher_cache(model, data)
+    
     # the trainer collect all the useful informations so far for the training
     n_gpus = 1 if torch.cuda.is_available() else 0
     if model.hparams.resume_from_checkpoint is not None:
@@ -0,0 +1,178 @@
+import os
+import gc
+import time
+import json
+import torch
+import itertools
+from dataclasses import asdict
+from torch.utils.data import IterableDataset
+from .hyperparameters import Hparams, host_profile_path
+from .data_module import URBE_DataModule
+from .model import URBE_Perception
+from .benchmark import print_table
+
+####################################################### BATCH SIZE ##########################################################
+def is_out_of_memory(e):
+    # 'torch.cuda.OutOfMemoryError' is a RuntimeError (and it only exists from PyTorch 1.13)
+    return isinstance(e, RuntimeError) and "out of memory" in str(e)
+
+def make_batch(data, batch_size):
+    # a real batch of the training set (samples are repeated if the dataset is smaller than the batch)
+    if isinstance(data.data_train, IterableDataset): # streamed from the shards
+        samples = list(itertools.islice(itertools.cycle(data.data_train), batch_size))
+    else:
+        samples = [data.data_train[i % len(data.data_train)] for i in range(batch_size)]
+    return data.collate(samples)
+
+def try_batch_size(model, optimizer, data, batch_size, steps=2):
+    """
+    Runs 'steps' real training steps (forward + loss + backward + optimizer step) with a batch of 'batch_size' images.
+    Returns:
+        tuple: (peak of allocated memory in bytes, seconds per training step), None if it goes out of memory
+    """
+    try:
+        batch = make_batch(data, batch_size)
+        batch["img"] = batch["img"].to(model.device)
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        start = time.perf_counter()
+        for _ in range(steps):
+            optimizer.zero_grad(set_to_none=True)
+            # same mixed precision of the Trainer
+            with torch.autocast("cuda", dtype=torch.float16, enabled=model.hparams.precision == 16):
+                loss = model.training_step(batch, 0)["loss"]
+            loss.backward()
+            optimizer.step()
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated(), (time.perf_counter() - start) / steps
+    except RuntimeError as e:
+        if not is_out_of_memory(e):
+            raise e
+        return None
+    finally:
+        # we release everything before the next attempt
+        optimizer.zero_grad(set_to_none=True)
+        batch, loss = None, None
+        gc.collect()
+        torch.cuda.empty_cache()
+
+def find_batch_size(hparams, data, max_batch_size=256, memory_fraction=0.9, start=2):
+    """
+    Largest batch size that fits in the GPU: the batch size is doubled until a training step goes out of memory
+    (or its peak memory exceeds 'memory_fraction' of the GPU memory), then the limit is found by binary search.
+    NB: the result depends on the model hyperparameters (e.g. 'first_out', 'img_size', 'precision' and 'checkpointing').
+    Returns:
+        tuple: (batch size, seconds per training step with that batch size)
+    """
+    assert torch.cuda.is_available(), "The batch size search measures the GPU memory, a GPU is needed!"
+    model = URBE_Perception(hparams).to("cuda").train()
+    optimizer = model.configure_optimizers()["optimizer"]
+    budget = memory_fraction * torch.cuda.get_device_properties(model.device).total_memory
+
+    results = {} # batch size --> (peak memory, step time) or None
+    def fits(batch_size):
+        results[batch_size] = try_batch_size(model, optimizer, data, batch_size)
+        ok = results[batch_size] is not None and results[batch_size][0] <= budget
+        print(f"batch size {batch_size}: " + (f"{results[batch_size][0]/2**30:.2f} GB, {results[batch_size][1]:.3f} s/step" if results[batch_size] is not None else "out of memory") + (" --> OK" if ok else " --> too large"))
+        return ok
+
+    # exponential growth...
+    low, high = 0, None
+    batch_size = start
+    while batch_size <= max_batch_size:
+        if not fits(batch_size):
+            high = batch_size
+            break
+        low = batch_size
+        batch_size *= 2
+    if high is None: # everything fits up to the last power of two below 'max_batch_size'
+        if low == max_batch_size or fits(max_batch_size):
+            low, high = max_batch_size, max_batch_size + 1
+        else:
+            high = max_batch_size
+    # ...and binary search between the last batch size that fits and the first one that doesn't
+    while high - low > 1:
+        mid = (low + high) // 2
+        if fits(mid):
+            low = mid
+        else:
+            high = mid
+    if low == 0:
+        raise RuntimeError("Not even a batch of one image fits in the GPU memory!")
+
+    del model, optimizer
+    gc.collect()
+    torch.cuda.empty_cache()
+    return low, results[low][1]
+##############################################################################################################################
+
+#################################################### DATALOADER WORKERS ######################################################
+def loader_throughput(data, batch_size, num_workers, prefetch_factor, num_batches=30):
+    """ Batches per second produced by the training dataloader (the start-up of the workers is not counted). """
+    # the sharded dataset shuffles by itself (a DataLoader refuses 'shuffle' with an IterableDataset)
+    loader = data.make_dataloader(data.data_train, shuffle=not isinstance(data.data_train, IterableDataset), batch_size=batch_size, num_workers=num_workers, prefetch_factor=prefetch_factor)
+    iterator = iter(loader)
+    next(iterator) # the first batch also pays the start-up of the workers
+    start = time.perf_counter()
+    n = 0
+    for _ in range(num_batches):
+        try:
+            next(iterator)
+        except StopIteration: # small datasets
+            break
+        n += 1
+    elapsed = time.perf_counter() - start
+    del iterator, loader
+    return n / max(elapsed, 1e-9)
+
+def find_num_workers(data, batch_size, step_time, workers=None, prefetch_factors=(2, 4, 8), num_batches=30, margin=1.1):
+    """
+    Cheapest (number of workers, prefetch factor) configuration whose dataloader produces batches faster than the training
+    consumes them (with a 'margin'), so the GPU is never starved. If none is fast enough, the fastest one is chosen.
+    Returns:
+        tuple: (number of workers, prefetch factor)
+    """
+    if workers is None:
+        cpus = os.cpu_count()
+        workers = sorted({0, 1, 2, 4, 6, 8, 12, 16, cpus} & set(range(cpus + 1)))
+    needed = margin / step_time # batches per second needed by the training
+    rows = []
+    for num_workers in workers:
+        # without worker processes there's nothing to prefetch
+        for prefetch_factor in (prefetch_factors if num_workers > 0 else prefetch_factors[:1]):
+            throughput = loader_throughput(data, batch_size, num_workers, prefetch_factor, num_batches)
+            rows.append({"n_cpu": num_workers, "prefetch_factor": prefetch_factor, "batches_per_s": throughput, "starving": throughput < needed})
+    print(f"the training needs {needed:.2f} batches/s")
+    print_table(rows, ["n_cpu", "prefetch_factor", "batches_per_s", "starving"])
+    # the rows are already sorted from the cheapest to the most expensive configuration
+    not_starving = [r for r in rows if not r["starving"]]
+    best = not_starving[0] if len(not_starving) > 0 else max(rows, key=lambda r: r["batches_per_s"])
+    return best["n_cpu"], best["prefetch_factor"]
+##############################################################################################################################
+
+def tune_host(hparams, data=None, profile_dir="profiles", max_batch_size=256, memory_fraction=0.9):
+    """
+    Searches batch size, dataloader workers, prefetch factor and pin memory for this machine and saves them
+    as the host profile (see 'load_host_profile' in hyperparameters.py).
+    Returns:
+        dict: the hyperparameters overrides for this host
+    """
+    if data is None:
+        data = URBE_DataModule(hparams)
+    data.setup()
+    print("############# searching the batch size... #############")
+    batch_size, step_time = find_batch_size(hparams, data, max_batch_size=max_batch_size, memory_fraction=memory_fraction)
+    print("############# searching the dataloader workers... #############")
+    num_workers, prefetch_factor = find_num_workers(data, batch_size, step_time)
+    overrides = {"batch_size" : batch_size, "n_cpu" : num_workers, "prefetch_factor" : prefetch_factor, "pin_memory" : torch.cuda.is_available()}
+
+    path = host_profile_path(profile_dir)
+    os.makedirs(profile_dir, exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(overrides, f, indent=4)
+    os.replace(path + ".tmp", path)
+    print(f"Host profile saved in {path}: {overrides}")
+    return overrides
+
+if __name__ == "__main__":
+    tune_host(asdict(Hparams()))
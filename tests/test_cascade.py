@@ -0,0 +1,31 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from types import SimpleNamespace
+from src.inference.cascade import CascadeDetector
+
+class FixedDetector:
+    # it returns the same NMS output for every image ('torch.tensor([])' is the output of a frame without predictions)
+    def __init__(self, detections):
+        self.detections = detections
+        self.config = SimpleNamespace(img_size=64, cascade_min_score=0.5, cascade_uncertain_scores=(0.1, 0.5),
+                                      cascade_max_uncertain=3, cascade_escalation="frame")
+
+    def detect(self, imgs, conf_threshold=None, iou_threshold=None, max_detections=50):
+        return [self.detections.clone() for _ in range(imgs.shape[0])]
+
+@pytest.mark.parametrize("escalation", ["frame", "crop"])
+def test_cascade_empty_frame(escalation):
+    teacher = FixedDetector(torch.tensor([[1, 0.9, 4, 4, 20, 20]]))
+    cascade = CascadeDetector(FixedDetector(torch.tensor([])), teacher, escalation=escalation)
+    detections, reasons = cascade(torch.rand((2, 3, 64, 64)))
+    assert reasons == ["low_score", "low_score"]
+    assert all(d.shape == (1, 6) for d in detections)
+
+@pytest.mark.parametrize("escalation", ["frame", "crop"])
+def test_cascade_empty_teacher(escalation):
+    student = FixedDetector(torch.tensor([[0, 0.3, 4, 4, 20, 20]]))
+    cascade = CascadeDetector(student, FixedDetector(torch.tensor([])), escalation=escalation)
+    detections, _ = cascade(torch.rand((1, 3, 64, 64)))
+    assert detections[0].shape[1] == 6
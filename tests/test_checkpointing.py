@@ -0,0 +1,26 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import copy
+from src.inference.network import C3
+
+def train_step(block, x):
+    block.zero_grad(set_to_none=True)
+    block(x).pow(2).mean().backward()
+    stats = {k : v.clone() for k, v in block.named_buffers()}
+    grads = {k : p.grad.clone() for k, p in block.named_parameters()}
+    return stats, grads
+
+def test_checkpointed_block_updates_bn_stats_once():
+    torch.manual_seed(0)
+    block = C3(8, 8, width_multiple=0.5, depth=2).train()
+    checkpointed = copy.deepcopy(block)
+    checkpointed.checkpointing = True
+    x = torch.rand((2, 8, 16, 16), requires_grad=True)
+    stats, grads = train_step(block, x)
+    checkpointed_stats, checkpointed_grads = train_step(checkpointed, x)
+    for k in stats: # same running statistics (and counter) of a normal training step
+        assert torch.allclose(stats[k].float(), checkpointed_stats[k].float())
+    for k in grads:
+        assert torch.allclose(grads[k], checkpointed_grads[k], atol=1e-6)
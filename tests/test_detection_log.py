@@ -0,0 +1,38 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+np = pytest.importorskip("numpy")
+
+from types import SimpleNamespace
+from src.inference.video import VideoDetector
+from src.inference.detection_log import DetectionLogWriter, DetectionLogReader
+
+class OneBoxDetector:
+    # one detection on every frame (every frame is a keyframe with keyframe_interval=1)
+    config = SimpleNamespace(keyframe_interval=1, motion_threshold=0.05, scene_change_threshold=0.15)
+
+    def detect(self, imgs, conf_threshold=None, iou_threshold=None, max_detections=50):
+        return [torch.tensor([[1, 0.9, 10, 10, 50, 50]]) for _ in range(imgs.shape[0])]
+
+def run_video(log, num_frames):
+    video = VideoDetector(OneBoxDetector(), detection_log=log)
+    for _ in range(num_frames):
+        video(torch.rand((1, 3, 64, 64)))
+
+def test_video_detector_on_reopened_log(tmp_path):
+    with DetectionLogWriter(str(tmp_path)) as log:
+        run_video(log, 3)
+    with DetectionLogWriter(str(tmp_path)) as log: # the frames continue after the ones of the first run
+        run_video(log, 2)
+        run_video(log, 2) # a second VideoDetector on the same writer
+    reader = DetectionLogReader(str(tmp_path))
+    assert list(reader.frame_ids) == list(range(7))
+    assert reader.frame(6).shape == (1, 6)
+
+def test_append_without_frame_ids(tmp_path):
+    with DetectionLogWriter(str(tmp_path)) as log:
+        log.append([5], [torch.tensor([])])
+        log.append(None, [torch.tensor([[0, 0.5, 1, 1, 2, 2]]), torch.tensor([])])
+    reader = DetectionLogReader(str(tmp_path))
+    assert list(reader.frame_ids) == [5, 6, 7]
+    assert reader.frame(6).shape == (1, 6) and reader.frame(7).shape == (0, 6)
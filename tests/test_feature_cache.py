@@ -0,0 +1,49 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+np = pytest.importorskip("numpy")
+
+from dataclasses import asdict
+from src.hyperparameters import Hparams
+from src.inference.detector import URBE_Detector
+from src.feature_cache import FeatureCache
+from src.loss import YOLO_Loss
+
+def collate(samples):
+    return {"img" : torch.stack([s["img"] for s in samples]), "labels" : torch.stack([s["labels"] for s in samples])}
+
+def random_labels(max_objects, num_classes):
+    labels = torch.zeros((max_objects, 5))
+    n = int(torch.randint(1, max_objects + 1, (1,)))
+    wh = torch.rand((n, 2)) * 0.3 + 0.05
+    xy = wh / 2 + torch.rand((n, 2)) * (1 - wh)
+    labels[:n] = torch.cat([torch.randint(0, num_classes, (n, 1)).float(), xy, wh], dim=1)
+    return labels
+
+class DatasetView:
+    # the two things 'FeatureCache.build' needs from the URBE_Dataset: its length and its 'data' list
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+def test_cached_features_give_the_live_loss(tmp_path):
+    torch.manual_seed(0)
+    hparams = {**asdict(Hparams()), "first_out" : 16, "img_size" : 64, "augmentation" : False}
+    # the frozen layers use the running statistics of their BatchNorms: the whole network is in eval mode here
+    detector = URBE_Detector(hparams).eval()
+    loss_fn = YOLO_Loss(hparams, detector.head.anchors, detector.head.stride, detector.head.nl)
+    dataset = DatasetView([{"img" : torch.rand((3, 64, 64)), "labels" : random_labels(4, hparams["num_classes"])} for _ in range(6)])
+
+    cache = FeatureCache(str(tmp_path / "features"))
+    cache.build(detector.backbone.forward_prefix, dataset, collate, key="test", batch_size=4)
+    assert cache.matches("test")
+
+    batch = collate(dataset.data)
+    c4, c6 = (torch.stack(t) for t in zip(*[cache.read(i) for i in range(len(dataset))]))
+    assert c4.dtype == torch.float16
+    with torch.no_grad():
+        live_loss = loss_fn(detector(batch["img"]), batch["labels"]).item()
+        cached_loss = loss_fn(detector.forward_from_features(c4.float(), c6.float()), batch["labels"]).item()
+    assert abs(live_loss - cached_loss) <= 1e-2 * abs(live_loss) # fp16 storage of the activations
@@ -0,0 +1,37 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from dataclasses import asdict
+from src.hyperparameters import Hparams
+from src.inference.network import ANCHORS, STRIDE
+from src.loss import YOLO_Loss
+
+def random_batch(batch_size, max_objects, num_classes, img_size):
+    # random predictions of the three scales and (bs, max_objects, 5) zero-padded labels, the first image has no objects
+    preds = [torch.randn((batch_size, 3, img_size // s, img_size // s, 5 + num_classes)) for s in STRIDE]
+    labels = torch.zeros((batch_size, max_objects, 5))
+    for b in range(1, batch_size):
+        n = int(torch.randint(1, max_objects + 1, (1,)))
+        wh = torch.rand((n, 2)) * 0.3 + 0.01
+        xy = wh / 2 + torch.rand((n, 2)) * (1 - wh)
+        labels[b, :n] = torch.cat([torch.randint(0, num_classes, (n, 1)).float(), xy, wh], dim=1)
+    return preds, labels
+
+@pytest.mark.parametrize("target_cache", [False, True])
+def test_fused_loss_matches_per_scale_loss(target_cache):
+    torch.manual_seed(0)
+    hparams = {**asdict(Hparams()), "img_size": 128, "augmentation": False, "target_cache": target_cache}
+    anchors = torch.tensor(ANCHORS).float().view(3, -1, 2) / torch.tensor(STRIDE).repeat(6, 1).T.reshape(3, 3, 2)
+    preds, labels = random_batch(4, 6, hparams["num_classes"], hparams["img_size"])
+    ids = list(range(len(labels)))
+    losses, grads = {}, {}
+    for fused in (False, True):
+        loss_fn = YOLO_Loss({**hparams, "fused_loss": fused}, anchors, STRIDE, 3)
+        p = [t.clone().requires_grad_(True) for t in preds]
+        loss = loss_fn(p, labels, ids)
+        loss.backward()
+        losses[fused], grads[fused] = loss.detach(), [t.grad for t in p]
+    assert torch.allclose(losses[True], losses[False], rtol=1e-4, atol=1e-6)
+    for g_fused, g_loop in zip(grads[True], grads[False]):
+        assert torch.allclose(g_fused, g_loop, rtol=1e-4, atol=1e-7)
@@ -0,0 +1,26 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from types import SimpleNamespace
+from src.inference.video import BoxTracker, VideoDetector
+
+class EmptyDetector:
+    # the NMS output of a frame without predictions is a 1-D 'torch.tensor([])'
+    config = SimpleNamespace(keyframe_interval=1, motion_threshold=0.05, scene_change_threshold=0.15)
+
+    def detect(self, imgs, conf_threshold=None, iou_threshold=None, max_detections=50):
+        return [torch.tensor([]) for _ in range(imgs.shape[0])]
+
+def test_tracker_update_with_empty_detections():
+    tracker = BoxTracker()
+    tracker.update(torch.tensor([[0, 0.9, 10, 10, 50, 50]]))
+    tracker.predict()
+    tracker.update(torch.tensor([]))
+    assert len(tracker) == 1 # missed once, still alive
+
+def test_video_detector_empty_keyframe():
+    video = VideoDetector(EmptyDetector())
+    for _ in range(3): # every frame is a keyframe (keyframe_interval=1)
+        boxes, trigger = video(torch.rand((1, 3, 64, 64)))
+        assert boxes.shape == (0, 6)